@@ -0,0 +1,189 @@
+"""
+Load test for the HTTP frontends of the proxy. This runs the http-api frontend against a fake hardware thread that
+generates state changes and hammers it with concurrent keep-alive clients.
+"""
+import argparse
+import http.client
+import json
+import socket
+import struct
+import threading
+import time
+
+from pyatem.protocol import AtemProtocol
+from pyatem.transport import BaseProtocol
+from openswitcher_proxy.frontend_httpapi import HttpApiFrontendThread
+from openswitcher_proxy.hardware import HardwareThread
+
+
+class FakeTransport(BaseProtocol):
+    def connect(self):
+        pass
+
+    def send_packet(self, packet):
+        pass
+
+
+class FakeHardwareThread(HardwareThread):
+    """
+    Hardware thread without a switcher, it generates an initial state and then changes the program bus at a fixed rate
+    """
+
+    def __init__(self, config, rate):
+        super().__init__(config)
+        self.rate = rate
+        self.switcher = AtemProtocol(transport=FakeTransport())
+        self.switcher.on('connected', self.on_connected)
+        self.switcher.on('change', self.on_change)
+
+    def run(self):
+        sw = self.switcher
+        sw.save_field_data(b'_ver', struct.pack('>HH', 2, 30))
+        sw.save_field_data(b'_pin', b'Fake switcher'.ljust(44, b'\0'))
+        for i in range(1, 21):
+            name = f'Input {i}'.encode()
+            sw.save_field_data(b'InPr', struct.pack('>H20s4s10x', i, name, f'IN{i}'.encode()))
+        for me in range(4):
+            sw.save_field_data(b'PrgI', struct.pack('>BxH', me, 1))
+            sw.save_field_data(b'PrvI', struct.pack('>BxHB3x', me, 2, 0))
+        sw._raise('connected')
+
+        i = 0
+        while not self.stop:
+            i += 1
+            sw.save_field_data(b'PrgI', struct.pack('>BxH', i % 4, i % 20 + 1))
+            time.sleep(1.0 / self.rate)
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = []
+        self.errors = 0
+        self.status = {}
+
+    def add(self, latency, status):
+        with self.lock:
+            self.latency.append(latency)
+            self.status[status] = self.status.get(status, 0) + 1
+
+    def error(self):
+        with self.lock:
+            self.errors += 1
+
+
+def client(port, paths, stats, deadline):
+    connection = None
+    etags = {}
+    i = 0
+    while time.monotonic() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        try:
+            if connection is None:
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+            headers = {}
+            if path in etags:
+                headers['If-None-Match'] = etags[path]
+            start = time.monotonic()
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            stats.add(time.monotonic() - start, response.status)
+            if response.getheader('ETag') is not None:
+                etags[path] = response.getheader('ETag')
+            if response.getheader('Connection', '').lower() == 'close':
+                connection.close()
+                connection = None
+        except (OSError, http.client.HTTPException):
+            stats.error()
+            if connection is not None:
+                connection.close()
+            connection = None
+
+
+def poller(port, stats, deadline):
+    # Long-poll client that waits for changes of the program bus
+    version = None
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    while time.monotonic() < deadline:
+        try:
+            if version is None:
+                connection.request('GET', '/fake?fields=program-bus-input')
+            else:
+                connection.request('GET', f'/fake?since={version}&fields=program-bus-input&timeout=5')
+            response = connection.getresponse()
+            data = json.loads(response.read())
+            if response.status in (200, 410):
+                version = data['version']
+            else:
+                version = None
+        except (OSError, http.client.HTTPException, ValueError):
+            stats.error()
+            connection.close()
+
+
+def stalled(port, deadline):
+    # Client on a bad connection that sends half a request and then nothing
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(b'GET /fake/program-bus-input HTTP/1.1\r\n')
+    time.sleep(max(0, deadline - time.monotonic()))
+    sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the proxy HTTP API")
+    parser.add_argument('--port', type=int, default=18080, help='Port to run the API on')
+    parser.add_argument('--clients', type=int, default=50, help='Number of concurrent clients')
+    parser.add_argument('--pollers', type=int, default=10, help='Number of long-poll clients')
+    parser.add_argument('--stalled', type=int, default=2, help='Number of clients that stop sending halfway')
+    parser.add_argument('--workers', type=int, default=32, help='Worker threads in the API server')
+    parser.add_argument('--duration', type=float, default=10, help='Duration of the test in seconds')
+    parser.add_argument('--rate', type=float, default=50, help='Changes per second generated by the fake hardware')
+    args = parser.parse_args()
+
+    hardware = FakeHardwareThread({'id': 'fake', 'label': 'Fake', 'address': 'fake'}, args.rate)
+    hardware.daemon = True
+    threads = {'hardware': {'fake': hardware}, 'frontend': {}}
+    hardware.start()
+
+    config = {'type': 'http-api', 'bind': f'127.0.0.1:{args.port}', 'auth': False, 'hardware': 'fake',
+              'workers': args.workers}
+    frontend = HttpApiFrontendThread(config, threads)
+    frontend.daemon = True
+    frontend.start()
+    time.sleep(0.5)
+
+    paths = ['/fake/program-bus-input', '/fake/preview-bus-input', '/fake/input-properties', '/fake/product-name',
+             '/fake?fields=program-bus-input,preview-bus-input']
+    stats = Stats()
+    deadline = time.monotonic() + args.duration
+    clients = []
+    for i in range(args.stalled):
+        t = threading.Thread(target=stalled, args=(args.port, deadline), daemon=True)
+        t.start()
+    for i in range(args.pollers):
+        t = threading.Thread(target=poller, args=(args.port, stats, deadline), daemon=True)
+        t.start()
+    time.sleep(0.1)
+    for i in range(args.clients):
+        t = threading.Thread(target=client, args=(args.port, paths, stats, deadline))
+        t.start()
+        clients.append(t)
+    for t in clients:
+        t.join()
+
+    latency = sorted(stats.latency)
+    if len(latency) == 0:
+        print("No requests completed")
+        return
+    print(f'requests:   {len(latency)} ({len(latency) / args.duration:.0f}/s)')
+    print(f'errors:     {stats.errors}')
+    print(f'status:     {stats.status}')
+    for p in [50, 90, 99]:
+        print(f'p{p} latency: {latency[len(latency) * p // 100 - 1] * 1000:.1f}ms')
+    print(f'max latency: {latency[-1] * 1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Replay a capture made with pyatem.capture through AtemProtocol and report the decode throughput.
+"""
+import argparse
+import time
+
+from pyatem.capture import ReplayTransport
+from pyatem.protocol import AtemProtocol
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay an ATEM capture file")
+    parser.add_argument('capture', help='Capture file')
+    parser.add_argument('--realtime', action='store_true', help='Replay with the original timing')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of times to replay the capture')
+    args = parser.parse_args()
+
+    packets = 0
+    size = 0
+    fields = 0
+    duration = 0
+    for i in range(args.repeat):
+        transport = ReplayTransport(args.capture, realtime=args.realtime)
+        switcher = AtemProtocol(transport=transport)
+        counter = [0]
+
+        def count(key, contents):
+            counter[0] += 1
+
+        switcher.on('change', count)
+        start = time.perf_counter()
+        while not transport.finished:
+            switcher.loop()
+        duration += time.perf_counter() - start
+        packets += transport.packets
+        size += transport.bytes
+        fields += counter[0]
+
+    print(f'packets: {packets} ({packets / duration:.0f}/s)')
+    print(f'fields:  {fields} ({fields / duration:.0f}/s)')
+    print(f'data:    {size / 1024 / 1024:.1f} MB ({size / 1024 / 1024 / duration:.1f} MB/s)')
+    print(f'time:    {duration:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
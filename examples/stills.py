@@ -27,10 +27,7 @@ def prepare_image(path, resolution):
     frame = Image.new('RGBA', resolution)
     im.thumbnail(resolution, Image.Resampling.LANCZOS)
     frame.paste(im)
-    pixels = frame.getdata()
-
-    flat = [item for sublist in pixels for item in sublist]
-    return bytes(flat)
+    return pyatem.media.rgba_buffer(frame)
 
 
 def save_image(path, resolution, data):
@@ -64,6 +64,9 @@ def main(version):
     parser.add_argument('--verbose', action='store_true', help='Show more log messages')
     parser.add_argument('--debug', action='store_true', help='Display a lot of debugging info')
     parser.add_argument('--dump', help='dump data for specific packets', nargs='*')
+    parser.add_argument('--profile-callbacks', type=float, nargs='?', const=5, metavar='BUDGET',
+                        help='time the event handlers, warn about handlers slower than BUDGET ms and print a report '
+                             'on SIGUSR1')
     parser.add_argument('--view', choices=['switcher', 'media', 'audio', 'camera'], default='switcher',
                         help='default view to open when launching')
     args = parser.parse_args()
@@ -3,6 +3,7 @@
 import ctypes
 import json
 import logging
+import signal
 import threading
 import time
 import traceback
@@ -46,6 +47,7 @@ class AtemConnection(threading.Thread):
         self.upload_progress = upload_progress
         self.atem = None
         self.ip = None
+        self.profile = None
         self.stop = False
         self.connected = False
         self.log = logging.getLogger('AtemConnection')
@@ -68,6 +70,8 @@ class AtemConnection(threading.Thread):
         else:
             self.log.info(f'Connect to {self.ip}')
             self.mixer = AtemProtocol(self.ip)
+        if self.profile is not None:
+            self.mixer.enable_profiling(budget=self.profile / 1000)
         self.mixer.on('change', self.do_callback)
         self.mixer.on('connected', self.do_connected)
         self.mixer.on('disconnected', self.do_disconnected)
@@ -196,6 +200,7 @@ class AtemWindow(SwitcherPage, MediaPage, AudioPage, CameraPage):
         self.connection = AtemConnection(self.on_change, self.on_disconnect, self.on_transfer_progress,
                                          self.on_download_done, self.on_connect, self.on_upload_done,
                                          self.on_upload_progress)
+        self.connection.profile = args.profile_callbacks
 
         if args.ip:
             self.connection.ip = args.ip
@@ -228,9 +233,17 @@ class AtemWindow(SwitcherPage, MediaPage, AudioPage, CameraPage):
         self.window.add_accel_group(accel)
 
         GLib.timeout_add_seconds(1, self.on_clock)
+        if args.profile_callbacks is not None and hasattr(signal, 'SIGUSR1'):
+            GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, self.on_profile_signal)
 
         Gtk.main()
 
+    def on_profile_signal(self):
+        mixer = getattr(self.connection, 'mixer', None)
+        if mixer is not None and mixer.profiler is not None:
+            self.log_aw.warning('Callback profile, times in ms:\n' + mixer.profiler.format_report())
+        return GLib.SOURCE_CONTINUE
+
     def on_preview_keyboard_change(self, widget, window, key, modifier):
         if self.disable_shortcuts:
             return
@@ -300,6 +313,7 @@ class AtemWindow(SwitcherPage, MediaPage, AudioPage, CameraPage):
                                          self.on_download_done, self.on_connect, self.on_upload_done,
                                          self.on_upload_progress)
         self.connection.daemon = True
+        self.connection.profile = self.args.profile_callbacks
         self.connection.ip = self.settings.get_string('switcher-ip')
         self.connection.start()
 
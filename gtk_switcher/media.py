@@ -370,8 +370,7 @@ class MediaPage:
 
         self.media_pixbuf[index] = pixbuf
 
-        pixels = dest.get_pixels()
-        frame = pyatem.media.rgb_to_atem(pixels, width, height, premultiply)
+        frame = pyatem.media.rgb_to_atem(dest, width, height, premultiply)
         self.media_slot_progress[index].show()
         self.media_slot[index].get_style_context().add_class('uploading')
         self.connection.mixer.upload(0, index, frame, name=name)
@@ -1,4 +1,5 @@
 import argparse
+import signal
 import time
 
 import toml
@@ -6,10 +7,15 @@ import logging
 
 from openswitcher_proxy.error import RecoverableError
 from openswitcher_proxy.frontend_httpapi import HttpApiFrontendThread
+from openswitcher_proxy.frontend_metrics import MetricsFrontendThread
 from openswitcher_proxy.frontend_status import StatusFrontendThread
 from openswitcher_proxy.frontend_tcp import TcpFrontendThread
 from openswitcher_proxy.frontend_mqtt import MqttFrontendThread
+from openswitcher_proxy.frontend_websocket import WebsocketFrontendThread
 from openswitcher_proxy.hardware import HardwareThread
+from openswitcher_proxy.shard import start_shards
+from openswitcher_proxy.virtual import VirtualThread
+from pyatem.supervisor import Supervisor
 
 logging.basicConfig(
     format="%(asctime)s [%(levelname)-8s %(threadName)-15s] %(message)s",
@@ -21,19 +27,60 @@ threads = []
 nthreads = {}
 
 
+def log_callback_profiles(signum, frame):
+    for hwid, hardware in nthreads.get('hardware', {}).items():
+        if hardware.switcher is None or hardware.switcher.profiler is None:
+            continue
+        logging.info(f'Callback profile for {hwid}, times in ms:\n' + hardware.switcher.profiler.format_report())
+
+
 def run(config_path):
     config = toml.load(config_path)
     logging.info('Loading config file ' + config_path)
-    if 'hardware' in config:
-        nthreads['hardware'] = {}
+    proxy = config.get('proxy', {})
+    shared_io = proxy.get('shared-io', False)
+    processes = proxy.get('processes', 0)
+    if not isinstance(processes, int) or processes < 0:
+        logging.error(f'  Invalid processes setting "{processes}", running all hardware in the proxy process')
+        processes = 0
+
+    supervisor = None
+    if shared_io and processes == 0:
+        logging.info('  handling the hardware connections from a single thread')
+        supervisor = Supervisor()
+        supervisor.start()
+
+    nthreads['hardware'] = {}
+    if 'hardware' in config and processes > 0:
+        logging.info(f'  running the hardware in {processes} worker processes')
+        for hwid, t in start_shards(config['hardware'], processes, shared_io=shared_io).items():
+            logging.info(f'  hardware: {hwid} ({t.config["label"]})')
+            t.daemon = True
+            threads.append(t)
+            nthreads['hardware'][hwid] = t
+            t.start()
+    elif 'hardware' in config:
         for hardware in config['hardware']:
             logging.info(f'  hardware: {hardware["id"]} ({hardware["label"]})')
-            t = HardwareThread(hardware)
+            t = HardwareThread(hardware, supervisor=supervisor)
             t.daemon = True
             threads.append(t)
             nthreads['hardware'][hardware['id']] = t
             t.start()
 
+    if 'virtual' in config:
+        for virtual in config['virtual']:
+            logging.info(f'  virtual: {virtual["id"]} ({virtual["label"]})')
+            try:
+                t = VirtualThread(virtual, nthreads['hardware'])
+            except RecoverableError as e:
+                logging.error(f'  Could not initialize the "{virtual["id"]}" virtual device. {e}')
+                continue
+            t.daemon = True
+            threads.append(t)
+            nthreads['hardware'][virtual['id']] = t
+            t.start()
+
     if 'frontend' in config:
         nthreads['frontend'] = {}
         for frontend in config['frontend']:
@@ -54,6 +101,10 @@ def run(config_path):
                     t = TcpFrontendThread(frontend, nthreads)
                 elif frontend['type'] == 'mqtt':
                     t = MqttFrontendThread(frontend, nthreads)
+                elif frontend['type'] == 'websocket':
+                    t = WebsocketFrontendThread(frontend, nthreads)
+                elif frontend['type'] == 'metrics':
+                    t = MetricsFrontendThread(frontend, nthreads)
                 else:
                     logging.error(f'  Unknown frontend type "{frontend["type"]}"')
                     continue
@@ -64,6 +115,10 @@ def run(config_path):
             except RecoverableError as e:
                 logging.error(f'  Could not initialize the "{frontend["type"]}" frontend. {e}')
 
+    if hasattr(signal, 'SIGUSR1'):
+        # `kill -USR1` logs the report of the hardware with profile-callbacks enabled
+        signal.signal(signal.SIGUSR1, log_callback_profiles)
+
     while True:
         time.sleep(1)
 
@@ -0,0 +1,303 @@
+import collections
+import logging
+import selectors
+import socket
+import threading
+import time
+
+from pyatem.metrics import Counter
+
+
+class Connection:
+    """
+    A client connection handled by the EventLoopServer. Subclasses implement the protocol by overriding the
+    on_* methods. The send() method is safe to call from any thread, it only queues the data and wakes up the
+    event loop so slow clients never block the caller.
+    """
+
+    def __init__(self, server, sock, address):
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.recv_buffer = bytearray()
+        self.closed = False
+
+        self.lock = threading.Lock()
+        self.send_queue = collections.deque()
+        self.send_size = 0
+        self.coalesced = collections.OrderedDict()
+        self.out = bytearray()
+        self.last_progress = time.monotonic()
+        self.overflow = False
+        self.closing = False
+
+    def on_connect(self):
+        pass
+
+    def on_data(self):
+        pass
+
+    def on_close(self):
+        pass
+
+    def on_tick(self, now):
+        pass
+
+    def encode(self, items):
+        """Turn a list of queued items into bytes for the socket"""
+        return b''.join(items)
+
+    def send(self, data, key=None, force=False):
+        """
+        Queue data for the client. If the client is not reading fast enough and the buffer goes over the limit
+        then data with a key will replace the previous queued data with the same key instead of growing the
+        buffer. Data without a key will disconnect the client when the hard limit is reached unless force is set.
+
+        Once data for a key is coalesced, newer data for that key keeps replacing it until it has been sent, so a value
+        never overtakes a newer one for the same key.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            if not self.has_pending():
+                # Start the send timeout from the moment there's something to send
+                self.last_progress = time.monotonic()
+            if key is not None and key in self.coalesced:
+                self.coalesced[key] = data
+                self.coalesced.move_to_end(key)
+                self.server.coalesced.add()
+            elif force or self.send_size + len(data) <= self.server.buffer_size:
+                self.send_queue.append(data)
+                self.send_size += len(data)
+            elif key is not None:
+                self.coalesced[key] = data
+                self.coalesced.move_to_end(key)
+                self.server.coalesced.add()
+            elif self.send_size + len(data) <= self.server.buffer_size * 4:
+                self.send_queue.append(data)
+                self.send_size += len(data)
+            else:
+                self.overflow = True
+        self.server.messages.add()
+        self.server.wakeup()
+
+    def close_after_send(self):
+        """Close the connection once all queued data has been written"""
+        self.closing = True
+        if not self.has_pending():
+            self.close()
+
+    def has_pending(self):
+        return len(self.out) > 0 or len(self.send_queue) > 0 or len(self.coalesced) > 0 or self.overflow
+
+    def _take(self, limit):
+        items = []
+        size = 0
+        with self.lock:
+            while len(self.send_queue) and size < limit:
+                item = self.send_queue.popleft()
+                self.send_size -= len(item)
+                items.append(item)
+                size += len(item)
+
+            # The backlog has been cleared, send the latest state of the fields that got coalesced
+            if len(self.send_queue) == 0 and len(self.coalesced):
+                items.extend(self.coalesced.values())
+                self.coalesced.clear()
+        return items
+
+    def handle_write(self):
+        if self.overflow:
+            logging.warning(f'Send buffer for {self.address[0]}:{self.address[1]} overflowed, disconnecting')
+            self.server.dropped.add()
+            self.close()
+            return
+
+        if len(self.out) == 0:
+            items = self._take(self.server.write_size)
+            if len(items) == 0:
+                if self.closing:
+                    self.close()
+                return
+            self.out += self.encode(items)
+
+        try:
+            sent = self.sock.send(self.out)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close()
+            return
+        del self.out[:sent]
+        self.server.bytes_out.add(sent)
+        self.last_progress = time.monotonic()
+        if self.closing and not self.has_pending():
+            self.close()
+
+    def handle_read(self):
+        try:
+            data = self.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if len(data) == 0:
+            self.close()
+            return
+        self.recv_buffer += data
+        try:
+            self.on_data()
+        except ValueError as e:
+            logging.error("Protocol error: " + str(e))
+            self.close()
+        except Exception:
+            # A malformed packet from one client should never stop the server for the other clients
+            logging.exception(f'Error handling data from {self.address[0]}:{self.address[1]}, disconnecting')
+            self.close()
+
+    def check_timeout(self, now):
+        if self.has_pending() and now - self.last_progress > self.server.send_timeout:
+            logging.warning(f'Client {self.address[0]}:{self.address[1]} stopped reading, disconnecting')
+            self.server.dropped.add()
+            self.close()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.send_queue.clear()
+            self.coalesced.clear()
+        self.server.remove(self)
+        try:
+            self.on_close()
+        finally:
+            self.sock.close()
+
+
+class EventLoopServer:
+    """
+    A TCP server that handles all clients from a single thread using selectors. Data for the clients is buffered
+    per connection with a bounded buffer.
+    """
+
+    def __init__(self, address, connection_factory, buffer_size=1024 * 1024, send_timeout=10, write_size=65536,
+                 tick_interval=None):
+        self.connection_factory = connection_factory
+        self.buffer_size = buffer_size
+        self.send_timeout = send_timeout
+        self.write_size = write_size
+        self.tick_interval = tick_interval
+        self.connections = set()
+        self.numclients = 0
+
+        self.messages = Counter()
+        self.coalesced = Counter()
+        self.bytes_out = Counter()
+        self.dropped = Counter()
+
+        self.selector = selectors.DefaultSelector()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(64)
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ)
+
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        self._woken = False
+
+    def get_metrics(self):
+        """
+        Get the number of clients and the counters for the data sent to them. Messages counts everything queued for
+        the clients, coalesced the messages that replaced an older queued message and dropped the clients that got
+        disconnected for not reading fast enough.
+        """
+        return {
+            'clients': self.numclients,
+            'messages': self.messages.total,
+            'messages_rate': self.messages.rate(),
+            'coalesced': self.coalesced.total,
+            'bytes_out': self.bytes_out.total,
+            'bytes_out_rate': self.bytes_out.rate(),
+            'dropped': self.dropped.total,
+        }
+
+    def wakeup(self):
+        if self._woken:
+            return
+        self._woken = True
+        try:
+            self._wakeup_send.send(b'x')
+        except BlockingIOError:
+            pass
+
+    def remove(self, connection):
+        if connection in self.connections:
+            self.connections.discard(connection)
+            self.numclients = len(self.connections)
+            self.selector.unregister(connection.sock)
+
+    def _accept(self):
+        try:
+            sock, address = self.sock.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = self.connection_factory(self, sock, address)
+        self.connections.add(connection)
+        self.numclients = len(self.connections)
+        self.selector.register(sock, selectors.EVENT_READ, connection)
+        try:
+            connection.on_connect()
+        except ValueError as e:
+            logging.error("Protocol error: " + str(e))
+            connection.close()
+        except Exception:
+            logging.exception(f'Error setting up the connection from {address[0]}:{address[1]}, disconnecting')
+            connection.close()
+
+    def serve_forever(self):
+        last_check = time.monotonic()
+        last_tick = last_check
+        timeout = 1 if self.tick_interval is None else min(1, self.tick_interval)
+        while True:
+            # Make sure the connections with queued data are waiting for the socket to become writable
+            for connection in list(self.connections):
+                events = selectors.EVENT_READ
+                if connection.has_pending():
+                    events |= selectors.EVENT_WRITE
+                if self.selector.get_key(connection.sock).events != events:
+                    self.selector.modify(connection.sock, events, connection)
+
+            for key, mask in self.selector.select(timeout=timeout):
+                if key.fileobj is self.sock:
+                    self._accept()
+                elif key.fileobj is self._wakeup_recv:
+                    self._woken = False
+                    try:
+                        while self._wakeup_recv.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    connection = key.data
+                    if mask & selectors.EVENT_READ and not connection.closed:
+                        connection.handle_read()
+                    if mask & selectors.EVENT_WRITE and not connection.closed:
+                        connection.handle_write()
+
+            now = time.monotonic()
+            if self.tick_interval is not None and now - last_tick >= self.tick_interval:
+                last_tick = now
+                for connection in list(self.connections):
+                    connection.on_tick(now)
+
+            if now - last_check >= 1:
+                last_check = now
+                for connection in list(self.connections):
+                    connection.check_timeout(now)
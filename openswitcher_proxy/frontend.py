@@ -1,8 +1,96 @@
 import base64
-from http.server import BaseHTTPRequestHandler
+import logging
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pyatem.command as commandmodule
+from pyatem.metrics import Counter
+
+# Largest command payload AtemProtocol.send_commands() accepts in a single UDP packet
+MAX_COMMAND_PACKET = 1300
+
+
+def make_command(name, arguments, inputs):
+    """
+    Create a command object from the names used by the frontends, `program-input` creates a ProgramInputCommand.
+    Numeric arguments are converted to int and a `source` argument can also be the short name of an input.
+    """
+    classname = name.title().replace('-', '') + "Command"
+    if not hasattr(commandmodule, classname):
+        raise ValueError(f'unknown command {name}')
+    if not isinstance(arguments, dict):
+        raise ValueError(f'arguments for {name} need to be a JSON dict')
+    arguments = dict(arguments)
+    for key in arguments:
+        try:
+            arguments[key] = int(arguments[key])
+        except:
+            pass
+    if 'source' in arguments and arguments['source'] in inputs:
+        arguments['source'] = inputs[arguments['source']]
+    try:
+        return getattr(commandmodule, classname)(**arguments)
+    except TypeError as e:
+        raise ValueError(f'invalid arguments for {name}: {e}')
+
+
+def parse_batch(batch, inputs):
+    """
+    Create the commands for a batch, a list of {"command": name, "arguments": {...}} objects. All commands are
+    validated before anything is sent so a batch is never applied halfway.
+    """
+    if not isinstance(batch, list):
+        raise ValueError('a batch needs to be a JSON list')
+    commands = []
+    for item in batch:
+        if not isinstance(item, dict) or 'command' not in item:
+            raise ValueError('batch items need to be a JSON dict with a command key')
+        commands.append(make_command(str(item['command']), item.get('arguments', {}), inputs))
+    return commands
+
+
+def send_batch(switcher, commands):
+    """
+    Send commands packed into as few packets as possible. Commands in the same packet are applied by the switcher at
+    the same time.
+
+    :return: number of packets sent
+    """
+    packets = []
+    packet = b''
+    for command in commands:
+        data = command.get_command()
+        if len(packet) + len(data) > MAX_COMMAND_PACKET and len(packet) > 0:
+            packets.append(packet)
+            packet = b''
+        packet += data
+    if len(packet) > 0:
+        packets.append(packet)
+
+    for packet in packets:
+        switcher.send_raw(packet)
+    return len(packets)
 
 
 class AuthRequestHandler(BaseHTTPRequestHandler):
+    # Keep connections open between requests, this needs a Content-length on every response
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        # Socket timeout for reading requests and writing responses, also closes idle keep-alive connections
+        self.timeout = self.config.get('request-timeout', 10)
+        super().setup()
+
+    def end_headers(self):
+        # Hand the worker to the next connection when others are waiting, instead of keeping this one alive
+        if getattr(self.server, 'waiting', 0) > 0 and not self.close_connection:
+            self.send_header('Connection', 'close')
+        if hasattr(self.server, 'requests'):
+            self.server.requests.add()
+        super().end_headers()
+
     def verify_auth(self):
         if self.config['auth']:
             ok = False
@@ -13,10 +101,80 @@ class AuthRequestHandler(BaseHTTPRequestHandler):
                     ok = True
 
             if not ok:
+                body = 'Authentication required'.encode()
                 self.send_response(401)
                 self.send_header('WWW-Authenticate', 'Basic realm="OpenSwitcher"')
                 self.send_header('Content-type', 'text/html')
+                self.send_header('Content-length', str(len(body)))
                 self.end_headers()
-                self.wfile.write('Authentication required'.encode())
+                self.wfile.write(body)
                 return False
         return True
+
+
+class PooledHTTPServer(HTTPServer):
+    """
+    HTTP server that handles the connections on a fixed size pool of worker threads. Connections that arrive while
+    all workers and the backlog are in use get a 503 response instead of piling up.
+    """
+
+    def __init__(self, address, handler, workers=32, backlog=64, name='http'):
+        super().__init__(address, handler)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.slots = threading.BoundedSemaphore(workers + backlog)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+        self.connections = Counter()
+        self.requests = Counter()
+        self.rejected = Counter()
+
+    def get_metrics(self):
+        """
+        Get the connections handled by the workers, the connections waiting for a worker and the request counters
+        """
+        return {
+            'clients': self.active,
+            'waiting': self.waiting,
+            'connections': self.connections.total,
+            'requests': self.requests.total,
+            'requests_rate': self.requests.rate(),
+            'rejected': self.rejected.total,
+        }
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            logging.warning(f'Too many connections, rejecting {client_address[0]}:{client_address[1]}')
+            self.rejected.add()
+            try:
+                request.sendall(b'HTTP/1.1 503 Service Unavailable\r\n'
+                                b'Content-Length: 0\r\n'
+                                b'Connection: close\r\n\r\n')
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        with self.lock:
+            self.waiting += 1
+        self.connections.add()
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        with self.lock:
+            self.waiting -= 1
+            self.active += 1
+        try:
+            self.finish_request(request, client_address)
+        except socket.timeout:
+            pass
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self.lock:
+                self.active -= 1
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
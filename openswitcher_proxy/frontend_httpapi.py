@@ -1,12 +1,14 @@
 import base64
 import json
+import math
 import threading
 import logging
-import http.server
+import time
 from functools import partial
 from urllib.parse import urlparse, parse_qsl
 
-from openswitcher_proxy.frontend import AuthRequestHandler
+from openswitcher_proxy.frontend import AuthRequestHandler, PooledHTTPServer, parse_batch, send_batch
+from openswitcher_proxy.hardware import LazyField
 from pyatem.field import FieldBase
 import pyatem.command as commandmodule
 
@@ -21,23 +23,87 @@ class FieldEncoder(json.JSONEncoder):
                     continue
                 result[key] = temp[key]
             return result
+        elif isinstance(obj, LazyField):
+            return self.default(obj.get())
         elif isinstance(obj, bytes):
             return base64.b64encode(obj).decode()
         return obj
 
 
+LONGPOLL_MAX_TIMEOUT = 120
+MAX_BODY = 65536
+
+
 class ApiRequestHandler(AuthRequestHandler):
-    def __init__(self, config, threadpool, *args, **kwargs):
+    def __init__(self, config, threadpool, cache, longpolls, *args, **kwargs):
         self.config = config
         self.threadpool = threadpool
+        self.cache = cache
+        self.longpolls = longpolls
         super().__init__(*args, **kwargs)
 
     def response(self, data, status=200):
+        raw = json.dumps(data, cls=FieldEncoder, indent=2).encode()
+        self.response_raw(raw, status)
+
+    def response_raw(self, raw, status=200, etag=None, headers=None):
         self.send_response(status)
         self.send_header('Content-type', 'application/json')
+        self.send_header('Content-length', str(len(raw)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if headers is not None:
+            for name, value in headers.items():
+                self.send_header(name, value)
         self.end_headers()
-        raw = json.dumps(data, cls=FieldEncoder, indent=2)
-        self.wfile.write(raw.encode())
+        self.wfile.write(raw)
+
+    def not_modified(self, etag):
+        if 'If-None-Match' not in self.headers:
+            return False
+        for tag in self.headers['If-None-Match'].split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == etag or tag == '*':
+                return True
+        return False
+
+    def response_field(self, hw, fieldname):
+        version = self.threadpool['hardware'][hw].get_field_version(fieldname)
+        if version is not None and self.not_modified(f'"{version}"'):
+            self.send_response(304)
+            self.send_header('ETag', f'"{version}"')
+            self.end_headers()
+            return
+
+        etag, raw = self.get_field_json(hw, fieldname)
+        self.response_raw(raw, etag=etag)
+
+    def get_field_json(self, hw, fieldname):
+        hardware = self.threadpool['hardware'][hw]
+        version = hardware.get_field_version(fieldname)
+        if version is None:
+            return None, json.dumps(hardware.switcher.mixerstate[fieldname], cls=FieldEncoder, indent=2).encode()
+
+        # The version is read before serializing, a change while serializing only makes the cached data newer
+        key = (hw, fieldname)
+        cached = self.cache.get(key)
+        if cached is None or cached[0] != version:
+            field = hardware.switcher.mixerstate[fieldname]
+            cached = (version, json.dumps(field, cls=FieldEncoder, indent=2).encode())
+            self.cache[key] = cached
+        return f'"{version}"', cached[1]
+
+    def get_change_json(self, hw, identity, field):
+        # Field objects are replaced on every change, the json is generated once for all waiting clients
+        key = (hw, identity)
+        cached = self.cache.get(key)
+        if cached is None or cached[0] is not field:
+            data = {'field': identity[0], 'index': list(identity[1:]), 'value': field}
+            cached = (field, json.dumps(data, cls=FieldEncoder).encode())
+            self.cache[key] = cached
+        return cached[1]
 
     def do_GET(self):
         if not self.verify_auth():
@@ -61,20 +127,115 @@ class ApiRequestHandler(AuthRequestHandler):
         path = parts.path[1:]
         part = path.split('/')
         args = parts.query
-        if len(part) < 2:
-            return self.response({}, 400)
         if part[0] not in allowed_hw:
             return self.response({'error': 'unknown device specified'}, 404)
 
         hw = part[0]
+        if len(part) < 2 or part[1] == '':
+            return self.response_bulk(hw, dict(parse_qsl(args)))
+
         fieldname = part[1]
+        if fieldname == '_metrics':
+            return self.response(self.threadpool['hardware'][hw].get_metrics())
+        if fieldname == '_profile':
+            return self.response_profile(hw)
         if fieldname in self.threadpool['hardware'][hw].switcher.mixerstate:
-            field = self.threadpool['hardware'][hw].switcher.mixerstate[fieldname]
-            return self.response(field)
+            return self.response_field(hw, fieldname)
         else:
             return self.response({'error': 'unknown field'}, 404)
 
+    def response_profile(self, hw):
+        switcher = self.threadpool['hardware'][hw].switcher
+        if switcher is None or switcher.profiler is None:
+            return self.response({'error': 'callback profiling is not enabled for this device'}, 404)
+        return self.response({'budget': switcher.profiler.budget, 'callbacks': switcher.profiler.report()})
+
+    def response_bulk(self, hw, query):
+        fields = None
+        if 'fields' in query:
+            fields = set(query['fields'].split(','))
+
+        hardware = self.threadpool['hardware'][hw]
+        if 'since' in query:
+            try:
+                instance, since = query['since'].split(':')
+                since = int(since)
+                timeout = float(query.get('timeout', 30))
+            except ValueError:
+                return self.response({'error': 'invalid since or timeout value'}, 400)
+            if not math.isfinite(timeout):
+                return self.response({'error': 'invalid since or timeout value'}, 400)
+            if instance != hardware.instance:
+                # The version is from before a restart of the proxy, the numbers start over for the new state
+                return self.response_gone(hardware)
+            return self.response_changes(hw, since, fields, min(timeout, LONGPOLL_MAX_TIMEOUT))
+
+        # The version is read first, the fields can only be newer. Replaying changes on top of that is harmless.
+        version = hardware.version
+        mixerstate = hardware.switcher.mixerstate
+        names = list(mixerstate)
+        if fields is not None:
+            names = [name for name in names if name in fields]
+
+        result = []
+        for name in names:
+            etag, raw = self.get_field_json(hw, name)
+            result.append(json.dumps(name).encode() + b': ' + raw)
+        version = f'{hardware.instance}:{version}'.encode()
+        raw = b'{"version": "%s", "fields": {' % version + b', '.join(result) + b'}}'
+        self.response_raw(raw)
+
+    def response_changes(self, hw, since, fields, timeout):
+        # A waiting long-poll holds a worker, limit them so there are always workers left for the other requests
+        if not self.longpolls.acquire(blocking=False):
+            raw = json.dumps({'error': 'too many long-poll requests, retry later'}).encode()
+            return self.response_raw(raw, 503, headers={'Retry-After': '1'})
+        try:
+            result = self.wait_for_changes(hw, since, fields, timeout)
+        finally:
+            self.longpolls.release()
+        hardware = self.threadpool['hardware'][hw]
+        if result is None:
+            return self.response_gone(hardware)
+        version, changes = result
+
+        result = [self.get_change_json(hw, identity, field) for _, identity, _, field in changes]
+        version = f'{hardware.instance}:{version}'.encode()
+        raw = b'{"version": "%s", "changes": [' % version + b', '.join(result) + b']}'
+        self.response_raw(raw)
+
+    def response_gone(self, hardware):
+        self.response({'error': 'version not available, reload the state',
+                       'version': f'{hardware.instance}:{hardware.version}'}, 410)
+
+    def wait_for_changes(self, hw, since, fields, timeout):
+        hardware = self.threadpool['hardware'][hw]
+        deadline = time.monotonic() + timeout
+        while True:
+            result = hardware.wait_for_changes(since, max(0, deadline - time.monotonic()))
+            if result is None:
+                return None
+            version, changes = result
+            if fields is not None:
+                changes = [change for change in changes if change[1][0] in fields]
+            if len(changes) > 0 or time.monotonic() >= deadline:
+                return version, changes
+            since = version
+
     def do_POST(self):
+        # Always consume the body so the connection can be reused for the next request
+        try:
+            length = int(self.headers.get('Content-length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            return self.response({'error': 'invalid content-length'}, 400)
+        if length > MAX_BODY:
+            self.close_connection = True
+            return self.response({'error': 'request too large'}, 413)
+        body = self.rfile.read(length).decode()
+
         if not self.verify_auth():
             return
         path = self.path
@@ -90,6 +251,9 @@ class ApiRequestHandler(AuthRequestHandler):
 
         hw = part[0]
         fieldname = part[1]
+        if fieldname == 'batch':
+            return self.handle_batch(hw, body)
+
         classname = fieldname.title().replace('-', '') + "Command"
         if not hasattr(commandmodule, classname):
             return self.response({'error': 'unknown command'}, 404)
@@ -98,13 +262,9 @@ class ApiRequestHandler(AuthRequestHandler):
         if rt is None:
             arguments = dict(parse_qsl(args))
         elif rt == 'application/x-www-form-urlencoded':
-            length = int(self.headers['Content-length'])
-            raw = self.rfile.read(length).decode()
-            arguments = dict(parse_qsl(raw))
+            arguments = dict(parse_qsl(body))
         elif rt == 'application/json':
-            length = int(self.headers['Content-length'])
-            raw = self.rfile.read(length).decode()
-            arguments = json.loads(raw)
+            arguments = json.loads(body)
         else:
             return self.response({'error': 'unknown content-type'}, 400)
 
@@ -125,6 +285,21 @@ class ApiRequestHandler(AuthRequestHandler):
             return self.response({"error": str(e)}, 500)
         return self.response({"status": "ok"})
 
+    def handle_batch(self, hw, body):
+        if self.headers['Content-type'] != 'application/json':
+            return self.response({'error': 'a batch needs to be sent as application/json'}, 400)
+        switcher = self.threadpool['hardware'][hw].switcher
+        try:
+            commands = parse_batch(json.loads(body), switcher.inputs)
+        except ValueError as e:
+            return self.response({'error': str(e)}, 400)
+
+        try:
+            packets = send_batch(switcher, commands)
+        except Exception as e:
+            return self.response({"error": str(e)}, 500)
+        return self.response({"status": "ok", "commands": len(commands), "packets": packets})
+
 
 class HttpApiFrontendThread(threading.Thread):
     def __init__(self, config, threadlist):
@@ -135,15 +310,20 @@ class HttpApiFrontendThread(threading.Thread):
         self.stop = False
         self.server = None
 
+        # (hardware, field) -> (version, serialized json) and (hardware, identity) -> (field, serialized change)
+        self.cache = {}
+
     def run(self):
         logging.info('HTTP-Api frontend run')
         host, port = self.config['bind'].split(':')
         address = (host, int(port))
         logging.info(f'binding to {address}')
 
-        handler = partial(ApiRequestHandler, self.config, self.threadlist)
+        workers = self.config.get('workers', 32)
+        longpolls = threading.BoundedSemaphore(self.config.get('longpoll-limit', max(1, workers // 2)))
+        handler = partial(ApiRequestHandler, self.config, self.threadlist, self.cache, longpolls)
 
-        self.server = http.server.HTTPServer(address, handler)
+        self.server = PooledHTTPServer(address, handler, workers=workers, name=self.name)
         with self.server:
             self.server.serve_forever()
 
@@ -151,4 +331,11 @@ class HttpApiFrontendThread(threading.Thread):
         print(args)
 
     def get_status(self):
-        return 'running'
+        if self.server is None:
+            return 'starting'
+        return 'running, {} active connections'.format(self.server.active)
+
+    def get_metrics(self):
+        if self.server is None:
+            return {}
+        return self.server.get_metrics()
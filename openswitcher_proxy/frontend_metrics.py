@@ -0,0 +1,256 @@
+import math
+import threading
+import logging
+from functools import partial
+
+from openswitcher_proxy.frontend import AuthRequestHandler, PooledHTTPServer
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# Transport counters exported for every hardware device: (key in get_metrics(), name, type, help, unit)
+TRANSPORT_METRICS = [
+    ('bytes_in', 'hardware_received_bytes', 'counter', 'Bytes received from the hardware', 'bytes'),
+    ('bytes_out', 'hardware_sent_bytes', 'counter', 'Bytes sent to the hardware', 'bytes'),
+    ('packets_in', 'hardware_received_packets', 'counter', 'Packets received from the hardware', None),
+    ('packets_out', 'hardware_sent_packets', 'counter', 'Packets sent to the hardware', None),
+    ('retransmissions', 'hardware_received_retransmissions', 'counter',
+     'Packets received from the hardware that are a retransmission of an earlier packet', None),
+    ('retransmission_requests', 'hardware_received_retransmission_requests', 'counter',
+     'Retransmit requests received from the hardware for packets it lost', None),
+]
+
+# Queues in the transport, exported as the queue label of openswitcher_hardware_queue_depth
+TRANSPORT_QUEUES = [
+    ('send_queue', 'send'),
+    ('thread_queue', 'thread'),
+    ('receive_backlog', 'receive'),
+    ('write_queue', 'write'),
+]
+
+# Metrics exported for the frontends, every frontend only has the ones that make sense for its protocol
+FRONTEND_METRICS = [
+    ('connected', 'frontend_up', 'gauge', 'Connection state of the frontend to its upstream server', None),
+    ('clients', 'frontend_clients', 'gauge', 'Connected clients', None),
+    ('waiting', 'frontend_waiting_clients', 'gauge', 'Connections waiting for a worker', None),
+    ('connections', 'frontend_connections', 'counter', 'Accepted connections', None),
+    ('requests', 'frontend_requests', 'counter', 'Handled HTTP requests', None),
+    ('rejected', 'frontend_rejected_connections', 'counter', 'Connections rejected because all workers were busy',
+     None),
+    ('messages', 'frontend_messages', 'counter', 'Messages sent or queued for the clients', None),
+    ('coalesced', 'frontend_coalesced_messages', 'counter', 'Queued messages replaced by a newer value', None),
+    ('suppressed', 'frontend_suppressed_messages', 'counter', 'Messages not published since nothing changed', None),
+    ('pending', 'frontend_pending_messages', 'gauge', 'Messages held back by the rate limit', None),
+    ('queued', 'frontend_queued_messages', 'gauge', 'Changes waiting in the dispatch queue', None),
+    ('bytes_out', 'frontend_sent_bytes', 'counter', 'Bytes sent to the clients', 'bytes'),
+    ('dropped', 'frontend_dropped_clients', 'counter', 'Clients disconnected for not reading fast enough', None),
+]
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+class MetricFamily:
+    def __init__(self, name, kind, description, unit=None):
+        self.name = name
+        self.kind = kind
+        self.description = description
+        self.unit = unit
+        self.samples = []
+
+    def add(self, labels, value, suffix=''):
+        if value is None:
+            return
+        self.samples.append((suffix, labels, value))
+
+    def add_histogram(self, labels, histogram):
+        buckets = histogram.cumulative()
+        for bound, count in buckets:
+            self.add(dict(labels, le=format_value(float(bound))), count, '_bucket')
+        # The count comes from the buckets so it always matches the +Inf bucket, the histogram is updated unlocked
+        self.add(labels, buckets[-1][1], '_count')
+        self.add(labels, histogram.sum, '_sum')
+
+    def add_summary(self, labels, histogram, quantiles=(0.5, 0.9, 0.99)):
+        for quantile in quantiles:
+            self.add(dict(labels, quantile=str(quantile)), histogram.percentile(quantile))
+        self.add(labels, histogram.count, '_count')
+        self.add(labels, histogram.sum, '_sum')
+
+    def render(self):
+        lines = [f'# TYPE {self.name} {self.kind}']
+        if self.unit is not None:
+            lines.append(f'# UNIT {self.name} {self.unit}')
+        description = self.description.replace('\\', '\\\\').replace('\n', '\\n')
+        lines.append(f'# HELP {self.name} {description}')
+        if self.kind == 'counter':
+            default_suffix = '_total'
+        elif self.kind == 'info':
+            default_suffix = '_info'
+        else:
+            default_suffix = ''
+        for suffix, labels, value in self.samples:
+            name = self.name + (suffix or default_suffix)
+            if len(labels):
+                label = ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+                name += '{' + label + '}'
+            lines.append(f'{name} {format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Exposition:
+    """
+    Collects the samples for every metric family so all samples of a family end up together in the output, as
+    required by the OpenMetrics format.
+    """
+
+    def __init__(self, prefix='openswitcher'):
+        self.prefix = prefix
+        self.families = {}
+
+    def family(self, name, kind, description, unit=None):
+        name = f'{self.prefix}_{name}'
+        if name not in self.families:
+            self.families[name] = MetricFamily(name, kind, description, unit)
+        return self.families[name]
+
+    def render(self):
+        families = [family.render() for family in self.families.values() if len(family.samples)]
+        return '\n'.join(families + ['# EOF']) + '\n'
+
+
+def collect_hardware(exposition, hwid, hardware):
+    labels = {'hardware': hwid}
+    switcher = hardware.switcher
+    connected = switcher is not None and switcher.connected
+    exposition.family('hardware_up', 'gauge', 'Connection state of the hardware').add(labels, connected)
+    if switcher is None:
+        return
+
+    info = dict(labels, label=hardware.config.get('label', hwid), address=hardware.config.get('address', 'virtual'))
+    product = switcher.mixerstate.get('product-name')
+    firmware = switcher.mixerstate.get('firmware-version')
+    if product is not None:
+        info['product'] = product.name
+    if firmware is not None:
+        info['firmware'] = firmware.version
+    exposition.family('hardware', 'info', 'Hardware configuration and model').add(info, 1)
+
+    metrics = hardware.get_metrics()
+    transport = metrics['transport']
+    exposition.family('hardware_link_quality_ratio', 'gauge', 'Fraction of packets that did not need a retransmit') \
+        .add(labels, transport['link_quality'] / 100)
+    for key, name, kind, description, unit in TRANSPORT_METRICS:
+        exposition.family(name, kind, description, unit).add(labels, transport[key])
+    queue_depth = exposition.family('hardware_queue_depth', 'gauge', 'Packets waiting in the transport queues')
+    for key, queue in TRANSPORT_QUEUES:
+        if key in transport:
+            queue_depth.add(dict(labels, queue=queue), transport[key])
+    exposition.family('hardware_rtt_seconds', 'histogram', 'Time until a reliable packet is acknowledged', 'seconds') \
+        .add_histogram(labels, switcher.transport.rtt)
+
+    callbacks = exposition.family('hardware_callback_seconds', 'summary', 'Time spent in the event callbacks',
+                                  'seconds')
+    for event, histogram in sorted(list(switcher.callback_times.items())):
+        callbacks.add_summary(dict(labels, event=event), histogram)
+
+    dropped = exposition.family('hardware_dispatch_dropped', 'counter', 'Events dropped by full callback queues')
+    depth = exposition.family('hardware_dispatch_depth', 'gauge', 'Events waiting in the callback queues')
+    for queue, values in sorted(metrics['queues'].items()):
+        dropped.add(dict(labels, queue=queue), values['dropped'])
+        depth.add(dict(labels, queue=queue), values['depth'])
+
+    transfer = exposition.family('hardware_transfer_bytes', 'counter', 'Bytes moved by media transfers', 'bytes')
+    transfer.add(dict(labels, direction='download'), metrics['transfer']['bytes_in'])
+    transfer.add(dict(labels, direction='upload'), metrics['transfer']['bytes_out'])
+
+    if 'version' in metrics:
+        exposition.family('hardware_state_changes', 'counter', 'Changes to the state kept by the proxy') \
+            .add(labels, metrics['version'])
+        exposition.family('hardware_subscribers', 'gauge', 'Frontend connections subscribed to the changes') \
+            .add(labels, metrics['subscribers'])
+
+
+def collect_frontend(exposition, name, frontend):
+    labels = {'frontend': name, 'type': frontend.config['type']}
+    metrics = frontend.get_metrics()
+    for key, metric, kind, description, unit in FRONTEND_METRICS:
+        if key in metrics:
+            exposition.family(metric, kind, description, unit).add(labels, metrics[key])
+
+
+class MetricsRequestHandler(AuthRequestHandler):
+    def __init__(self, config, threadpool, *args, **kwargs):
+        self.config = config
+        self.threadpool = threadpool
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        if not self.verify_auth():
+            return
+
+        if self.path.split('?')[0] != '/metrics':
+            body = b'Not found, the metrics are at /metrics'
+            self.send_response(404)
+            self.send_header('Content-type', 'text/plain')
+            self.send_header('Content-length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        exposition = Exposition()
+        allowed_hw = self.config['hardware'].split(',') if 'hardware' in self.config else None
+        for hwid, hardware in list(self.threadpool.get('hardware', {}).items()):
+            if allowed_hw is None or hwid in allowed_hw:
+                collect_hardware(exposition, hwid, hardware)
+        for name, frontend in list(self.threadpool.get('frontend', {}).items()):
+            collect_frontend(exposition, name, frontend)
+
+        body = exposition.render().encode()
+        self.send_response(200)
+        self.send_header('Content-type', CONTENT_TYPE)
+        self.send_header('Content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsFrontendThread(threading.Thread):
+    def __init__(self, config, threadlist):
+        threading.Thread.__init__(self)
+        self.name = 'metrics.' + str(config['bind'])
+        self.config = config
+        self.threadlist = threadlist
+        self.stop = False
+        self.server = None
+
+    def run(self):
+        logging.info('Metrics frontend run')
+        host, port = self.config['bind'].split(':')
+        address = (host, int(port))
+        logging.info(f'binding to {address}')
+
+        handler = partial(MetricsRequestHandler, self.config, self.threadlist)
+
+        self.server = PooledHTTPServer(address, handler, workers=self.config.get('workers', 2), name=self.name)
+        with self.server:
+            self.server.serve_forever()
+
+    def get_status(self):
+        if self.server is None:
+            return 'starting'
+        return 'running'
+
+    def get_metrics(self):
+        if self.server is None:
+            return {}
+        return self.server.get_metrics()
@@ -1,12 +1,19 @@
+import fnmatch
 import re
 import threading
 import logging
 import json
+import time
 from functools import partial
 from json import JSONDecodeError
 
-from .error import DependencyError
+from .error import ConfigurationError, DependencyError
+from .frontend import parse_batch, send_batch
 from .frontend_httpapi import FieldEncoder
+from .hardware import field_identity
+from pyatem.dispatch import QueuedCallback, POLICIES
+from pyatem.field import FieldBase
+from pyatem.metrics import Counter
 import pyatem.command as commandmodule
 
 try:
@@ -32,6 +39,28 @@ class MqttFrontendThread(threading.Thread):
         self.readonly = not self.config.get('allow-writes', False)
         self.subscribe = self.config['topic-subscribe'] if 'topic-subscribe' in self.config else self.topic
 
+        # Only publish when the payload of a field changes and limit the rate of noisy fields like the audio meters
+        self.retain = self.config.get('retain', False)
+        self.rate_limit = [(pattern, 1.0 / rate) for pattern, rate in self.config.get('rate-limit', {}).items()]
+        self.interval = {}
+        self.publish_lock = threading.Lock()
+        self.published = {}
+        self.last_sent = {}
+        self.pending = {}
+        self.messages = Counter()
+        self.suppressed = Counter()
+
+        # Hardware that (re)connected, the flush thread publishes the complete state for these
+        self.sync_lock = threading.Lock()
+        self.sync_ready = threading.Condition(self.sync_lock)
+        self.sync_pending = []
+
+        # Optionally handle the events on a worker thread so a slow broker doesn't stall the hardware threads
+        self.queue = None
+        self.queue_policy = self.config.get('queue-policy')
+        if self.queue_policy is not None and self.queue_policy not in POLICIES:
+            raise ConfigurationError(f'Unknown queue-policy "{self.queue_policy}" for the MQTT frontend')
+
         regex = self.subscribe.replace('{hardware}', r'(?P<hardware>[^/]+)')
         regex = regex.replace('{field}', r'(?P<field>.+)')
         self.topic_re = re.compile(regex)
@@ -52,24 +81,119 @@ class MqttFrontendThread(threading.Thread):
             self.error = f'could not connect to {host}:{port}'
             self.status = 'error'
             return
+        if self.queue_policy is not None:
+            # A single queue for all events so they are published in the same order as they happened
+            self.queue = QueuedCallback(self.handle_event, size=self.config.get('queue-size', 4096),
+                                        policy=self.queue_policy, key=self.event_key, name=self.name)
         for hw in self.hw_name:
             sw = self.threadlist['hardware'][hw].switcher
 
+            # Publishing the complete state after connecting takes a while, without the queue it's done on the flush
+            # thread instead of the hardware thread
+            if self.queue is None:
+                sync = partial(self.request_sync, hw)
+            else:
+                sync = self.event_handler(self.on_switcher_connected, hw)
+
             # Hook into the events for the registered switchers and update the mqtt topic
-            sw.on('connected', partial(self.on_switcher_connected, hw))
-            sw.on('disconnected', partial(self.on_switcher_disconnected, hw))
-            sw.on('change', partial(self.on_switcher_changed, hw))
+            sw.on('connected', sync)
+            sw.on('disconnected', self.event_handler(self.on_switcher_disconnected, hw))
+            sw.on('change', self.event_handler(self.on_switcher_changed, hw))
 
             if self.threadlist['hardware'][hw].status == 'connected':
                 # Hardware is already connected at this point, re-generate the initial data
-                self.on_switcher_connected(hw)
+                sync()
+
+        flush = threading.Thread(target=self.flush_loop, name=self.name + '.flush', daemon=True)
+        flush.start()
 
         self.client.loop_forever()
 
+    def event_handler(self, handler, hw):
+        if self.queue is None:
+            return partial(handler, hw)
+        return partial(self.queue, handler, hw)
+
+    def handle_event(self, handler, hw, *args):
+        handler(hw, *args)
+
+    def event_key(self, handler, hw, *args):
+        if handler == self.on_switcher_changed:
+            return self.change_key(hw, *args)
+        return hw, handler.__name__
+
+    def change_key(self, hw, field, value):
+        # Fields that exist multiple times share a topic, keep track of every index separately
+        if isinstance(value, FieldBase):
+            return (hw,) + field_identity(field, value)
+        return hw, field
+
+    def get_interval(self, field):
+        if field not in self.interval:
+            self.interval[field] = None
+            for pattern, interval in self.rate_limit:
+                if fnmatch.fnmatchcase(field, pattern):
+                    self.interval[field] = interval
+                    break
+        return self.interval[field]
+
     def on_switcher_changed(self, hw, field, value):
-        raw = json.dumps(value, cls=FieldEncoder)
+        key = self.change_key(hw, field, value)
         topic = self.topic.format(hardware=hw, field=field)
-        self.client.publish(topic, raw)
+
+        interval = self.get_interval(field)
+        if interval is not None:
+            now = time.monotonic()
+            with self.publish_lock:
+                if now - self.last_sent.get(key, 0) < interval:
+                    # Too soon, the flush thread will publish the latest value when the interval has passed
+                    self.pending[key] = (topic, value)
+                    return
+                self.last_sent[key] = now
+                self.pending.pop(key, None)
+
+        self.publish(key, topic, value)
+
+    def publish(self, key, topic, value):
+        raw = json.dumps(value, cls=FieldEncoder)
+        with self.publish_lock:
+            if self.published.get(key) == raw:
+                self.suppressed.add()
+                return
+            self.published[key] = raw
+        self.client.publish(topic, raw, retain=self.retain)
+        self.messages.add()
+
+    def request_sync(self, hw):
+        with self.sync_lock:
+            if hw not in self.sync_pending:
+                self.sync_pending.append(hw)
+            self.sync_ready.notify()
+
+    def flush_loop(self):
+        delay = None
+        if len(self.rate_limit) > 0:
+            delay = min(interval for pattern, interval in self.rate_limit)
+        while True:
+            with self.sync_lock:
+                self.sync_ready.wait_for(lambda: len(self.sync_pending) > 0, delay)
+                sync = self.sync_pending
+                self.sync_pending = []
+            for hw in sync:
+                self.on_switcher_connected(hw)
+
+            if delay is None:
+                continue
+            now = time.monotonic()
+            ready = []
+            with self.publish_lock:
+                for key, (topic, value) in list(self.pending.items()):
+                    if now - self.last_sent.get(key, 0) >= self.get_interval(key[1]):
+                        ready.append((key, topic, value))
+                        del self.pending[key]
+                        self.last_sent[key] = now
+            for key, topic, value in ready:
+                self.publish(key, topic, value)
 
     def on_switcher_connected(self, hw):
         self.on_switcher_changed(hw, 'status', {'upstream': True})
@@ -109,6 +233,9 @@ class MqttFrontendThread(threading.Thread):
             logging.error(f'MQTT: writing to disconnected device "{hw}"')
             return
 
+        if fieldname == 'batch':
+            return self.handle_batch(hw, msg.payload)
+
         classname = fieldname.title().replace('-', '') + "Command"
         if not hasattr(commandmodule, classname):
             logging.error(f'MQTT: unrecognized command {fieldname}')
@@ -143,6 +270,19 @@ class MqttFrontendThread(threading.Thread):
             else:
                 logging.error(f'MQTT: cannot write {fieldname}: {str(e)}')
 
+    def handle_batch(self, hw, payload):
+        switcher = self.threadlist['hardware'][hw].switcher
+        try:
+            commands = parse_batch(json.loads(payload), switcher.inputs)
+        except ValueError as e:
+            # JSONDecodeError is a ValueError too
+            logging.error(f'MQTT: invalid batch: {str(e)}')
+            return
+        try:
+            send_batch(switcher, commands)
+        except Exception as e:
+            logging.error(f'MQTT: cannot send batch: {str(e)}')
+
     def get_status(self):
         if self.status == 'error':
             return f'{self.status}, {self.error}'
@@ -150,3 +290,13 @@ class MqttFrontendThread(threading.Thread):
             return self.status + ' (readonly)'
         else:
             return self.status + ' (writable)'
+
+    def get_metrics(self):
+        return {
+            'connected': self.status == 'running',
+            'messages': self.messages.total,
+            'messages_rate': self.messages.rate(),
+            'suppressed': self.suppressed.total,
+            'pending': len(self.pending),
+            'queued': 0 if self.queue is None else self.queue.depth(),
+        }
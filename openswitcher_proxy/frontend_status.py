@@ -1,9 +1,8 @@
 import threading
 import logging
-import http.server
 from functools import partial
 
-from openswitcher_proxy.frontend import AuthRequestHandler
+from openswitcher_proxy.frontend import AuthRequestHandler, PooledHTTPServer
 
 
 class StatusRequestHandler(AuthRequestHandler):
@@ -19,45 +18,52 @@ class StatusRequestHandler(AuthRequestHandler):
         if self.path == '/favicon.ico':
             self.send_response(404)
             self.send_header('Content-type', 'text/html')
+            self.send_header('Content-length', '0')
             self.end_headers()
             return
 
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        self.wfile.write("<!DOCTYPE html>\n<title>OpenSwitcher proxy status</title>".encode())
-        self.wfile.write("<h1>Status</h1>".encode())
-        self.wfile.write("<h2>Hardware</h2>".encode())
+        # The page is assembled first since the keep-alive connection needs the length before the body
+        page = []
+        page.append("<!DOCTYPE html>\n<title>OpenSwitcher proxy status</title>")
+        page.append("<h1>Status</h1>")
+        page.append("<h2>Hardware</h2>")
         if 'hardware' in self.threadpool:
-            self.wfile.write(
-                '<table border="1"><tr><th>id</th><th>label</th><th>address</th><th>status</th></tr>'.encode())
+            page.append(
+                '<table border="1"><tr><th>id</th><th>label</th><th>address</th><th>status</th></tr>')
             for hwid in self.threadpool['hardware']:
                 hardware = self.threadpool['hardware'][hwid]
-                self.wfile.write('<tr>'.encode())
-                self.wfile.write(f'<td>{hwid}</td>'.encode())
-                self.wfile.write(f'<td>{hardware.config["label"]}</td>'.encode())
-                self.wfile.write(f'<td>{hardware.config["address"]}</td>'.encode())
-                self.wfile.write(f'<td>{hardware.get_status()}</td>'.encode())
-                self.wfile.write('</tr>'.encode())
-            self.wfile.write('</table>'.encode())
+                page.append('<tr>')
+                page.append(f'<td>{hwid}</td>')
+                page.append(f'<td>{hardware.config["label"]}</td>')
+                page.append(f'<td>{hardware.config.get("address", "virtual")}</td>')
+                page.append(f'<td>{hardware.get_status()}</td>')
+                page.append('</tr>')
+            page.append('</table>')
         else:
-            self.wfile.write("No hardware is defined".encode())
+            page.append("No hardware is defined")
 
-        self.wfile.write("<h2>Frontends</h2>".encode())
+        page.append("<h2>Frontends</h2>")
         if 'frontend' in self.threadpool:
-            self.wfile.write(
-                '<table border="1"><tr><th>bind</th><th>type</th><th>auth</th><th>status</th></tr>'.encode())
+            page.append(
+                '<table border="1"><tr><th>bind</th><th>type</th><th>auth</th><th>status</th></tr>')
             for bind in self.threadpool['frontend']:
                 frontend = self.threadpool['frontend'][bind]
-                self.wfile.write('<tr>'.encode())
-                self.wfile.write(f'<td>{bind}</td>'.encode())
-                self.wfile.write(f'<td>{frontend.config["type"]}</td>'.encode())
-                self.wfile.write(f'<td>{frontend.config["auth"]}</td>'.encode())
-                self.wfile.write(f'<td>{frontend.get_status()}</td>'.encode())
-                self.wfile.write('</tr>'.encode())
-            self.wfile.write('</table>'.encode())
+                page.append('<tr>')
+                page.append(f'<td>{bind}</td>')
+                page.append(f'<td>{frontend.config["type"]}</td>')
+                page.append(f'<td>{frontend.config["auth"]}</td>')
+                page.append(f'<td>{frontend.get_status()}</td>')
+                page.append('</tr>')
+            page.append('</table>')
         else:
-            self.wfile.write("No hardware is defined".encode())
+            page.append("No hardware is defined")
+
+        body = ''.join(page).encode()
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html')
+        self.send_header('Content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
 
 class StatusFrontendThread(threading.Thread):
@@ -77,7 +83,7 @@ class StatusFrontendThread(threading.Thread):
 
         handler = partial(StatusRequestHandler, self.config, self.threadlist)
 
-        self.server = http.server.HTTPServer(address, handler)
+        self.server = PooledHTTPServer(address, handler, workers=self.config.get('workers', 4), name=self.name)
         with self.server:
             self.server.serve_forever()
 
@@ -86,3 +92,8 @@ class StatusFrontendThread(threading.Thread):
 
     def get_status(self):
         return 'running'
+
+    def get_metrics(self):
+        if self.server is None:
+            return {}
+        return self.server.get_metrics()
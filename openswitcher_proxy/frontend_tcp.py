@@ -2,28 +2,30 @@ import hmac
 import struct
 import threading
 import logging
-import socketserver
-from functools import partial
 
 from pyatem.command import TransferCompleteCommand
 from pyatem.field import InitCompleteField
 from pyatem.transfer import TransferTask
+from openswitcher_proxy.eventloop import Connection, EventLoopServer
 
 
-class TCPHandler(socketserver.BaseRequestHandler):
+class TcpConnection(Connection):
+    STATE_HANDSHAKE = 0
+    STATE_AUTH = 1
+    STATE_DEVICE = 2
+    STATE_PROXY = 3
+
+    MAX_FRAME = 65535
+
     def __init__(self, config, threadpool, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         self.config = config
         self.threadpool = threadpool
+        self.state = TcpConnection.STATE_HANDSHAKE
         self.device = None
-        self.callback_id = None
-        self.callback_uploaded = None
+        self.subscriber_id = None
+        self.callback_upload = None
         self.transfer_buffer = {}
-        super().__init__(*args, **kwargs)
-
-    def setup(self):
-        if not hasattr(self.server, 'numclients'):
-            self.server.numclients = 0
-        self.server.numclients += 1
 
     def decode_packet(self, data):
         offset = 0
@@ -31,6 +33,8 @@ class TCPHandler(socketserver.BaseRequestHandler):
             raise ValueError("Packet too short")
         while offset < len(data):
             datalen, cmd = struct.unpack_from('!H2x 4s', data, offset)
+            if datalen < 8:
+                raise ValueError("Received packet shorter than its header")
             if datalen > 8 + 32:
                 raise ValueError("Received large packet")
             raw = data[offset + 8:offset + datalen]
@@ -44,150 +48,131 @@ class TCPHandler(socketserver.BaseRequestHandler):
             result += value
         return result
 
-    def _flatten(self, idict):
-        result = []
-        for key in idict:
-            if isinstance(idict[key], dict):
-                result.extend(self._flatten(idict[key]))
-            elif isinstance(idict[key], list):
-                result.extend(idict[key])
-            else:
-                result.append(idict[key])
-        return result
-
     def send_packets(self, data):
         data = self.list_to_packets(data)
         self.send_raw(data)
 
-    def send_raw(self, data):
-        header = struct.pack('!H', len(data))
-        self.request.sendall(header + data)
+    def send_raw(self, data, key=None, force=False):
+        # The length header is added in encode() so queued fields can share a frame
+        if len(data) > TcpConnection.MAX_FRAME:
+            raise ValueError("Packet too large for a single frame")
+        self.send(data, key=key, force=force)
 
     def send_fields(self, fields):
         data = b''
         for field in fields:
             data += field.make_packet()
-        header = struct.pack('!H', len(data))
-        self.request.sendall(header + data)
-
-    def send_initial_sync(self):
-        mixerstate = self.threadpool['hardware'][self.device].switcher.mixerstate
-        state = self._flatten(mixerstate)
-
-        buffer = []
-        size = 0
-        for field in state:
-            if isinstance(field, bytes):
-                continue
-            fsize = len(field.raw) + 8
-            if size + fsize > 1000:
-                self.send_fields(buffer)
-                buffer = []
-                size = 0
-            buffer.append(field)
-            size += fsize
-        self.send_fields(buffer)
-
-        buffer = [InitCompleteField(b'\0\0\0\0')]
-        self.send_fields(buffer)
-
-    def receive(self):
-        try:
-            header = self.request.recv(2)
-        except ConnectionResetError:
-            raise ValueError("Client disconnected")
-        if len(header) == 0:
-            raise ValueError("Client disconnected")
-        datalength, = struct.unpack('!H', header)
-        data_left = datalength
-        data = b''
-        while data_left > 0:
-            block = self.request.recv(data_left)
-            if len(block) == 0:
-                logging.warning("Connection closed")
-                return
-            data_left -= len(block)
-            data += block
+        self.send_raw(data, force=True)
+
+    def encode(self, items):
+        # Merge the queued fields into as few frames as possible, the frame length is limited by the u16 header
+        result = bytearray()
+        frame = bytearray()
+        for item in items:
+            if len(frame) + len(item) > TcpConnection.MAX_FRAME and len(frame) > 0:
+                result += struct.pack('!H', len(frame))
+                result += frame
+                frame.clear()
+            frame += item
+        if len(frame) > 0:
+            result += struct.pack('!H', len(frame))
+            result += frame
+        return result
 
-        return data
+    def send_initial_sync(self, version, entries):
+        # The sync callback of HardwareThread.subscribe()
+        for identity, packet, field in entries:
+            self.send_raw(packet, force=True)
+        self.send_fields([InitCompleteField(b'\0\0\0\0')])
 
-    def handle(self):
-        # Rename thread
-        t = threading.currentThread()
-        t.setName('tcp.{}:{}'.format(self.client_address[0], self.client_address[1]))
+    def on_data(self):
+        while len(self.recv_buffer) >= 2:
+            datalength, = struct.unpack_from('!H', self.recv_buffer)
+            if len(self.recv_buffer) < datalength + 2:
+                return
+            packet = bytes(self.recv_buffer[2:datalength + 2])
+            del self.recv_buffer[:datalength + 2]
+            self.handle_packet(packet)
+            if self.closed:
+                return
 
-        try:
+    def handle_packet(self, packet):
+        if self.state == TcpConnection.STATE_HANDSHAKE:
             # Handshake magic packet
-            handshake = self.receive()
-            packets = list(self.decode_packet(handshake))
+            packets = list(self.decode_packet(packet))
             if len(packets) > 1:
                 logging.warning('Too many packets in handshake, rejecting')
-                return
+                return self.close()
 
             if packets[0][0] != b'*SW*':
                 logging.warning('Invalid magic on new connection, rejecting')
-                return
+                return self.close()
 
             # Optionally run the auth
             if self.config['auth']:
                 self.send_packets([(b'AUTH', b'')])
-                raw = self.receive()
-                packets = list(self.decode_packet(raw))
-                fields = {}
-                for packet in packets:
-                    fields[packet[0]] = packet[1]
-                username = fields[b'*USR'].decode()
-                password = fields[b'*PWD'].decode()
-                user_ok = hmac.compare_digest(self.config['username'], username)
-                pass_ok = hmac.compare_digest(self.config['password'], password)
-                if not user_ok or not pass_ok:
-                    logging.warning("Invalid login information supplied, rejecting")
-                    return
-
-            # Send device list to client
-            logging.info('Client connected')
-            hardware = []
-            for key in self.config['hardware'].split(','):
-                label = self.threadpool['hardware'][key].config['label']
-                hardware.append((b'*HW*', struct.pack('>20s20s', key.encode(), label.encode())))
-            self.send_packets(hardware)
-
+                self.state = TcpConnection.STATE_AUTH
+            else:
+                self.send_device_list()
+
+        elif self.state == TcpConnection.STATE_AUTH:
+            packets = list(self.decode_packet(packet))
+            fields = {}
+            for field in packets:
+                fields[field[0]] = field[1]
+            if b'*USR' not in fields or b'*PWD' not in fields:
+                raise ValueError("Missing credentials")
+            username = fields[b'*USR'].decode()
+            password = fields[b'*PWD'].decode()
+            user_ok = hmac.compare_digest(self.config['username'], username)
+            pass_ok = hmac.compare_digest(self.config['password'], password)
+            if not user_ok or not pass_ok:
+                logging.warning("Invalid login information supplied, rejecting")
+                return self.close()
+            self.send_device_list()
+
+        elif self.state == TcpConnection.STATE_DEVICE:
             # Device selection
-            raw = self.receive()
-            packets = list(self.decode_packet(raw))
+            packets = list(self.decode_packet(packet))
             if packets[0][0] != b'*DEV':
                 logging.error('Expected *DEV response, rejecting')
-                return
-            self.device = packets[0][1].decode()
+                return self.close()
+            device = packets[0][1].decode()
+            if device not in self.config['hardware'].split(','):
+                logging.error(f'Client selected unknown device {device}, rejecting')
+                return self.close()
+            self.device = device
             logging.info('selected device ' + str(self.device))
 
-            # Initial sync
-            self.send_initial_sync()
-
-            # Register events
-            self.callback_id = self.threadpool['hardware'][self.device].switcher.on('change', self.proxy_change)
-            self.callback_upload = self.threadpool['hardware'][self.device].switcher.on('upload-done',
-                                                                                        self.proxy_uploaded)
+            # Register events, the initial sync is sent from the state snapshot in the same step
+            hardware = self.threadpool['hardware'][self.device]
+            self.subscriber_id = hardware.subscribe(self.proxy_change, sync=self.send_initial_sync)
+            self.callback_upload = hardware.switcher.on('upload-done', self.proxy_uploaded)
+            self.state = TcpConnection.STATE_PROXY
 
+        elif self.state == TcpConnection.STATE_PROXY:
             # Proxying
-            while True:
-                packet = self.receive()
-                pid = packet[4:8]
-                if pid.startswith(b'*'):
-                    cmd = pid[1:4].decode()
-                    handler_name = f'handle_{cmd.lower()}'
-                    if hasattr(self, handler_name):
-                        handler = getattr(self, handler_name)
-                        handler(packet)
-                    else:
-                        logging.error(f"Unknown command: {cmd}")
+            pid = packet[4:8]
+            if pid.startswith(b'*'):
+                cmd = pid[1:4].decode()
+                handler_name = f'handle_{cmd.lower()}'
+                if hasattr(self, handler_name):
+                    handler = getattr(self, handler_name)
+                    handler(packet)
                 else:
-                    self.threadpool['hardware'][self.device].switcher.send_raw(packet)
-
-
-        except ValueError as e:
-            logging.error("Protocol error: " + str(e))
-            return
+                    logging.error(f"Unknown command: {cmd}")
+            else:
+                self.threadpool['hardware'][self.device].switcher.send_raw(packet)
+
+    def send_device_list(self):
+        # Send device list to client
+        logging.info('Client connected')
+        hardware = []
+        for key in self.config['hardware'].split(','):
+            label = self.threadpool['hardware'][key].config['label']
+            hardware.append((b'*HW*', struct.pack('>20s20s', key.encode(), label.encode())))
+        self.send_packets(hardware)
+        self.state = TcpConnection.STATE_DEVICE
 
     def handle_xfr(self, packet):
         task = TransferTask.from_tcp(packet)
@@ -204,22 +189,22 @@ class TCPHandler(socketserver.BaseRequestHandler):
             if task.upload:
                 hw.upload(task.store, task.slot, b'', task=self.transfer_buffer[id])
 
-    def finish(self):
-        if self.callback_id is not None:
-            self.threadpool['hardware'][self.device].switcher.off('change', self.callback_id)
+    def on_close(self):
+        if self.subscriber_id is not None:
+            self.threadpool['hardware'][self.device].unsubscribe(self.subscriber_id)
         if self.callback_upload is not None:
             self.threadpool['hardware'][self.device].switcher.off('upload-done', self.callback_upload)
-        self.server.numclients -= 1
 
-    def proxy_change(self, key, val):
-        if isinstance(val, bytes):
-            pass
-            # Don't send packets we can't decode yet
-            # self.send_raw(val)
-        else:
-            self.send_raw(val.make_packet())
+    def proxy_change(self, identity, packet, field):
+        # Runs on the hardware thread, see HardwareThread.subscribe()
+        if packet is None:
+            # The ATEM protocol has no way to remove a field
+            return
+        self.send_raw(packet, key=identity)
 
     def proxy_uploaded(self, store, slot):
+        if (store, slot, True) not in self.transfer_buffer:
+            return
         del self.transfer_buffer[(store, slot, True)]
         self.send_raw(TransferCompleteCommand(store, slot, True).get_command())
 
@@ -239,11 +224,21 @@ class TcpFrontendThread(threading.Thread):
         address = (host, int(port))
         logging.info(f'binding to {address}')
 
-        socketserver.TCPServer.allow_reuse_address = True
-        handler = partial(TCPHandler, self.config, self.threadlist)
-        self.server = socketserver.ThreadingTCPServer(address, handler)
-        self.server.numclients = 0
+        buffer_size = self.config.get('send-buffer', 1024 * 1024)
+        send_timeout = self.config.get('send-timeout', 10)
+        self.server = EventLoopServer(address, self.make_connection, buffer_size=buffer_size,
+                                      send_timeout=send_timeout)
         self.server.serve_forever()
 
+    def make_connection(self, server, sock, address):
+        return TcpConnection(self.config, self.threadlist, server, sock, address)
+
     def get_status(self):
+        if self.server is None:
+            return 'starting'
         return 'running, {} clients'.format(self.server.numclients)
+
+    def get_metrics(self):
+        if self.server is None:
+            return {}
+        return self.server.get_metrics()
@@ -0,0 +1,445 @@
+import base64
+import fnmatch
+import hashlib
+import hmac
+import json
+import logging
+import mimetypes
+import os
+import struct
+import threading
+import time
+from urllib.parse import urlparse, unquote
+
+from openswitcher_proxy.eventloop import Connection, EventLoopServer
+from openswitcher_proxy.frontend_httpapi import FieldEncoder
+import pyatem.command as commandmodule
+
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class Subscription:
+    """
+    The fields a client subscribed to on a hardware unit. The changes are filtered on the hardware thread while the
+    client can replace the subscription from the event loop so the match cache has its own lock.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.subscriber_id = None
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    def matches(self, fieldname):
+        with self.lock:
+            if fieldname not in self.cache:
+                self.cache[fieldname] = any(fnmatch.fnmatchcase(fieldname, pattern) for pattern in self.patterns)
+            return self.cache[fieldname]
+
+
+class WebsocketConnection(Connection):
+    """
+    A single client of the websocket frontend. The connection starts as a plain HTTP request which either gets
+    upgraded to a websocket or gets a file from the static-files directory.
+    """
+    STATE_HTTP = 0
+    STATE_WEBSOCKET = 1
+
+    OP_CONTINUATION = 0x0
+    OP_TEXT = 0x1
+    OP_BINARY = 0x2
+    OP_CLOSE = 0x8
+    OP_PING = 0x9
+    OP_PONG = 0xA
+
+    MAX_REQUEST = 8192
+    MAX_MESSAGE = 65536
+
+    def __init__(self, frontend, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.frontend = frontend
+        self.config = frontend.config
+        self.state = WebsocketConnection.STATE_HTTP
+        self.fragments = None
+
+        # hardware id -> Subscription
+        self.subscriptions = {}
+
+        # Meter fields that arrived too soon after the previous one, key -> message
+        self.meter_lock = threading.Lock()
+        self.meter_sent = {}
+        self.meter_pending = {}
+
+    def encode(self, items):
+        if self.state == WebsocketConnection.STATE_HTTP:
+            return b''.join(items)
+        result = bytearray()
+        for item in items:
+            if isinstance(item, tuple):
+                opcode, payload = item
+            else:
+                opcode, payload = WebsocketConnection.OP_TEXT, item
+            result += self.make_frame(opcode, payload)
+        return result
+
+    def make_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        return header + payload
+
+    def send_message(self, message, key=None, force=False):
+        self.send(json.dumps(message).encode(), key=key, force=force)
+
+    def on_data(self):
+        if self.state == WebsocketConnection.STATE_HTTP:
+            end = self.recv_buffer.find(b'\r\n\r\n')
+            if end == -1:
+                if len(self.recv_buffer) > WebsocketConnection.MAX_REQUEST:
+                    raise ValueError("HTTP request too large")
+                return
+            request = bytes(self.recv_buffer[:end]).decode('latin-1')
+            del self.recv_buffer[:end + 4]
+            self.handle_request(request)
+            if self.closed or self.closing:
+                return
+
+        while self.state == WebsocketConnection.STATE_WEBSOCKET and not self.closed:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            self.handle_frame(*frame)
+
+    def handle_request(self, request):
+        lines = request.split('\r\n')
+        parts = lines[0].split(' ')
+        if len(parts) != 3:
+            raise ValueError("Malformed HTTP request line")
+        method, path, _ = parts
+        headers = {}
+        for line in lines[1:]:
+            if ':' not in line:
+                continue
+            name, value = line.split(':', maxsplit=1)
+            headers[name.strip().lower()] = value.strip()
+
+        if method != 'GET':
+            return self.http_response(405, 'Method Not Allowed', b'Method not allowed')
+
+        if not self.verify_auth(headers):
+            return self.http_response(401, 'Unauthorized', b'Authentication required',
+                                      {'WWW-Authenticate': 'Basic realm="OpenSwitcher"'})
+
+        if headers.get('upgrade', '').lower() == 'websocket':
+            return self.upgrade(headers)
+        return self.serve_static(urlparse(path).path)
+
+    def verify_auth(self, headers):
+        if not self.config['auth']:
+            return True
+        auth = base64.b64encode(f'{self.config["username"]}:{self.config["password"]}'.encode()).decode()
+        return hmac.compare_digest(headers.get('authorization', ''), f'Basic {auth}')
+
+    def http_response(self, status, reason, body, headers=None, content_type='text/html'):
+        response = f'HTTP/1.1 {status} {reason}\r\n'
+        response += f'Content-Type: {content_type}\r\n'
+        response += f'Content-Length: {len(body)}\r\n'
+        response += 'Connection: close\r\n'
+        if headers is not None:
+            for name, value in headers.items():
+                response += f'{name}: {value}\r\n'
+        response += '\r\n'
+        self.send(response.encode() + body, force=True)
+        self.close_after_send()
+
+    def serve_static(self, path):
+        root = self.config.get('static-files')
+        if root is None:
+            return self.http_response(404, 'Not Found', b'Not found')
+
+        root = os.path.realpath(root)
+        filename = os.path.realpath(os.path.join(root, unquote(path).lstrip('/')))
+        if os.path.commonpath([root, filename]) != root:
+            return self.http_response(404, 'Not Found', b'Not found')
+        if os.path.isdir(filename):
+            filename = os.path.join(filename, 'index.html')
+        if not os.path.isfile(filename):
+            return self.http_response(404, 'Not Found', b'Not found')
+
+        content_type, _ = mimetypes.guess_type(filename)
+        with open(filename, 'rb') as handle:
+            body = handle.read()
+        self.http_response(200, 'OK', body, content_type=content_type or 'application/octet-stream')
+
+    def upgrade(self, headers):
+        if 'sec-websocket-key' not in headers:
+            return self.http_response(400, 'Bad Request', b'Missing Sec-WebSocket-Key')
+        if headers.get('sec-websocket-version') != '13':
+            # RFC 6455 section 4.2.2, answer with the version this server supports
+            return self.http_response(426, 'Upgrade Required', b'Unsupported Sec-WebSocket-Version',
+                                      {'Sec-WebSocket-Version': '13'})
+
+        accept = hashlib.sha1(headers['sec-websocket-key'].encode() + WEBSOCKET_GUID).digest()
+        response = 'HTTP/1.1 101 Switching Protocols\r\n'
+        response += 'Upgrade: websocket\r\n'
+        response += 'Connection: Upgrade\r\n'
+        response += f'Sec-WebSocket-Accept: {base64.b64encode(accept).decode()}\r\n'
+        response += '\r\n'
+
+        # The handshake response has to go out before the first websocket frame is encoded
+        self.send(response.encode(), force=True)
+        self.handle_write()
+        self.state = WebsocketConnection.STATE_WEBSOCKET
+
+        hardware = []
+        for hw in self.frontend.hardware:
+            thread = self.frontend.threadlist['hardware'][hw]
+            hardware.append({'id': hw, 'label': thread.config['label'], 'status': thread.get_status()})
+        self.send_message({'type': 'hello', 'hardware': hardware}, force=True)
+
+    def read_frame(self):
+        if len(self.recv_buffer) < 2:
+            return None
+        b0, b1 = self.recv_buffer[0], self.recv_buffer[1]
+        if not b1 & 0x80:
+            raise ValueError("Received unmasked frame from client")
+        length = b1 & 0x7f
+        offset = 2
+        if length == 126:
+            if len(self.recv_buffer) < 4:
+                return None
+            length, = struct.unpack_from('!H', self.recv_buffer, 2)
+            offset = 4
+        elif length == 127:
+            if len(self.recv_buffer) < 10:
+                return None
+            length, = struct.unpack_from('!Q', self.recv_buffer, 2)
+            offset = 10
+        if length > WebsocketConnection.MAX_MESSAGE:
+            raise ValueError("Received large frame")
+        if len(self.recv_buffer) < offset + 4 + length:
+            return None
+
+        mask = bytes(self.recv_buffer[offset:offset + 4])
+        payload = bytes(self.recv_buffer[offset + 4:offset + 4 + length])
+        del self.recv_buffer[:offset + 4 + length]
+
+        if length > 0:
+            mask = (mask * (length // 4 + 1))[:length]
+            payload = (int.from_bytes(payload, 'big') ^ int.from_bytes(mask, 'big')).to_bytes(length, 'big')
+        return b0 & 0x80 != 0, b0 & 0x0f, payload
+
+    def handle_frame(self, fin, opcode, payload):
+        if opcode == WebsocketConnection.OP_PING:
+            self.send((WebsocketConnection.OP_PONG, payload), force=True)
+            return
+        elif opcode == WebsocketConnection.OP_PONG:
+            return
+        elif opcode == WebsocketConnection.OP_CLOSE:
+            self.send((WebsocketConnection.OP_CLOSE, payload[:2]), force=True)
+            self.close_after_send()
+            return
+
+        if opcode == WebsocketConnection.OP_CONTINUATION:
+            if self.fragments is None:
+                raise ValueError("Unexpected continuation frame")
+            self.fragments += payload
+        else:
+            self.fragments = bytearray(payload)
+        if len(self.fragments) > WebsocketConnection.MAX_MESSAGE:
+            raise ValueError("Received large message")
+        if not fin:
+            return
+
+        data = bytes(self.fragments)
+        self.fragments = None
+        try:
+            message = json.loads(data)
+        except ValueError:
+            self.send_message({'type': 'error', 'error': 'malformed message, need a JSON object'})
+            return
+        if not isinstance(message, dict):
+            self.send_message({'type': 'error', 'error': 'malformed message, need a JSON object'})
+            return
+        self.handle_message(message)
+
+    def handle_message(self, message):
+        msgtype = message.get('type')
+        if msgtype == 'subscribe':
+            self.handle_subscribe(message)
+        elif msgtype == 'unsubscribe':
+            self.handle_unsubscribe(message)
+        elif msgtype == 'command':
+            self.handle_command(message)
+        else:
+            self.send_message({'type': 'error', 'id': message.get('id'), 'error': 'unknown message type'})
+
+    def _hardware(self, message):
+        hw = message.get('hardware')
+        if hw not in self.frontend.hardware:
+            self.send_message({'type': 'error', 'id': message.get('id'), 'error': 'unknown device specified'})
+            return None
+        return hw
+
+    def handle_subscribe(self, message):
+        hw = self._hardware(message)
+        if hw is None:
+            return
+        patterns = message.get('fields', ['*'])
+        if not isinstance(patterns, list):
+            patterns = [patterns]
+
+        self.handle_unsubscribe(message)
+        # The subscription is registered before subscribing, a change can arrive before subscribe() returns
+        subscription = Subscription(patterns)
+        self.subscriptions[hw] = subscription
+        hardware = self.frontend.threadlist['hardware'][hw]
+        subscription.subscriber_id = hardware.subscribe(lambda *args: self.on_change(hw, subscription, *args),
+                                                        sync=lambda *args: self.send_snapshot(hw, subscription, *args))
+
+    def handle_unsubscribe(self, message):
+        hw = self._hardware(message)
+        if hw is None or hw not in self.subscriptions:
+            return
+        subscription = self.subscriptions.pop(hw)
+        self.frontend.threadlist['hardware'][hw].unsubscribe(subscription.subscriber_id)
+
+    def handle_command(self, message):
+        hw = self._hardware(message)
+        if hw is None:
+            return
+        fieldname = str(message.get('command'))
+        classname = fieldname.title().replace('-', '') + "Command"
+        if not hasattr(commandmodule, classname):
+            self.send_message({'type': 'error', 'id': message.get('id'), 'error': 'unknown command'})
+            return
+
+        arguments = message.get('arguments', {})
+        if not isinstance(arguments, dict):
+            self.send_message({'type': 'error', 'id': message.get('id'), 'error': 'arguments need to be a JSON dict'})
+            return
+        for key in arguments:
+            try:
+                arguments[key] = int(arguments[key])
+            except:
+                pass
+        if 'source' in arguments:
+            inputs = self.frontend.threadlist['hardware'][hw].switcher.inputs
+            if arguments['source'] in inputs:
+                arguments['source'] = inputs[arguments['source']]
+
+        try:
+            cmd = getattr(commandmodule, classname)(**arguments)
+            self.frontend.threadlist['hardware'][hw].switcher.send_commands([cmd])
+        except Exception as e:
+            self.send_message({'type': 'error', 'id': message.get('id'), 'error': str(e)})
+            return
+        self.send_message({'type': 'result', 'id': message.get('id'), 'status': 'ok'})
+
+    def send_snapshot(self, hw, subscription, version, entries):
+        # The sync callback of HardwareThread.subscribe()
+        fields = []
+        for identity, packet, field in entries:
+            if subscription.matches(identity[0]):
+                fields.append(self.frontend.serialize(hw, identity, field))
+        data = '{"type":"state","hardware":%s,"version":%d,"fields":[%s]}' % (json.dumps(hw), version,
+                                                                             ','.join(fields))
+        self.send(data.encode(), force=True)
+
+    def on_change(self, hw, subscription, identity, packet, field):
+        # Runs on the hardware thread, see HardwareThread.subscribe()
+        if self.subscriptions.get(hw) is not subscription or not subscription.matches(identity[0]):
+            return
+        data = self.frontend.serialize(hw, identity, field)
+        data = ('{"type":"change",' + data[1:]).encode()
+        key = (hw, identity)
+
+        if self.frontend.is_meter(identity[0]):
+            now = time.monotonic()
+            with self.meter_lock:
+                if now - self.meter_sent.get(key, 0) < self.frontend.meter_interval:
+                    self.meter_pending[key] = data
+                    return
+                self.meter_sent[key] = now
+                self.meter_pending.pop(key, None)
+        self.send(data, key=key)
+
+    def on_tick(self, now):
+        # Send the latest value of meters that were held back by the rate limit
+        with self.meter_lock:
+            ready = []
+            for key in list(self.meter_pending):
+                if now - self.meter_sent.get(key, 0) >= self.frontend.meter_interval:
+                    ready.append((key, self.meter_pending.pop(key)))
+                    self.meter_sent[key] = now
+        for key, data in ready:
+            self.send(data, key=key)
+
+    def on_close(self):
+        for hw, subscription in self.subscriptions.items():
+            self.frontend.threadlist['hardware'][hw].unsubscribe(subscription.subscriber_id)
+        self.subscriptions = {}
+
+
+class WebsocketFrontendThread(threading.Thread):
+    def __init__(self, config, threadlist):
+        threading.Thread.__init__(self)
+        self.name = 'websocket.' + str(config['bind'])
+        self.config = config
+        self.threadlist = threadlist
+        self.hardware = self.config['hardware'].split(',')
+        self.stop = False
+        self.server = None
+
+        self.meter_fields = self.config.get('meter-fields', '*-levels').split(',')
+        self.meter_interval = 1.0 / self.config.get('meter-rate', 10)
+
+        # (hardware, identity) -> (field, serialized json), shared by all clients
+        self.cache = {}
+
+    def run(self):
+        logging.info('Websocket frontend run')
+        host, port = self.config['bind'].split(':')
+        address = (host, int(port))
+        logging.info(f'binding to {address}')
+
+        buffer_size = self.config.get('send-buffer', 1024 * 1024)
+        send_timeout = self.config.get('send-timeout', 10)
+        self.server = EventLoopServer(address, self.make_connection, buffer_size=buffer_size,
+                                      send_timeout=send_timeout, tick_interval=self.meter_interval)
+        self.server.serve_forever()
+
+    def make_connection(self, server, sock, address):
+        return WebsocketConnection(self, server, sock, address)
+
+    def is_meter(self, fieldname):
+        return any(fnmatch.fnmatchcase(fieldname, pattern) for pattern in self.meter_fields)
+
+    def serialize(self, hw, identity, field):
+        """
+        Get the JSON for a field in the state and change messages. The field objects are replaced on every change
+        so the JSON is only generated once per change no matter how many clients are subscribed.
+        """
+        key = (hw, identity)
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] is field:
+            return cached[1]
+        value = json.dumps(field, cls=FieldEncoder)
+        data = '{"hardware":%s,"field":%s,"index":%s,"value":%s}' % (json.dumps(hw), json.dumps(identity[0]),
+                                                                     json.dumps(list(identity[1:])), value)
+        self.cache[key] = (field, data)
+        return data
+
+    def get_status(self):
+        if self.server is None:
+            return 'starting'
+        return 'running, {} clients'.format(self.server.numclients)
+
+    def get_metrics(self):
+        if self.server is None:
+            return {}
+        return self.server.get_metrics()
@@ -1,32 +1,107 @@
+import collections
+import fnmatch
+import os
 import threading
 import logging
+import time
 
+from pyatem.capture import start_recording
 from pyatem.protocol import AtemProtocol
 
 
+def field_identity(key, value):
+    """
+    Get a hashable identity for a field. Fields that exist multiple times, like the program bus for every M/E,
+    get the index added the same way AtemProtocol stores them in the mixerstate.
+    """
+    if key not in AtemProtocol.FIELDNAME_UNIQUE or isinstance(value, bytes):
+        return key,
+    idxes = AtemProtocol.FIELDNAME_UNIQUE[key].unpack_from(value.raw, 0)
+    if hasattr(value, 'strip_id'):
+        idxes = (value.strip_id,) + idxes[1:]
+    return (key,) + idxes
+
+
+class LazyField:
+    """
+    A field that is only available as its serialized packet, like the changes forwarded by a worker process. The
+    packet is decoded the first time a frontend needs the field object.
+    """
+    __slots__ = ('packet', '_field')
+
+    def __init__(self, packet):
+        self.packet = packet
+        self._field = None
+
+    def get(self):
+        if self._field is None:
+            key, self._field = AtemProtocol.decode_field(self.packet[4:8], self.packet[8:])
+        return self._field
+
+
 class HardwareThread(threading.Thread):
-    def __init__(self, config):
+    def __init__(self, config, supervisor=None):
         threading.Thread.__init__(self)
         self.name = 'hw.' + str(config['id'])
         self.config = config
+        self.supervisor = supervisor
         self.switcher = None
         self.stop = False
         self.status = 'init'
 
+        # Pre-serialized copy of the switcher state, maintained by on_change on the hardware thread
+        self.subscriber_lock = threading.Lock()
+        self.changed = threading.Condition(self.subscriber_lock)
+        self.subscribers = {}
+        self.subscriber_id = 0
+        self.snapshot = {}
+        self.version = 0
+        self.changelog = collections.deque(maxlen=config.get('changelog-size', 4096))
+
+        # Meter fields change many times per second, they would push everything else out of the changelog. These are
+        # only kept in the snapshot and sent to the subscribers without changing the state version.
+        self.meter_fields = config.get('meter-fields', '*-levels').split(',')
+        self.meter_cache = {}
+
+        # Change counter for every top level field in the mixerstate, used by the frontends to cache the serialized
+        # fields. The instance id keeps the versions unique across restarts of the proxy.
+        self.field_versions = {}
+        self.instance = os.urandom(4).hex()
+
     def run(self):
         logging.info('HardwareThread run')
         self.status = 'connecting...'
+        shared = self.supervisor is not None and self.config['address'] != 'usb' \
+            and not self.config['address'].startswith('tcp://')
         if self.config['address'] == 'usb':
             self.switcher = AtemProtocol(usb='auto')
+        elif shared:
+            self.switcher = self.supervisor.add(self.config['address'])
         else:
             self.switcher = AtemProtocol(ip=self.config['address'])
-        self.switcher.on('connected', self.on_connected)
-        self.switcher.on('change', self.on_change)
-        self.switcher.on('disconnected', self.on_disconnected)
+        if 'record' in self.config:
+            start_recording(self.switcher.transport, self.config['record'])
+        self.setup_profiling()
+        self.register_callbacks()
         self.switcher.connect()
+        if shared:
+            # The supervisor thread handles the connection from here
+            return
         while not self.stop:
             self.switcher.loop()
 
+    def register_callbacks(self):
+        self.switcher.on('connected', self.on_connected)
+        self.switcher.on('change', self.on_change)
+        self.switcher.on('disconnected', self.on_disconnected)
+        self.switcher.on('resynced', self.on_resynced)
+
+    def setup_profiling(self):
+        if self.config.get('profile-callbacks', False):
+            budget = self.config.get('callback-budget', 5)
+            logging.info(f'Profiling the callbacks of {self.config["id"]} with a budget of {budget} ms')
+            self.switcher.enable_profiling(budget=budget / 1000)
+
     def get_status(self):
         if self.status == 'connected':
             name = self.switcher.mixerstate["product-name"].name
@@ -34,13 +109,151 @@ class HardwareThread(threading.Thread):
             self.status += f' ({name} fw {fw})'
         return self.status
 
+    def get_metrics(self):
+        """
+        Get the metrics of the connection to the hardware and of the state kept by the proxy
+        """
+        if self.switcher is None:
+            return {'connected': False}
+        metrics = self.switcher.get_metrics()
+        metrics['version'] = self.version
+        metrics['subscribers'] = len(self.subscribers)
+        metrics['changelog'] = len(self.changelog)
+        return metrics
+
     def on_connected(self):
         self.status = 'connected'
         logging.info('Initial state sync complete')
 
     def on_disconnected(self):
+        # The snapshot is kept, after reconnecting only the fields that changed in the meantime are raised again
         self.status = 'lost connection'
         logging.error('Lost connection with the hardware')
 
+    def on_resynced(self, removed):
+        # Fields that are gone after a reconnect are published as a change with None as packet and field
+        with self.subscriber_lock:
+            removed = [identity for identity in removed if self.snapshot.pop(identity, None) is not None]
+            for identity in removed:
+                self.version += 1
+                self.changelog.append((self.version, identity, None, None))
+            if len(removed) > 0:
+                self.changed.notify_all()
+            subscribers = list(self.subscribers.items())
+
+        for identity in removed:
+            self.field_versions[identity[0]] = self.field_versions.get(identity[0], 0) + 1
+            self._notify(subscribers, identity, None, None)
+
+    def subscribe(self, callback, sync=None):
+        """
+        Register a callback that receives every change as (identity, packet, field). The packet is serialized once for
+        all subscribers so the callbacks get the same immutable bytes object. The callback runs on the hardware thread,
+        frontends should only queue the data there so a slow client can't stall the hardware. Fields that no longer
+        exist after a reconnect are sent with None as packet and field. For hardware in a worker process the field is
+        a LazyField, use the packet where possible so the field isn't decoded.
+
+        If sync is set it's called as sync(version, entries) with the current state as a list of
+        (identity, packet, field) before the subscription becomes active. It runs with the state lock held, so data
+        queued in sync always goes out before the first change. No change can happen between the snapshot and the
+        first callback so nothing is lost or reordered.
+        """
+        with self.subscriber_lock:
+            if sync is not None:
+                sync(self.version, self._entries())
+            self.subscriber_id += 1
+            self.subscribers[self.subscriber_id] = callback
+            return self.subscriber_id
+
+    def unsubscribe(self, subscriber_id):
+        with self.subscriber_lock:
+            self.subscribers.pop(subscriber_id, None)
+
+    def get_snapshot(self):
+        """
+        Get a consistent copy of the switcher state
+
+        :return: tuple of the state version and a list of (identity, packet, field)
+        """
+        with self.subscriber_lock:
+            return self.version, self._entries()
+
+    def _entries(self):
+        return [(identity, packet, field) for identity, (packet, field) in self.snapshot.items()]
+
+    def changes_since(self, version):
+        """
+        Get the buffered changes made after a state version
+
+        :return: tuple of the current version and a list of (version, identity, packet, field), or None if the changelog
+                 doesn't go back far enough and the client needs a new snapshot
+        """
+        with self.subscriber_lock:
+            return self._changes_since(version)
+
+    def wait_for_changes(self, version, timeout):
+        """
+        Block until the state is newer than version or the timeout expires. All waiting clients share a single
+        condition so a change costs one wakeup per waiter instead of every waiter polling the state.
+
+        :return: same as changes_since()
+        """
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return self._changes_since(version)
+
+    def _changes_since(self, version):
+        if version > self.version:
+            return None
+        count = self.version - version
+        if count > len(self.changelog):
+            return None
+        # The newest changes are at the end of the deque, indexing from the right avoids copying the whole log
+        return self.version, [self.changelog[-i] for i in range(count, 0, -1)]
+
+    def is_meter(self, key):
+        if key not in self.meter_cache:
+            self.meter_cache[key] = any(fnmatch.fnmatchcase(key, pattern) for pattern in self.meter_fields)
+        return self.meter_cache[key]
+
+    def get_field_version(self, key):
+        """
+        Get an identifier for the current state of a top level mixerstate field, or None if the field never changed
+        """
+        if key not in self.field_versions:
+            return None
+        return f'{self.instance}-{self.field_versions[key]}'
+
     def on_change(self, key, value):
-        pass
+        if isinstance(value, bytes):
+            # Don't send packets we can't decode yet
+            self.field_versions[key] = self.field_versions.get(key, 0) + 1
+            return
+        self.publish(field_identity(key, value), value.make_packet(), value)
+
+    def publish(self, identity, packet, field):
+        """
+        Store a serialized change in the snapshot and the changelog and send it to the subscribers. The field is the
+        decoded object or a LazyField.
+        """
+        key = identity[0]
+        self.field_versions[key] = self.field_versions.get(key, 0) + 1
+        meter = self.is_meter(key)
+        with self.subscriber_lock:
+            self.snapshot[identity] = (packet, field)
+            if not meter:
+                self.version += 1
+                self.changelog.append((self.version, identity, packet, field))
+                self.changed.notify_all()
+            subscribers = list(self.subscribers.items())
+        self._notify(subscribers, identity, packet, field)
+
+    def _notify(self, subscribers, identity, packet, value):
+        profiler = self.switcher.profiler
+        for subscriber_id, callback in subscribers:
+            if profiler is None:
+                callback(identity, packet, value)
+            else:
+                start = time.perf_counter()
+                callback(identity, packet, value)
+                profiler.observe('subscriber', subscriber_id, callback, time.perf_counter() - start)
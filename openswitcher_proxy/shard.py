@@ -0,0 +1,543 @@
+"""
+Runs the hardware connections in worker processes so the protocol handling of the switchers is spread over multiple
+cores instead of sharing the GIL of the proxy process. Every worker owns the AtemProtocol instances of its devices and
+streams the changed fields to the proxy process, where a mirror of every device is kept for the frontends.
+"""
+import logging
+import multiprocessing
+import pickle
+import queue
+import threading
+import time
+
+from pyatem.media import EncodedFrame, rgba_buffer
+from pyatem.protocol import AtemProtocol
+from pyatem.supervisor import Supervisor
+from pyatem.transfer import TransferTask
+from pyatem.transport import BaseProtocol
+from openswitcher_proxy.hardware import HardwareThread, LazyField
+
+# Messages from the worker, the first items are the type and the hardware id
+CHANGE = 0  # field identity, packet
+CONNECTED = 1
+DISCONNECTED = 2
+EVENT = 3  # event name, args
+METRICS = 4  # metrics, rtt histogram
+
+# Messages to the worker
+SEND = 10  # command data
+CALL = 11  # method name, args, kwargs
+CLIP = 12  # clip index, width, height, name, premultiply, frame count
+FRAME = 13  # clip index, frame or None after the last frame
+
+# Events of the switcher that are raised again on the mirror in the proxy process
+FORWARDED_EVENTS = [
+    'upload-done',
+    'upload-error',
+    'upload-progress',
+    'download-done',
+    'transfer-progress',
+    'clip-upload-done',
+    'clip-upload-progress',
+    'clip-upload-error',
+    'resynced',
+]
+
+# Methods of the AtemProtocol that are run in the worker when they are called on the mirror
+REMOTE_METHODS = ['download', 'upload', 'upload_stream', 'upload_clip']
+
+METRICS_INTERVAL = 1
+
+# Frames of a clip upload that are sent to the worker ahead of the frame being transferred. The worker encodes the
+# frame after the current one in the background so it needs two frames buffered to never wait for the proxy process.
+CLIP_WINDOW = 3
+
+
+class Outbox:
+    """
+    Batches the messages to the proxy process. Pickling and writing happen on a separate thread so the hardware
+    threads only append to a list, all messages queued while a batch is written go out in the next write.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.messages = []
+        self.thread = threading.Thread(target=self._run, name='shard-send', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, *message):
+        with self.lock:
+            self.messages.append(message)
+            if len(self.messages) == 1:
+                self.ready.notify()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                self.ready.wait_for(lambda: len(self.messages) > 0)
+                batch = self.messages
+                self.messages = []
+            try:
+                self.conn.send_bytes(pickle.dumps(batch, pickle.HIGHEST_PROTOCOL))
+            except OSError:
+                # The proxy process is gone, the receiving side in run_worker() stops the worker
+                return
+
+
+class WorkerHardwareThread(HardwareThread):
+    """
+    The connection to a switcher inside a worker process, all changes are forwarded to the mirror in the proxy process
+    """
+
+    def __init__(self, config, outbox, supervisor=None):
+        super().__init__(config, supervisor=supervisor)
+        self.outbox = outbox
+        self.subscribe(self.forward_change)
+
+    def register_callbacks(self):
+        super().register_callbacks()
+        for event in FORWARDED_EVENTS:
+            self.switcher.on(event, self._forward_event(event))
+
+    def _forward_event(self, event):
+        return lambda *args: self.outbox.put(EVENT, self.config['id'], event, args)
+
+    def forward_change(self, identity, packet, field):
+        if packet is None:
+            # Removed fields reach the mirror with the forwarded resynced event
+            return
+        self.outbox.put(CHANGE, self.config['id'], identity, packet)
+
+    def on_connected(self):
+        super().on_connected()
+        self.outbox.put(CONNECTED, self.config['id'])
+
+    def on_disconnected(self):
+        super().on_disconnected()
+        self.outbox.put(DISCONNECTED, self.config['id'])
+
+
+def report_metrics(devices, outbox):
+    while True:
+        time.sleep(METRICS_INTERVAL)
+        for hwid, device in devices.items():
+            if device.switcher is not None:
+                outbox.put(METRICS, hwid, device.get_metrics(), device.switcher.transport.rtt)
+
+
+def run_worker(index, configs, conn, shared_io=False):
+    """
+    Entry point of a worker process, this runs the hardware in configs until the connection to the proxy closes
+    """
+    logging.basicConfig(
+        format=f"%(asctime)s [%(levelname)-8s shard{index} %(threadName)-15s] %(message)s",
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+    outbox = Outbox(conn)
+    outbox.start()
+
+    supervisor = None
+    if shared_io:
+        supervisor = Supervisor()
+        supervisor.start()
+
+    clips = {}
+    devices = {}
+    for config in configs:
+        device = WorkerHardwareThread(config, outbox, supervisor=supervisor)
+        device.daemon = True
+        devices[config['id']] = device
+        device.start()
+    threading.Thread(target=report_metrics, args=(devices, outbox), name='shard-metrics', daemon=True).start()
+
+    while True:
+        try:
+            batch = pickle.loads(conn.recv_bytes())
+        except (EOFError, OSError):
+            logging.info('Connection to the proxy process closed, stopping')
+            return
+        for message in batch:
+            switcher = devices[message[1]].switcher
+            if switcher is None:
+                logging.warning(f'Dropping a command for {message[1]}, the hardware is not running yet')
+                continue
+            try:
+                if message[0] == SEND:
+                    switcher.send_raw(message[2])
+                elif message[0] == CALL and message[2] in REMOTE_METHODS:
+                    getattr(switcher, message[2])(*message[3], **message[4])
+                elif message[0] == CLIP:
+                    hwid, index, width, height, name, premultiply, frame_count = message[1:]
+                    frames = queue.Queue()
+                    clips[(hwid, index)] = frames
+                    # upload_clip() waits for the first frames, those arrive on this thread
+                    threading.Thread(target=switcher.upload_clip, name='shard-clip', daemon=True,
+                                     args=(index, iter(frames.get, None), width, height),
+                                     kwargs={'name': name, 'premultiply': premultiply,
+                                             'frame_count': frame_count}).start()
+                elif message[0] == FRAME:
+                    frames = clips[(message[1], message[2])]
+                    frames.put(message[3])
+                    if message[3] is None:
+                        del clips[(message[1], message[2])]
+            except Exception:
+                logging.exception(f'Could not run a command for {message[1]}')
+
+
+class RemoteTransport(BaseProtocol):
+    """
+    Transport for the mirror of a device in a worker process, the outgoing commands are sent to the worker and the
+    counters are the ones last reported by the worker.
+    """
+
+    def __init__(self, shard, hwid):
+        super().__init__()
+        self.shard = shard
+        self.hwid = hwid
+        self.metrics = None
+
+    def connect(self):
+        pass
+
+    def send_packet(self, packet):
+        self.shard.send(SEND, self.hwid, packet.data)
+
+    def _send_packet(self, packet):
+        self.shard.send(SEND, self.hwid, packet.data)
+
+    def get_link_quality(self):
+        if self.metrics is None:
+            return super().get_link_quality()
+        return self.metrics['link_quality']
+
+    def get_metrics(self):
+        if self.metrics is None:
+            return super().get_metrics()
+        return self.metrics
+
+
+def portable_frame(frame):
+    """
+    Convert a frame to an object that can be pickled for the worker process. Images are converted to RGBA8888 bytes
+    and pre-encoded frames that are backed by a mapped file get a copy of their data.
+    """
+    if isinstance(frame, EncodedFrame):
+        if isinstance(frame.data, bytes) and frame._map is None:
+            return frame
+        return EncodedFrame(bytes(frame.data), frame.data_length, frame.hash, frame.width, frame.height,
+                            name=frame.name, description=frame.description)
+    buffer = rgba_buffer(frame)
+    if isinstance(buffer, bytes):
+        return buffer
+    return memoryview(buffer).tobytes()
+
+
+class RemoteSwitcher(AtemProtocol):
+    """
+    Mirror of the AtemProtocol in a worker process. The state is rebuilt from the forwarded fields, media transfers
+    are started in the worker and their events are raised here again.
+
+    The forwarded packets are kept as they are until the mixerstate or the inputs are read, most changes are only
+    passed on to the frontends as packets and never need to be decoded in the proxy process. Once a callback for the
+    change events is registered every packet is decoded when it arrives so the events can be raised.
+
+    The frames for uploads are converted to bytes before they are sent to the worker. The frames of a clip are read
+    from the iterator on a separate thread and sent a few frames ahead of the upload.
+    """
+
+    def __init__(self, shard, hwid):
+        # identity -> packet for the changes that are not decoded into the mixerstate yet
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.decode_changes = False
+        super().__init__(transport=RemoteTransport(shard, hwid))
+        self.remote_metrics = None
+        self.clip_lock = threading.Lock()
+        self.clip_progress = threading.Condition(self.clip_lock)
+        self.clips_done = {}
+        self.on('clip-upload-progress', self._on_clip_progress)
+        self.on('clip-upload-done', self._on_clip_done)
+        self.on('clip-upload-error', lambda index, error: self._on_clip_done(index))
+        self.on('disconnected', self._on_clip_done)
+
+    @property
+    def mixerstate(self):
+        if len(self.pending) > 0:
+            self._decode_pending()
+        return self._mixerstate
+
+    @mixerstate.setter
+    def mixerstate(self, value):
+        self._mixerstate = value
+
+    @property
+    def inputs(self):
+        if len(self.pending) > 0:
+            self._decode_pending()
+        return self._inputs
+
+    @inputs.setter
+    def inputs(self, value):
+        self._inputs = value
+
+    def on(self, event, callback):
+        if event.startswith('change'):
+            self.decode_changes = True
+        return super().on(event, callback)
+
+    def store_packet(self, identity, packet):
+        """Update the state with a packet forwarded by the worker"""
+        if self.decode_changes:
+            self.save_field_data(packet[4:8], packet[8:])
+            return
+        with self.pending_lock:
+            self.pending[identity] = packet
+
+    def remove_fields(self, identities):
+        with self.pending_lock:
+            for identity in identities:
+                self.pending.pop(identity, None)
+        for identity in identities:
+            self._remove_field(identity)
+
+    def _decode_pending(self):
+        with self.pending_lock:
+            for identity, packet in self.pending.items():
+                key, contents = self.decode_field(packet[4:8], packet[8:])
+                if len(identity) > 1:
+                    unique = self.make_unique_dict(contents, identity[1:])
+                    self._mixerstate[key] = self.recursive_merge(self._mixerstate.get(key, {}), unique)
+                else:
+                    self._mixerstate[key] = contents
+                if key == 'input-properties':
+                    self._inputs[contents.short_name] = contents.index
+            self.pending = {}
+
+    def _call(self, method, *args, **kwargs):
+        self.transport.shard.send(CALL, self.transport.hwid, method, args, kwargs)
+
+    def download(self, store, index):
+        self._call('download', store, index)
+
+    def upload(self, store, index, data, compress=True, compressed=False, name=None, description=None, size=None,
+               task=None):
+        if task is not None:
+            if type(task) is not TransferTask:
+                raise TypeError(f'Uploading a {type(task).__name__} is not supported with worker processes')
+            task.data = bytes(task.data)
+        elif compressed:
+            data = bytes(data)
+        else:
+            data = portable_frame(data)
+        self._call('upload', store, index, data, compress=compress, compressed=compressed, name=name,
+                   description=description, size=size, task=task)
+
+    def upload_stream(self, store, index, data, width, height, premultiply=False, name=None, description=None):
+        self._call('upload_stream', store, index, portable_frame(data), width, height, premultiply=premultiply,
+                   name=name, description=description)
+
+    def upload_clip(self, index, frames, width, height, name=None, premultiply=False, frame_count=None):
+        if frame_count is None and hasattr(frames, '__len__'):
+            frame_count = len(frames)
+        with self.clip_lock:
+            self.clips_done[index] = 0
+        self.transport.shard.send(CLIP, self.transport.hwid, index, width, height, name, premultiply, frame_count)
+        threading.Thread(target=self._send_clip, args=(index, frames), name='clip-upload', daemon=True).start()
+
+    def _send_clip(self, index, frames):
+        hwid = self.transport.hwid
+        sent = 0
+        try:
+            for frame in frames:
+                with self.clip_lock:
+                    self.clip_progress.wait_for(lambda: index not in self.clips_done
+                                                or self.clips_done[index] + CLIP_WINDOW > sent)
+                    if index not in self.clips_done:
+                        # The connection was lost, the upload won't continue
+                        break
+                self.transport.shard.send(FRAME, hwid, index, portable_frame(frame))
+                sent += 1
+        except Exception:
+            self.log.exception(f'Could not send frame {sent} of clip {index}, the clip ends here')
+        self.transport.shard.send(FRAME, hwid, index, None)
+
+    def _on_clip_progress(self, index, frames_done, frame_count, progress):
+        with self.clip_lock:
+            self.clips_done[index] = frames_done
+            self.clip_progress.notify_all()
+
+    def _on_clip_done(self, index=None):
+        with self.clip_lock:
+            if index is None:
+                self.clips_done.clear()
+            else:
+                self.clips_done.pop(index, None)
+            self.clip_progress.notify_all()
+
+    def get_metrics(self):
+        metrics = super().get_metrics()
+        if self.remote_metrics is not None:
+            metrics['transfer'] = self.remote_metrics['transfer']
+        return metrics
+
+
+class RemoteHardwareThread(HardwareThread):
+    """
+    Hardware that runs in a worker process. It's used by the frontends like a normal HardwareThread, the messages
+    from the worker are handled on the thread of its ShardThread.
+    """
+
+    def __init__(self, config, shard):
+        super().__init__(config)
+        self.shard = shard
+        self.status = 'connecting...'
+        self.resyncing = False
+        self.resync_seen = set()
+        self.switcher = RemoteSwitcher(shard, config['id'])
+        self.register_callbacks()
+        self.setup_profiling()
+
+    def run(self):
+        # Nothing to do here, the ShardThread feeds the changes from the worker
+        pass
+
+    def register_callbacks(self):
+        # The changes are published from the forwarded packets in handle(), not from the change events
+        self.switcher.on('connected', self.on_connected)
+        self.switcher.on('disconnected', self.on_disconnected)
+        self.switcher.on('resynced', self.on_resynced)
+
+    def handle(self, message):
+        switcher = self.switcher
+        if message[0] == CHANGE:
+            identity, packet = message[2], message[3]
+            if self.resyncing:
+                self.resync_seen.add(identity)
+                entry = self.snapshot.get(identity)
+                if entry is not None and entry[0] == packet:
+                    return
+            switcher.store_packet(identity, packet)
+            self.publish(identity, packet, LazyField(packet))
+        elif message[0] == CONNECTED:
+            if self.resyncing:
+                self.resyncing = False
+                removed = [identity for identity in list(self.snapshot) if identity not in self.resync_seen]
+                self.resync_seen = set()
+                switcher.remove_fields(removed)
+                switcher._raise('resynced', removed)
+            switcher.connected = True
+            switcher._raise('connected')
+        elif message[0] == DISCONNECTED:
+            if switcher.connected:
+                switcher.connected = False
+                switcher._raise('disconnected')
+        elif message[0] == EVENT:
+            if message[2] == 'resynced':
+                switcher.remove_fields(message[3][0])
+            switcher._raise(message[2], *message[3])
+        elif message[0] == METRICS:
+            switcher.remote_metrics = message[2]
+            switcher.transport.metrics = message[2]['transport']
+            switcher.transport.rtt = message[3]
+
+    def worker_lost(self):
+        """
+        The worker process stopped. The new worker sends the complete state again, only the packets that differ from
+        the snapshot are published and the fields that are missing from the new state are removed when it's complete.
+        """
+        self.handle((DISCONNECTED, self.config['id']))
+        self.resyncing = len(self.snapshot) > 0
+        self.resync_seen = set()
+
+
+class ShardThread(threading.Thread):
+    """
+    Starts a worker process for a group of hardware devices and receives the changes from it. The worker is restarted
+    when it exits.
+    """
+
+    def __init__(self, index, configs, shared_io=False):
+        threading.Thread.__init__(self)
+        self.name = f'shard.{index}'
+        self.index = index
+        self.configs = configs
+        self.shared_io = shared_io
+        self.context = multiprocessing.get_context('spawn')
+        self.process = None
+        self.conn = None
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.hardware = {config['id']: RemoteHardwareThread(config, self) for config in configs}
+
+    def send(self, *message):
+        try:
+            data = pickle.dumps([message], pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            raise TypeError(f"Can't send the arguments to the worker process of {message[1]}: {e}") from e
+        with self.lock:
+            if self.conn is None:
+                logging.warning(f'Dropping a command for {message[1]}, the worker process is not running')
+                return
+            self.conn.send_bytes(data)
+
+    def stop(self):
+        self.stopped = True
+        if self.process is not None:
+            self.process.terminate()
+
+    def run(self):
+        while not self.stopped:
+            conn, child = self.context.Pipe()
+            self.process = self.context.Process(target=run_worker, name=self.name, daemon=True,
+                                                args=(self.index, self.configs, child, self.shared_io))
+            self.process.start()
+            child.close()
+            with self.lock:
+                self.conn = conn
+
+            try:
+                while True:
+                    for message in pickle.loads(conn.recv_bytes()):
+                        self._handle(message)
+            except (EOFError, OSError):
+                pass
+
+            with self.lock:
+                self.conn = None
+            conn.close()
+            self.process.join(1)
+            if self.stopped:
+                return
+            logging.error(f'Worker process {self.name} stopped with exit code {self.process.exitcode}, restarting')
+            for hardware in self.hardware.values():
+                hardware.worker_lost()
+            time.sleep(1)
+
+    def _handle(self, message):
+        try:
+            self.hardware[message[1]].handle(message)
+        except Exception:
+            logging.exception(f'Exception while handling a change from {message[1]}')
+
+
+def start_shards(configs, processes, shared_io=False):
+    """
+    Divide the hardware over the worker processes and start them
+
+    :return: dict of hardware id to RemoteHardwareThread
+    """
+    groups = [configs[i::processes] for i in range(processes)]
+    hardware = {}
+    for index, group in enumerate(groups):
+        if len(group) == 0:
+            continue
+        shard = ShardThread(index, group, shared_io=shared_io)
+        shard.daemon = True
+        hardware.update(shard.hardware)
+        shard.start()
+    return {config['id']: hardware[config['id']] for config in configs}
@@ -0,0 +1,56 @@
+import socket
+import struct
+import threading
+import types
+from unittest import TestCase
+
+from openswitcher_proxy.eventloop import Connection, EventLoopServer
+from openswitcher_proxy.frontend_tcp import TcpConnection
+
+
+class Test(TestCase):
+    def _server(self, factory, **kwargs):
+        server = EventLoopServer(('127.0.0.1', 0), factory, **kwargs)
+        self.addCleanup(server.sock.close)
+        return server
+
+    def test_coalesce_order(self):
+        server = self._server(Connection, buffer_size=8)
+        connection = Connection(server, None, ('test', 0))
+
+        connection.send(b'1234')
+        connection.send(b'5678')
+        connection.send(b'old', key='field')
+        self.assertEqual(list(connection.coalesced.values()), [b'old'])
+
+        # Drain part of the backlog so the buffer is under the limit again, a newer value for the coalesced field
+        # should replace the coalesced value instead of being queued before it
+        self.assertEqual(connection._take(1), [b'1234'])
+        connection.send(b'new', key='field')
+        connection.send(b'other', key='other')
+        self.assertEqual(connection._take(1024), [b'5678', b'new', b'other'])
+        self.assertFalse(connection.has_pending())
+
+    def test_malformed_packet(self):
+        config = {'auth': False, 'hardware': 'atem'}
+        threadpool = {'hardware': {'atem': types.SimpleNamespace(config={'label': 'Test'})}}
+        server = self._server(lambda *args: TcpConnection(config, threadpool, *args))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        bad = socket.create_connection(server.sock.getsockname(), timeout=5)
+        good = socket.create_connection(server.sock.getsockname(), timeout=5)
+        self.addCleanup(bad.close)
+        self.addCleanup(good.close)
+
+        # A handshake with a truncated second header makes struct.unpack fail, only this client gets disconnected
+        packet = struct.pack('!H2x 4s', 8, b'*SW*') + b'\x00'
+        bad.sendall(struct.pack('!H', len(packet)) + packet)
+        self.assertEqual(bad.recv(1024), b'')
+
+        packet = struct.pack('!H2x 4s', 8, b'*SW*')
+        good.sendall(struct.pack('!H', len(packet)) + packet)
+        data = good.recv(1024)
+        self.assertEqual(data[6:10], b'*HW*')
+        self.assertEqual(data[10:14], b'atem')
+        self.assertTrue(thread.is_alive())
@@ -0,0 +1,117 @@
+import http.client
+import json
+import struct
+import threading
+import time
+from unittest import TestCase
+
+from pyatem.emulator import default_dump
+from pyatem.protocol import AtemProtocol
+from pyatem.transport import BaseProtocol
+from openswitcher_proxy.frontend_httpapi import HttpApiFrontendThread
+from openswitcher_proxy.hardware import HardwareThread
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.hardware = HardwareThread({'id': 'atem', 'label': 'ATEM', 'changelog-size': 4})
+        self.hardware.switcher = AtemProtocol(transport=BaseProtocol())
+        self.hardware.register_callbacks()
+        for name, raw in default_dump(inputs=4):
+            self.hardware.switcher.save_field_data(name, raw)
+
+        config = {'bind': '127.0.0.1:0', 'auth': False, 'hardware': 'atem', 'workers': 4, 'longpoll-limit': 1}
+        self.frontend = HttpApiFrontendThread(config, {'hardware': {'atem': self.hardware}})
+        self.frontend.daemon = True
+        self.frontend.start()
+        while self.frontend.server is None:
+            time.sleep(0.01)
+        self.addCleanup(self.frontend.server.shutdown)
+
+    def get(self, path):
+        return self.request('GET', path)
+
+    def request(self, method, path, headers=None):
+        connection = http.client.HTTPConnection(*self.frontend.server.server_address, timeout=10)
+        connection.request(method, path, headers=headers or {})
+        response = connection.getresponse()
+        body = json.loads(response.read())
+        connection.close()
+        return response.status, body
+
+    def test_meters(self):
+        version = self.hardware.version
+        for i in range(10):
+            self.hardware.switcher.save_field_data(b'AMLv', struct.pack('>H2x 8I', 0, *[i] * 8))
+        self.assertEqual(version, self.hardware.version)
+        packet, field = self.hardware.snapshot[('audio-meter-levels',)]
+        self.assertIs(self.hardware.switcher.mixerstate['audio-meter-levels'], field)
+
+        # The meters don't push the changes out of the small changelog
+        self.hardware.switcher.save_field_data(b'PrgI', struct.pack('>BxH', 0, 3))
+        status, body = self.get(f'/atem?since={self.hardware.instance}:{version}&timeout=0')
+        self.assertEqual(200, status)
+        self.assertEqual(['program-bus-input'], [change['field'] for change in body['changes']])
+
+    def test_removed(self):
+        version = self.hardware.version
+        removed = []
+        self.hardware.subscribe(lambda identity, packet, field: removed.append((identity, packet, field)))
+
+        # Reconnect to a switcher that no longer has input 4
+        self.hardware.switcher.connected = True
+        self.hardware.switcher.handle_packet(None)
+        for name, raw in default_dump(inputs=4):
+            if name != b'InPr' or struct.unpack_from('>H', raw)[0] != 4:
+                self.hardware.switcher.save_field_data(name, raw)
+
+        self.assertEqual([(('input-properties', 4), None, None)], removed)
+        self.assertNotIn(('input-properties', 4), self.hardware.snapshot)
+        status, body = self.get(f'/atem?since={self.hardware.instance}:{version}&timeout=0')
+        self.assertEqual(200, status)
+        self.assertEqual({'field': 'input-properties', 'index': [4], 'value': None}, body['changes'][0])
+        self.assertEqual(f'{self.hardware.instance}:{self.hardware.version}', body['version'])
+
+    def test_longpoll_limit(self):
+        version = self.hardware.version
+        result = []
+        thread = threading.Thread(target=lambda: result.append(self.get(f'/atem?since={self.hardware.instance}:{version}&timeout=10')))
+        thread.start()
+        deadline = time.monotonic() + 5
+        while self.frontend.server.active == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+
+        # The second long-poll is refused while the first one is waiting, other requests still work
+        status, body = self.get(f'/atem?since={self.hardware.instance}:{version}&timeout=10')
+        self.assertEqual(503, status)
+        status, body = self.get('/atem/program-bus-input')
+        self.assertEqual(200, status)
+
+        self.hardware.switcher.save_field_data(b'PrgI', struct.pack('>BxH', 0, 3))
+        thread.join(5)
+        status, body = result[0]
+        self.assertEqual(200, status)
+        self.assertEqual(3, body['changes'][0]['value']['source'])
+
+    def test_since(self):
+        status, body = self.get('/atem?fields=program-bus-input')
+        self.assertEqual(200, status)
+        self.hardware.switcher.save_field_data(b'PrgI', struct.pack('>BxH', 0, 3))
+        status, body = self.get(f'/atem?since={body["version"]}&timeout=0')
+        self.assertEqual(200, status)
+        self.assertEqual(['program-bus-input'], [change['field'] for change in body['changes']])
+
+        # A version of an earlier run of the proxy
+        status, body = self.get(f'/atem?since=00000000:{self.hardware.version}&timeout=0')
+        self.assertEqual(410, status)
+        self.assertEqual(f'{self.hardware.instance}:{self.hardware.version}', body['version'])
+
+        for query in ['since=1', f'since={self.hardware.instance}:1&timeout=nan',
+                      f'since={self.hardware.instance}:1&timeout=inf']:
+            status, body = self.get(f'/atem?{query}')
+            self.assertEqual(400, status, query)
+
+    def test_content_length(self):
+        status, body = self.request('POST', '/atem/program-input', headers={'Content-length': 'abc'})
+        self.assertEqual(400, status)
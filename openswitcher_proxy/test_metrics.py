@@ -0,0 +1,65 @@
+import re
+from unittest import TestCase
+
+from pyatem.protocol import AtemProtocol
+from openswitcher_proxy.frontend_metrics import Exposition, collect_frontend, collect_hardware
+from openswitcher_proxy.hardware import HardwareThread
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$')
+
+
+def parse(text):
+    """Parse an OpenMetrics exposition into {family: (type, help, {sample name: [(labels, value)]})}"""
+    lines = text.split('\n')
+    assert lines[-2:] == ['# EOF', ''], 'exposition has to end with # EOF'
+    families = {}
+    current = None
+    for line in lines[:-2]:
+        if line.startswith('# TYPE '):
+            _, _, name, kind = line.split(' ')
+            assert name not in families, f'family {name} is not contiguous'
+            current = families[name] = [kind, None, {}]
+        elif line.startswith('# HELP '):
+            _, _, name, description = line.split(' ', maxsplit=3)
+            families[name][1] = description
+        elif line.startswith('# UNIT '):
+            _, _, name, unit = line.split(' ')
+            assert name.endswith('_' + unit), f'family {name} has to end with its unit'
+        else:
+            name, labels, value = SAMPLE.match(line).groups()
+            current[2].setdefault(name, []).append((labels, float(value)))
+    return families
+
+
+class Test(TestCase):
+    def test_exposition(self):
+        hardware = HardwareThread({'id': 'mini', 'label': 'Mini', 'address': '127.0.0.1'})
+        hardware.switcher = AtemProtocol('127.0.0.1')
+        hardware.switcher.transport.retransmissions.add(2)
+        hardware.switcher.transport.retransmission_requests.add(1)
+        frontend = type('Frontend', (), {'config': {'type': 'tcp'},
+                                         'get_metrics': lambda self: {'clients': 3, 'messages': 10}})()
+
+        exposition = Exposition()
+        collect_hardware(exposition, 'mini', hardware)
+        collect_frontend(exposition, 'tcp.:9990', frontend)
+        families = parse(exposition.render())
+
+        for name, (kind, description, samples) in families.items():
+            self.assertIsNotNone(description, f'{name} has no HELP')
+            for sample in samples:
+                if kind == 'counter':
+                    self.assertEqual(name + '_total', sample)
+                elif kind == 'gauge':
+                    self.assertEqual(name, sample)
+
+        kind, description, samples = families['openswitcher_hardware_received_retransmissions']
+        self.assertEqual('counter', kind)
+        self.assertIn('received', description)
+        self.assertEqual([('{hardware="mini"}', 2)], samples['openswitcher_hardware_received_retransmissions_total'])
+        kind, description, samples = families['openswitcher_hardware_received_retransmission_requests']
+        self.assertIn('received', description)
+        self.assertEqual([('{hardware="mini"}', 1)],
+                         samples['openswitcher_hardware_received_retransmission_requests_total'])
+        self.assertEqual([('{frontend="tcp.:9990",type="tcp"}', 3)],
+                         families['openswitcher_frontend_clients'][2]['openswitcher_frontend_clients'])
@@ -0,0 +1,129 @@
+import hashlib
+import time
+from unittest import TestCase
+
+from pyatem.command import ProgramInputCommand
+from pyatem.emulator import Emulator, default_dump
+from pyatem.media import EncodedFrame, rgb_to_atem, rle_encode
+from pyatem.protocol import AtemProtocol
+from pyatem.transfer import StreamingTransferTask
+from openswitcher_proxy.hardware import LazyField, field_identity
+from openswitcher_proxy.shard import CHANGE, CONNECTED, RemoteHardwareThread, ShardThread, portable_frame
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.emulator = Emulator(meter_rate=0)
+        self.device = self.emulator.add_device(default_dump('Sharded', inputs=4), port=9910, host='127.0.0.5')
+        self.emulator.start()
+        self.addCleanup(self.emulator.stop)
+
+        self.shard = ShardThread(0, [{'id': 'sharded', 'label': 'Sharded', 'address': '127.0.0.5'}])
+        self.shard.daemon = True
+        self.shard.start()
+        self.addCleanup(self.shard.stop)
+        self.hardware = self.shard.hardware['sharded']
+        self.switcher = self.hardware.switcher
+        self.events = []
+        self.switcher.on('upload-done', lambda store, slot: self.events.append(('upload-done', store, slot)))
+        self.switcher.on('clip-upload-done', lambda index: self.events.append(('clip-upload-done', index)))
+        self._wait(lambda: self.switcher.connected, timeout=15)
+
+    def _wait(self, check, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if check():
+                return
+            time.sleep(0.01)
+        self.fail('Timeout waiting for the worker process')
+
+    WIDTH = 64
+    HEIGHT = 16
+
+    def _frame(self, seed):
+        return bytes((seed * 31 + i * 7) % 256 for i in range(self.WIDTH * self.HEIGHT * 4))
+
+    def test_change(self):
+        self.assertEqual('Sharded', self.switcher.mixerstate['product-name'].name)
+        self.assertEqual('connected', self.hardware.status)
+        self.switcher.send_commands([ProgramInputCommand(0, 3)])
+        self._wait(lambda: self.switcher.mixerstate['program-bus-input'][0].source == 3)
+        version, entries = self.hardware.get_snapshot()
+        self.assertIn(('program-bus-input', 0), [identity for identity, packet, field in entries])
+
+    def test_upload(self):
+        frame = self._frame(1)
+        self.switcher.upload(0, 2, memoryview(frame))
+        self._wait(lambda: ('upload-done', 0, 2) in self.events)
+        self.assertEqual(frame, self.device.stored[(0, 2)])
+
+    def test_upload_clip(self):
+        frames = [self._frame(i) for i in range(4)]
+        # A generator can't be pickled, the frames are sent to the worker one by one
+        self.switcher.upload_clip(0, (frame for frame in frames), self.WIDTH, self.HEIGHT, name='Clip')
+        self._wait(lambda: ('clip-upload-done', 0) in self.events)
+        for i, frame in enumerate(frames):
+            self.assertEqual(rgb_to_atem(frame, self.WIDTH, self.HEIGHT), self.device.stored[(1, i)])
+
+    def test_portable_frame(self):
+        data = rgb_to_atem(bytes(64), 4, 4)
+        frame = EncodedFrame(memoryview(rle_encode(data)), len(data), hashlib.md5(data).digest(), 4, 4, name='Still')
+        portable = portable_frame(frame)
+        self.assertIsInstance(portable.data, bytes)
+        self.assertEqual(bytes(frame.data), portable.data)
+        self.assertEqual('Still', portable.name)
+        self.assertEqual(bytes(64), portable_frame(bytearray(64)))
+
+        task = StreamingTransferTask(0, 1, bytes(64), 4, 4)
+        with self.assertRaises(TypeError):
+            self.switcher.upload(0, 1, None, task=task)
+
+
+class TestMirror(TestCase):
+    def setUp(self):
+        self.hardware = RemoteHardwareThread({'id': 'mirror'}, None)
+        self.switcher = self.hardware.switcher
+        self.changes = {}
+        for name, raw in default_dump('Mirror', inputs=4):
+            key, field = AtemProtocol.decode_field(name, raw)
+            if not isinstance(field, bytes):
+                self.changes[field_identity(key, field)] = field.make_packet()
+
+    def _feed(self, changes):
+        for identity, packet in changes.items():
+            self.hardware.handle((CHANGE, 'mirror', identity, packet))
+        self.hardware.handle((CONNECTED, 'mirror'))
+
+    def test_lazy(self):
+        self._feed(self.changes)
+        version, entries = self.hardware.get_snapshot()
+        self.assertEqual(len(self.changes), len(entries))
+        for identity, packet, field in entries:
+            self.assertIsInstance(field, LazyField)
+            self.assertIsNone(field._field)
+        self.assertEqual(len(self.changes), len(self.switcher.pending))
+
+        self.assertEqual('Mirror', self.switcher.mixerstate['product-name'].name)
+        self.assertEqual(len(self.switcher.pending), 0)
+        self.assertIn(0, self.switcher.mixerstate['program-bus-input'])
+        self.assertEqual(set(self.switcher.inputs.values()), set(self.switcher.mixerstate['input-properties']))
+        packet, field = self.hardware.snapshot[('product-name',)]
+        self.assertEqual('Mirror', field.get().name)
+
+    def test_decoded_events(self):
+        changed = []
+        self.switcher.on('change', lambda key, value: changed.append(key))
+        self._feed(self.changes)
+        self.assertIn('product-name', changed)
+        self.assertEqual(len(self.switcher.pending), 0)
+
+    def test_worker_lost(self):
+        self._feed(self.changes)
+        removed = []
+        self.hardware.subscribe(lambda identity, packet, field: removed.append((identity, packet)))
+        self.hardware.worker_lost()
+        changes = dict(self.changes)
+        del changes[('input-properties', 4)]
+        self._feed(changes)
+        self.assertEqual([(('input-properties', 4), None)], removed)
+        self.assertNotIn(4, self.switcher.mixerstate['input-properties'])
@@ -0,0 +1,80 @@
+import struct
+from unittest import TestCase
+
+from pyatem.command import AuxSourceCommand, KeyFillCommand, MultiviewInputCommand, PreviewInputCommand, \
+    ProgramInputCommand
+from pyatem.emulator import default_dump
+from pyatem.protocol import AtemProtocol
+from pyatem.transport import BaseProtocol
+from openswitcher_proxy.hardware import HardwareThread
+from openswitcher_proxy.virtual import VirtualThread
+
+
+class CaptureTransport(BaseProtocol):
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def send_packet(self, packet):
+        self.sent.append(packet.data)
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.hardware = {}
+        for hw in ['root', 'unit']:
+            thread = HardwareThread({'id': hw, 'label': hw})
+            thread.switcher = AtemProtocol(transport=CaptureTransport())
+            thread.register_callbacks()
+            for name, raw in default_dump(hw, inputs=4):
+                thread.switcher.save_field_data(name, raw)
+            self.hardware[hw] = thread
+        self.virtual = VirtualThread({'id': 'merged', 'label': 'Merged', 'hardware': 'root,unit',
+                                      'connections': 'unit->root:4'}, self.hardware)
+
+    def sent(self, hw):
+        result = []
+        for data in self.hardware[hw].switcher.transport.sent:
+            offset = 0
+            while offset < len(data):
+                datalen, = struct.unpack_from('>H', data, offset)
+                result.append(data[offset + 4:offset + datalen])
+                offset += datalen
+        return result
+
+    def test_program(self):
+        self.virtual.switcher.send_commands([ProgramInputCommand(0, 102)])
+        self.assertEqual(self.sent('unit'), [b'CPgI' + struct.pack('>BxH', 0, 2)])
+        self.assertEqual(self.sent('root'), [b'CPgI' + struct.pack('>BxH', 0, 4)])
+
+    def test_preview_aux(self):
+        # The cascaded unit has input 1 on program from the default dump
+        self.virtual.switcher.send_commands([PreviewInputCommand(0, 102), AuxSourceCommand(0, 102)])
+        self.assertEqual(self.sent('unit'), [])
+        self.assertEqual(self.sent('root'), [])
+
+        self.virtual.switcher.send_commands([PreviewInputCommand(0, 101), AuxSourceCommand(0, 101)])
+        self.assertEqual(self.sent('unit'), [])
+        self.assertEqual([packet[:4] for packet in self.sent('root')], [b'CPvI', b'CAuS'])
+        self.assertEqual(self.virtual.program['unit'], 101)
+
+    def test_keyer_multiview(self):
+        self.virtual.switcher.send_commands([KeyFillCommand(0, 0, 102), MultiviewInputCommand(0, 3, 102)])
+        self.assertEqual(self.sent('root'), [])
+
+        self.virtual.switcher.send_commands([KeyFillCommand(0, 0, 101), MultiviewInputCommand(0, 3, 101)])
+        self.assertEqual(self.sent('unit'), [])
+        self.assertEqual(self.sent('root'), [b'CKeF' + struct.pack('>BBH', 0, 0, 4),
+                                             b'CMvI' + struct.pack('>BBH', 0, 3, 4)])
+
+    def test_keyer_fields(self):
+        # Keyer on the root unit with the fill from the cascade input and the key from a local input
+        root = self.hardware['root'].switcher
+        root.save_field_data(b'KeBP', struct.pack('>BBB Bx B HH ?x 4h', 0, 0, 0, 1, 0, 4, 2, False, 0, 0, 0, 0))
+        keyer = self.virtual.switcher.mixerstate['key-properties-base'][0][0]
+        self.assertEqual((101, 2), (keyer.fill_source, keyer.key_source))
+
+        # The keyer follows the program bus of the cascaded unit
+        self.hardware['unit'].switcher.save_field_data(b'PrgI', struct.pack('>BxH', 0, 3))
+        keyer = self.virtual.switcher.mixerstate['key-properties-base'][0][0]
+        self.assertEqual((103, 2), (keyer.fill_source, keyer.key_source))
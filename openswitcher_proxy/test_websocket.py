@@ -0,0 +1,61 @@
+import json
+import struct
+from unittest import TestCase
+
+from pyatem.emulator import default_dump
+from pyatem.protocol import AtemProtocol
+from pyatem.transport import BaseProtocol
+from openswitcher_proxy.eventloop import EventLoopServer
+from openswitcher_proxy.frontend_websocket import WebsocketConnection, WebsocketFrontendThread
+from openswitcher_proxy.hardware import HardwareThread
+
+
+class RacingHardwareThread(HardwareThread):
+    def subscribe(self, callback, sync=None):
+        result = super().subscribe(callback, sync)
+        # A change on the hardware thread right after the subscription became active but before subscribe() returns
+        self.switcher.save_field_data(b'PrgI', struct.pack('>BxH', 0, 3))
+        return result
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.hardware = RacingHardwareThread({'id': 'atem', 'label': 'ATEM'})
+        self.hardware.switcher = AtemProtocol(transport=BaseProtocol())
+        self.hardware.register_callbacks()
+        for name, raw in default_dump(inputs=4):
+            self.hardware.switcher.save_field_data(name, raw)
+
+        config = {'bind': '127.0.0.1:0', 'auth': False, 'hardware': 'atem'}
+        self.frontend = WebsocketFrontendThread(config, {'hardware': {'atem': self.hardware}})
+        server = EventLoopServer(('127.0.0.1', 0), self.frontend.make_connection)
+        self.addCleanup(server.sock.close)
+        self.connection = WebsocketConnection(self.frontend, server, None, ('test', 0))
+        self.connection.state = WebsocketConnection.STATE_WEBSOCKET
+
+    def messages(self):
+        return [json.loads(item) for item in self.connection._take(1024 * 1024)]
+
+    def test_subscribe(self):
+        self.connection.handle_subscribe({'hardware': 'atem', 'fields': ['program-*']})
+        state, change = self.messages()
+        self.assertEqual(state['type'], 'state')
+        self.assertEqual([field['field'] for field in state['fields']], ['program-bus-input'])
+        self.assertEqual(state['fields'][0]['value']['source'], 1)
+        self.assertEqual(change['type'], 'change')
+        self.assertEqual(change['value']['source'], 3)
+
+        # Changes for fields that don't match the patterns and changes after unsubscribing are not sent
+        self.hardware.switcher.save_field_data(b'PrvI', struct.pack('>BxHB3x', 0, 4, 0))
+        self.connection.handle_unsubscribe({'hardware': 'atem'})
+        self.hardware.switcher.save_field_data(b'PrgI', struct.pack('>BxH', 0, 2))
+        self.assertEqual(self.messages(), [])
+
+    def test_upgrade_version(self):
+        self.connection.state = WebsocketConnection.STATE_HTTP
+        request = 'GET / HTTP/1.1\r\nUpgrade: websocket\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+        self.connection.handle_request(request + 'Sec-WebSocket-Version: 8\r\n')
+        response = b''.join(self.connection._take(1024 * 1024)).decode()
+        self.assertTrue(response.startswith('HTTP/1.1 426 '))
+        self.assertIn('\r\nSec-WebSocket-Version: 13\r\n', response)
+        self.assertEqual(WebsocketConnection.STATE_HTTP, self.connection.state)
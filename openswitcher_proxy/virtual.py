@@ -0,0 +1,309 @@
+import struct
+import threading
+import time
+import logging
+
+from pyatem.protocol import AtemProtocol
+from pyatem.transport import BaseProtocol
+from openswitcher_proxy.error import ConfigurationError
+from openswitcher_proxy.hardware import HardwareThread
+
+# Fields that contain source indexes and the offsets of the u16 sources in the data
+SOURCE_FIELDS = {
+    b'PrgI': (2,),
+    b'PrvI': (2,),
+    b'AuxS': (2,),
+    b'KeBP': (6, 8),
+    b'DskB': (2, 4),
+    b'MvIn': (2,),
+}
+# Commands that select a source and the offset of the u16 source in the data
+SOURCE_COMMANDS = {
+    b'CPgI': 2,
+    b'CPvI': 2,
+    b'CAuS': 2,
+    b'CKeF': 2,
+    b'CKeC': 2,
+    b'CDsF': 2,
+    b'CDsC': 2,
+    b'CMvI': 2,
+}
+
+# The external inputs of the cascaded units are numbered from 100 for the first unit, 200 for the second, etc.
+SOURCE_OFFSET = 100
+
+STRUCT_FIELD = struct.Struct('!H2x 4s')
+STRUCT_SOURCE = struct.Struct('>H')
+
+
+def parse_connections(spec, hardware):
+    """
+    Parse the connections setting of a virtual device. Every connection is in the form `member->root:input`
+    which means the program output of `member` is connected to `input` on `root`.
+
+    :return: dict of member id to (root id, input)
+    """
+    result = {}
+    for connection in spec.split(','):
+        connection = connection.strip()
+        if connection == '':
+            continue
+        try:
+            member, target = connection.split('->')
+            root, source = target.split(':')
+            source = int(source)
+        except ValueError:
+            raise ConfigurationError(f'Invalid connection "{connection}", expected member->hardware:input')
+        for hw in [member, root]:
+            if hw not in hardware:
+                raise ConfigurationError(f'Connection "{connection}" uses hardware that is not part of the device')
+        result[member] = (root, source)
+    return result
+
+
+class VirtualTransport(BaseProtocol):
+    """
+    Transport for the AtemProtocol instance of a virtual device, the outgoing commands are routed to the member
+    hardware instead of being sent to a switcher.
+    """
+
+    def __init__(self, device):
+        super().__init__()
+        self.device = device
+
+    def connect(self):
+        pass
+
+    def send_packet(self, packet):
+        self.device.route(packet.data)
+
+    def _send_packet(self, packet):
+        self.device.route(packet.data)
+
+
+class VirtualThread(HardwareThread):
+    """
+    A switcher made from multiple hardware units that are cascaded by connecting the program output of one unit
+    into an input of another unit. The state of the root unit is exposed with the inputs of the other units added
+    and commands that select one of those inputs are sent to the right unit.
+    """
+
+    def __init__(self, config, hardware):
+        super().__init__(config)
+        self.name = 'virtual.' + str(config['id'])
+        self.hardware = hardware
+        self.members = config['hardware'].split(',')
+        for hw in self.members:
+            if hw not in hardware:
+                raise ConfigurationError(f'Unknown hardware "{hw}" in virtual device "{config["id"]}"')
+
+        self.connections = parse_connections(config.get('connections', ''), self.members)
+        roots = [hw for hw in self.members if hw not in self.connections]
+        if len(roots) != 1:
+            raise ConfigurationError(f'Virtual device "{config["id"]}" needs exactly one unit that is not cascaded')
+        self.root = roots[0]
+        for member, (target, source) in self.connections.items():
+            if target != self.root:
+                raise ConfigurationError(f'Unit "{member}" in virtual device "{config["id"]}" has to be connected '
+                                         f'to "{self.root}"')
+        self.offset = {}
+        for i, hw in enumerate(hw for hw in self.members if hw != self.root):
+            self.offset[hw] = (i + 1) * SOURCE_OFFSET
+
+        # (root, input) -> member for the inputs that are fed by another unit
+        self.cascade = {}
+        for member, target in self.connections.items():
+            self.cascade[target] = member
+
+        # merged source -> (member, local source) for the inputs of cascaded units
+        self.sources = {}
+        # member -> merged source on its program bus
+        self.program = {}
+        # Source fields on the root unit that point to a cascade input, identity -> (members, name, raw)
+        self.cascade_fields = {}
+        # member -> identities in cascade_fields for that member
+        self.cascade_users = {hw: set() for hw in self.connections}
+
+        self.merge_lock = threading.RLock()
+        self.switcher = AtemProtocol(transport=VirtualTransport(self))
+        self.switcher.on('change', self.on_change)
+        self.setup_profiling()
+        for hw in self.members:
+            hardware[hw].subscribe(self._member_change(hw), sync=self._member_sync(hw))
+
+    def run(self):
+        logging.info('VirtualThread run')
+        self.status = 'connecting...'
+        connected = False
+        while not self.stop:
+            ok = all(self.hardware[hw].status.startswith('connected') for hw in self.members)
+            if ok != connected:
+                connected = ok
+                with self.merge_lock:
+                    self.switcher.connected = ok
+                    if ok:
+                        self.on_connected()
+                        self.switcher._raise('connected')
+                    else:
+                        self.on_disconnected()
+                        self.switcher._raise('disconnected')
+            time.sleep(0.5)
+
+    def get_status(self):
+        if self.status.startswith('connected'):
+            return f'connected ({", ".join(self.members)})'
+        return self.status
+
+    def on_disconnected(self):
+        self.status = 'lost connection to ' + ', '.join(hw for hw in self.members
+                                                         if not self.hardware[hw].status.startswith('connected'))
+        logging.error('Lost connection with a unit of the virtual device')
+
+    def _member_sync(self, hw):
+        def sync(version, entries):
+            for identity, packet, field in entries:
+                self.merge(hw, identity, packet)
+
+        return sync
+
+    def _member_change(self, hw):
+        def change(identity, packet, field):
+            if packet is None:
+                self.remove(hw, identity)
+            else:
+                self.merge(hw, identity, packet)
+
+        return change
+
+    def feed(self, name, raw):
+        self.switcher.save_field_data(name, raw)
+
+    def translate(self, member, source):
+        if member == self.root:
+            return source
+        if source < 1 or source >= SOURCE_OFFSET:
+            return None
+        return self.offset[member] + source
+
+    def merge(self, hw, identity, packet):
+        """
+        Update the merged state with a change from one of the units. This runs on the hardware thread of that unit.
+        """
+        name = bytes(packet[4:8])
+        raw = packet[8:]
+        with self.merge_lock:
+            if identity[0] == 'input-properties':
+                index, = STRUCT_SOURCE.unpack_from(raw, 0)
+                if hw == self.root:
+                    if (hw, index) in self.cascade:
+                        # This input is fed by another unit, its inputs replace this one
+                        return
+                    self.feed(name, raw)
+                    return
+                merged = self.translate(hw, index)
+                if merged is None:
+                    return
+                self.sources[merged] = (hw, index)
+                self.feed(name, STRUCT_SOURCE.pack(merged) + raw[2:])
+                return
+
+            if hw in self.connections and name == b'PrgI' and raw[0] == 0:
+                # The program bus of the first M/E is the output feeding the root unit
+                source, = STRUCT_SOURCE.unpack_from(raw, 2)
+                self.program[hw] = self.translate(hw, source)
+                for user in list(self.cascade_users[hw]):
+                    self._feed_source(user)
+
+            if hw != self.root:
+                # Only the inputs and program bus of the cascaded units are part of the merged state
+                return
+
+            if name in SOURCE_FIELDS:
+                self._update_source(identity, hw, name, raw)
+            else:
+                self.feed(name, raw)
+
+    def remove(self, hw, identity):
+        """
+        Remove a field that no longer exists on the root unit after a reconnect. The removed inputs of cascaded units
+        stay in the merged state until the virtual device is restarted.
+        """
+        if hw != self.root:
+            return
+        with self.merge_lock:
+            self._drop_cascade_field(identity)
+            self.switcher._remove_field(identity)
+            self.on_resynced([identity])
+
+    def _update_source(self, identity, hw, name, raw):
+        self._drop_cascade_field(identity)
+
+        members = set()
+        for offset in SOURCE_FIELDS[name]:
+            source, = STRUCT_SOURCE.unpack_from(raw, offset)
+            member = self.cascade.get((hw, source))
+            if member is not None:
+                members.add(member)
+        if len(members) == 0:
+            self.feed(name, raw)
+            return
+
+        self.cascade_fields[identity] = (members, name, raw)
+        for member in members:
+            self.cascade_users[member].add(identity)
+        self._feed_source(identity)
+
+    def _drop_cascade_field(self, identity):
+        previous = self.cascade_fields.pop(identity, None)
+        if previous is not None:
+            for member in previous[0]:
+                self.cascade_users[member].discard(identity)
+
+    def _feed_source(self, identity):
+        # A field can use the cascade inputs of multiple units, like a keyer with the fill and key from different units
+        members, name, raw = self.cascade_fields[identity]
+        for offset in SOURCE_FIELDS[name]:
+            source, = STRUCT_SOURCE.unpack_from(raw, offset)
+            member = self.cascade.get((self.root, source))
+            if member is None or self.program.get(member) is None:
+                continue
+            raw = raw[:offset] + STRUCT_SOURCE.pack(self.program[member]) + raw[offset + 2:]
+        self.feed(name, raw)
+
+    def route(self, data):
+        """
+        Send commands to the units. Program commands selecting a source of a cascaded unit select that source on the
+        program bus of the unit and select the cascade input on the root unit, everything else goes to the root unit.
+
+        The other source commands, like preview, aux, keyer, downstream keyer and multiview sources, never change the
+        program bus of a cascaded unit since that would cut whatever the root unit has live from that unit. They only
+        select the cascade input if the unit already outputs the source. Commands that are not in SOURCE_COMMANDS are
+        sent to the root unit unchanged.
+        """
+        packets = {hw: b'' for hw in self.members}
+        offset = 0
+        while offset < len(data):
+            datalen, name = STRUCT_FIELD.unpack_from(data, offset)
+            if datalen < 8:
+                raise ValueError("Malformed command")
+            command = data[offset:offset + datalen]
+            offset += datalen
+
+            if name in SOURCE_COMMANDS:
+                pos = 8 + SOURCE_COMMANDS[name]
+                source, = STRUCT_SOURCE.unpack_from(command, pos)
+                if source in self.sources:
+                    member, local = self.sources[source]
+                    if name == b'CPgI':
+                        packets[member] += STRUCT_FIELD.pack(12, b'CPgI') + struct.pack('>BxH', 0, local)
+                    elif self.program.get(member) != source:
+                        logging.warning(f'Not routing {name.decode()} to source {source}, "{member}" has another '
+                                        f'source on its program output')
+                        continue
+                    source = self.connections[member][1]
+                    command = command[:pos] + STRUCT_SOURCE.pack(source) + command[pos + 2:]
+            packets[self.root] += command
+
+        for hw, packet in packets.items():
+            if len(packet) > 0:
+                self.hardware[hw].switcher.send_raw(packet)
@@ -0,0 +1,387 @@
+# Copyright 2021 - 2022, Martijn Braam and the OpenAtem contributors
+# SPDX-License-Identifier: LGPL-3.0-only
+"""
+Benchmarks for the hot paths in pyatem. Run with `python3 -m pyatem.benchmark`, the results can be written as JSON
+and compared against an earlier run to find regressions.
+"""
+import argparse
+import fnmatch
+import inspect
+import json
+import platform
+import struct
+import sys
+import time
+from functools import partial
+
+import pyatem.command as commandmodule
+import pyatem.field as fieldmodule
+from pyatem.capture import CaptureReader, KIND_UDP
+from pyatem.emulator import default_dump, decode_fields, encode_field
+from pyatem.macro import decode_macro, encode_macro, encode_macroscript, decode_macroscript
+from pyatem.media import rle_encode, rle_decode, atem_to_rgb, rgb_to_atem
+from pyatem.protocol import AtemProtocol
+from pyatem.transport import BaseProtocol, Packet
+
+# Fields that start transfers or change the connection state when decoded, these can't run in a loop
+SKIP_FIELDS = ['InCm', 'LKOB', 'LKST', 'FTCD', 'FTDa', 'FTDE', 'FTDC', '*XFC']
+
+# Arguments for commands that can't be created with zeroes for all the required arguments
+COMMAND_ARGUMENTS = {
+    'KeyerKeyframeRunCommand': ((0, 0), {'run_to': 'A'}),
+    'MediaplayerClipSetCommand': ((0, 'Clip', 10), {}),
+    'MediaplayerSelectCommand': ((0,), {'still': 1}),
+    'TransferDataCommand': ((1, bytes(1300)), {}),
+    'TransferFileDataCommand': ((1, bytes(16)), {'name': 'Still', 'description': 'Benchmark'}),
+    'CaptureStillCommand': ((), {}),
+    'TimeRequestCommand': ((), {}),
+}
+
+# Packets are filled up to this size with copies of the field to decode
+PACKET_SIZE = 1400
+
+
+class NullTransport(BaseProtocol):
+    def connect(self):
+        pass
+
+    def send_packet(self, packet):
+        pass
+
+    def _send_packet(self, packet):
+        pass
+
+
+class Benchmark:
+    def __init__(self, name, unit, setup):
+        """
+        :param name: Unique name of the benchmark
+        :param unit: Unit of the items processed by a single run
+        :param setup: Function returning (run, items), run is called repeatedly and processes items per call
+        """
+        self.name = name
+        self.unit = unit
+        self.setup = setup
+
+    def measure(self, min_time):
+        run, items = self.setup()
+
+        # Calibrate the number of calls so a round takes at least 10% of the time budget
+        loops = 1
+        while True:
+            start = time.perf_counter()
+            for i in range(loops):
+                run()
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time / 10:
+                break
+            loops *= 2
+
+        best = elapsed
+        total = elapsed
+        rounds = 1
+        while total < min_time:
+            start = time.perf_counter()
+            for i in range(loops):
+                run()
+            elapsed = time.perf_counter() - start
+            best = min(best, elapsed)
+            total += elapsed
+            rounds += 1
+
+        return {
+            'unit': self.unit,
+            'rate': items * loops / best,
+            'time': best / loops,
+            'rounds': rounds,
+        }
+
+
+def field_samples(capture=None):
+    """
+    Get an example raw field for every field type. Fields from the capture are used first, then the emulator
+    default state and for the rest of the fields the smallest zero filled buffer the decoder accepts.
+    """
+    samples = {}
+    if capture is not None:
+        reader = CaptureReader(capture)
+        for timestamp, data in reader:
+            if reader.kind == KIND_UDP:
+                data = Packet.from_bytes(data).data
+            for name, raw in decode_fields(data):
+                samples.setdefault(name.decode(errors='replace'), raw)
+        reader.close()
+
+    for name, raw in default_dump():
+        samples.setdefault(name.decode(), raw)
+
+    for name, key in AtemProtocol.FIELDNAME_PRETTY.items():
+        if name in samples:
+            continue
+        classname = key.title().replace('-', '') + "Field"
+        decoder = getattr(fieldmodule, classname, None)
+        if decoder is None:
+            samples[name] = bytes(16)
+            continue
+        for size in range(0, 512):
+            try:
+                decoder(bytes(size))
+            except Exception:
+                continue
+            samples[name] = bytes(size)
+            break
+
+    for name in SKIP_FIELDS:
+        samples.pop(name, None)
+    return samples
+
+
+def field_benchmarks(capture=None):
+    result = []
+    for name, raw in sorted(field_samples(capture).items()):
+        def setup(name=name, raw=raw):
+            encoded = encode_field(name.encode(), raw)
+            count = max(1, PACKET_SIZE // len(encoded))
+            data = encoded * count
+            switcher = AtemProtocol(transport=NullTransport())
+
+            def run():
+                for fieldname, contents in switcher.decode_packet(data):
+                    switcher.save_field_data(fieldname, contents)
+
+            return run, count
+
+        result.append(Benchmark('decode.' + name, 'fields/s', setup))
+    return result
+
+
+def command_benchmarks():
+    result = []
+    for name, cls in inspect.getmembers(commandmodule, inspect.isclass):
+        if not issubclass(cls, commandmodule.Command) or cls is commandmodule.Command:
+            continue
+        if name in COMMAND_ARGUMENTS:
+            args, kwargs = COMMAND_ARGUMENTS[name]
+        else:
+            parameters = list(inspect.signature(cls.__init__).parameters.values())[1:]
+            args = [0 for p in parameters if p.default is inspect.Parameter.empty]
+            kwargs = {}
+
+        def setup(cls=cls, args=args, kwargs=kwargs):
+            command = cls(*args, **kwargs)
+            return command.get_command, 1
+
+        result.append(Benchmark('encode.' + name, 'commands/s', setup))
+    return result
+
+
+def resolutions():
+    result = {}
+    for mode in range(0, 28):
+        field = fieldmodule.VideoModeField(bytes([mode, 0, 0, 0]))
+        width, height = field.get_resolution()
+        result[height] = (width, height)
+    return [result[key] for key in sorted(result)]
+
+
+def test_frame(width, height):
+    """Generate an RGBA frame with a flat area and a gradient so the compression has something to do"""
+    flat = b'\x20\x40\x80\xff' * (width // 2)
+    gradient = bytes(i % 256 for i in range((width - width // 2) * 4))
+    return (flat + gradient) * height
+
+
+def media_benchmarks():
+    result = []
+    for width, height in resolutions():
+        def setup_rgb_to_atem(width=width, height=height):
+            frame = test_frame(width, height)
+            return lambda: rgb_to_atem(frame, width, height), 1
+
+        def setup_atem_to_rgb(width=width, height=height):
+            frame = rgb_to_atem(test_frame(width, height), width, height)
+            return lambda: atem_to_rgb(frame, width, height), 1
+
+        def setup_rle_encode(width=width, height=height):
+            frame = rgb_to_atem(test_frame(width, height), width, height)
+            return lambda: rle_encode(frame), 1
+
+        def setup_rle_decode(width=width, height=height):
+            frame = rle_encode(rgb_to_atem(test_frame(width, height), width, height))
+            return lambda: rle_decode(frame), 1
+
+        result.append(Benchmark(f'rgb_to_atem.{height}', 'frames/s', setup_rgb_to_atem))
+        result.append(Benchmark(f'atem_to_rgb.{height}', 'frames/s', setup_atem_to_rgb))
+        result.append(Benchmark(f'rle_encode.{height}', 'frames/s', setup_rle_encode))
+        result.append(Benchmark(f'rle_decode.{height}', 'frames/s', setup_rle_decode))
+    return result
+
+
+def test_macro(length=100):
+    """Generate a raw macro with sleeps, preview changes and unknown actions"""
+    raw = b''
+    for i in range(length):
+        raw += b''.join([
+            struct.pack('<HH B x H', 8, 0x0003, 0, i % 8 + 1),
+            struct.pack('<HH H 2x', 8, 0x0007, 25),
+            struct.pack('<HH 8x', 12, 0x00ff),
+        ])
+    return raw, length * 3
+
+
+def macro_benchmarks():
+    def setup_decode():
+        raw, count = test_macro()
+        return lambda: decode_macro(raw), count
+
+    def setup_encode():
+        raw, count = test_macro()
+        actions = decode_macro(raw)
+        return lambda: encode_macro(actions), count
+
+    def script_actions():
+        # Actions without decoded fields can't be represented in a macro script
+        raw, count = test_macro()
+        actions = [action for action in decode_macro(raw) if len(action.fields)]
+        return actions, len(actions)
+
+    def setup_encode_script():
+        actions, count = script_actions()
+        return lambda: encode_macroscript(actions), count
+
+    def setup_decode_script():
+        actions, count = script_actions()
+        script = encode_macroscript(actions)
+        return lambda: decode_macroscript(script), count
+
+    return [
+        Benchmark('macro.decode', 'actions/s', setup_decode),
+        Benchmark('macro.encode', 'actions/s', setup_encode),
+        Benchmark('macroscript.encode', 'actions/s', setup_encode_script),
+        Benchmark('macroscript.decode', 'actions/s', setup_decode_script),
+    ]
+
+
+def shard_benchmarks():
+    """
+    Time the work of the proxy process for the changes forwarded by worker processes. Every run handles a full state
+    dump from each of the devices, the rate is the number of changes the proxy process can take in on a single core.
+    The decoded variant has a callback for the change events registered like the MQTT frontend does.
+
+    These only exist when the openswitcher_proxy package can be imported.
+    """
+    try:
+        from openswitcher_proxy.hardware import field_identity
+        from openswitcher_proxy.shard import RemoteHardwareThread, CHANGE
+    except ImportError:
+        return []
+
+    changes = []
+    for name, raw in default_dump():
+        key, field = AtemProtocol.decode_field(name, raw)
+        if not isinstance(field, bytes):
+            changes.append((field_identity(key, field), field.make_packet()))
+
+    result = []
+    for count in [1, 4, 16]:
+        def setup(count=count, decode=False):
+            devices = []
+            for i in range(count):
+                device = RemoteHardwareThread({'id': f'bench{i}'}, None)
+                if decode:
+                    device.switcher.on('change', lambda key, value: None)
+                devices.append((device, [(CHANGE, f'bench{i}', identity, packet) for identity, packet in changes]))
+
+            def run():
+                for device, messages in devices:
+                    for message in messages:
+                        device.handle(message)
+
+            return run, count * len(changes)
+
+        result.append(Benchmark(f'shard.changes.{count}', 'changes/s', setup))
+        result.append(Benchmark(f'shard.changes-decoded.{count}', 'changes/s', partial(setup, decode=True)))
+    return result
+
+
+def all_benchmarks(capture=None):
+    return field_benchmarks(capture) + command_benchmarks() + media_benchmarks() + macro_benchmarks() \
+        + shard_benchmarks()
+
+
+def run(benchmarks, min_time=0.2, progress=None):
+    results = {}
+    for benchmark in benchmarks:
+        results[benchmark.name] = benchmark.measure(min_time)
+        if progress is not None:
+            progress(benchmark.name, results[benchmark.name])
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'timestamp': time.time(),
+        'results': results,
+    }
+
+
+def compare(old, new, threshold):
+    """
+    Compare two benchmark runs
+
+    :return: list of (name, old rate, new rate) for the benchmarks that got slower than the threshold allows
+    """
+    regressions = []
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before = old['results'][name]['rate']
+        if result['rate'] < before * (1 - threshold):
+            regressions.append((name, before, result['rate']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pyatem encoders and decoders")
+    parser.add_argument('filter', nargs='*', help='Only run benchmarks matching these patterns, like "decode.*"')
+    parser.add_argument('--time', type=float, default=0.2, help='Minimum time to run every benchmark in seconds')
+    parser.add_argument('--capture', help='Capture file to take the example fields from')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--compare', help='Compare against the JSON results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Fraction a benchmark may get slower before it counts as a regression')
+    parser.add_argument('--list', action='store_true', help='List the benchmarks without running them')
+    args = parser.parse_args()
+
+    benchmarks = all_benchmarks(args.capture)
+    if args.filter:
+        benchmarks = [b for b in benchmarks if any(fnmatch.fnmatch(b.name, p) for p in args.filter)]
+
+    if args.list:
+        for benchmark in benchmarks:
+            print(benchmark.name)
+        return
+
+    def progress(name, result):
+        print(f'{name:40} {result["rate"]:14.1f} {result["unit"]}', file=sys.stderr)
+
+    results = run(benchmarks, args.time, progress)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(results, handle, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as handle:
+            old = json.load(handle)
+        regressions = compare(old, results, args.threshold)
+        for name, before, after in regressions:
+            print(f'regression in {name}: {before:.1f} -> {after:.1f} ({after / before * 100 - 100:.1f}%)',
+                  file=sys.stderr)
+        if len(regressions):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
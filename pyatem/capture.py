@@ -0,0 +1,181 @@
+# Copyright 2021 - 2022, Martijn Braam and the OpenAtem contributors
+# SPDX-License-Identifier: LGPL-3.0-only
+import collections
+import gzip
+import struct
+import threading
+import time
+
+from pyatem.transport import BaseProtocol, ConnectionReady, Packet, UdpProtocol
+
+MAGIC = b'ATEMCAP'
+VERSION = 1
+
+# Transport the capture was made on. UDP captures contain the complete datagrams including the 12 byte header, the
+# other transports only have the field data.
+KIND_UDP = ord('u')
+KIND_TCP = ord('t')
+
+STRUCT_HEADER = struct.Struct('>7sBBxxxd')
+STRUCT_RECORD = struct.Struct('>IH')
+
+
+def start_recording(transport, path):
+    """
+    Record all packets received by a UdpProtocol or TcpProtocol transport to a capture file
+
+    :return: The CaptureWriter, the recording is stopped by calling stop_recording(transport)
+    """
+    kind = KIND_UDP if isinstance(transport, UdpProtocol) else KIND_TCP
+    stop_recording(transport)
+    transport.recorder = CaptureWriter(path, kind)
+    return transport.recorder
+
+
+def stop_recording(transport):
+    recorder = transport.recorder
+    transport.recorder = None
+    if recorder is not None:
+        recorder.close()
+
+
+def _open(path, mode):
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+class CaptureWriter:
+    """
+    Writes the raw packets received by a transport to a capture file. Every record is the time since the
+    previous packet in microseconds and the packet length followed by the packet. Paths ending in .gz are compressed.
+    """
+
+    def __init__(self, path, kind):
+        self.kind = kind
+        self.handle = _open(path, 'wb')
+        self.start = time.time()
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+        self.count = 0
+        self.handle.write(STRUCT_HEADER.pack(MAGIC, VERSION, kind, self.start))
+
+    def write(self, data):
+        now = time.monotonic()
+        with self.lock:
+            if self.handle is None:
+                return
+            delta = min(int((now - self.last) * 1000000), 0xffffffff)
+            self.last = now
+            self.handle.write(STRUCT_RECORD.pack(delta, len(data)))
+            self.handle.write(data)
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
+
+
+class CaptureReader:
+    """
+    Reads a capture file, iterating over it gives (timestamp, data) tuples with the timestamp in seconds since the
+    start of the recording.
+    """
+
+    def __init__(self, path):
+        self.handle = _open(path, 'rb')
+        header = self.handle.read(STRUCT_HEADER.size)
+        if len(header) != STRUCT_HEADER.size:
+            raise ValueError("Not an ATEM capture file")
+        magic, version, self.kind, self.start = STRUCT_HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("Not an ATEM capture file")
+        if version != VERSION:
+            raise ValueError("Unsupported capture version {}".format(version))
+
+    def __iter__(self):
+        timestamp = 0
+        while True:
+            header = self.handle.read(STRUCT_RECORD.size)
+            if len(header) < STRUCT_RECORD.size:
+                break
+            delta, length = STRUCT_RECORD.unpack(header)
+            data = self.handle.read(length)
+            if len(data) < length:
+                break
+            timestamp += delta / 1000000
+            yield timestamp, data
+
+    def close(self):
+        self.handle.close()
+
+
+class ReplayTransport(BaseProtocol):
+    """
+    Transport that feeds a capture file into AtemProtocol.loop(). By default the packets are returned as fast as
+    possible, with realtime set the original timing is kept. Commands sent by the client are dropped. The `finished`
+    attribute is set after the last packet has been returned, calling loop() after that is handled as a disconnect.
+    """
+
+    def __init__(self, path, realtime=False):
+        super().__init__()
+        self.reader = CaptureReader(path)
+        self.records = iter(self.reader)
+        self.realtime = realtime
+        self.started = None
+        self.packets = 0
+        self.bytes = 0
+        self.received = collections.deque(maxlen=1024)
+        self.pending = self._next()
+
+    @property
+    def finished(self):
+        return self.pending is None and not self.mark_next_connected
+
+    def connect(self):
+        pass
+
+    def send_packet(self, packet):
+        pass
+
+    def _send_packet(self, packet):
+        pass
+
+    def _next(self):
+        for timestamp, data in self.records:
+            if self.reader.kind == KIND_UDP:
+                packet = Packet.from_bytes(data)
+                if packet.flags & UdpProtocol.FLAG_SYN or len(packet.data) == 0:
+                    # Handshake and control packets are handled by the UDP layer
+                    continue
+                if packet.flags & UdpProtocol.FLAG_RETRANSMISSION and packet.sequence_number in self.received:
+                    # Duplicates are dropped by the UDP layer
+                    continue
+                self.received.append(packet.sequence_number)
+            else:
+                packet = Packet()
+                packet.data = data
+            return timestamp, packet
+        return None
+
+    def receive_packet(self):
+        if self.mark_next_connected:
+            self.mark_next_connected = False
+            return ConnectionReady()
+        if self.pending is None:
+            return None
+        timestamp, packet = self.pending
+        if self.realtime:
+            if self.started is None:
+                self.started = time.monotonic() - timestamp
+            delay = self.started + timestamp - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        self.packets += 1
+        self.bytes += len(packet.data)
+        self.pending = self._next()
+        if self.pending is None:
+            self.reader.close()
+        return packet
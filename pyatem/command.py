@@ -427,6 +427,63 @@ class MediaplayerSelectCommand(Command):
         return self._make_command('MPSS', data)
 
 
+class MediaplayerClipClearCommand(Command):
+    """
+    Implementation of the `CMPC` command. This clears a clip from the media pool, it is sent before uploading the
+    frames of a new clip.
+
+    ====== ==== ====== ===========
+    Offset Size Type   Description
+    ====== ==== ====== ===========
+    0      1    u8     Clip index
+    1      3    ?      padding
+    ====== ==== ====== ===========
+
+    """
+
+    def __init__(self, index):
+        """
+        :param index: 0-indexed clip number
+        """
+        self.index = index
+
+    def get_command(self):
+        data = struct.pack('>Bxxx', self.index)
+        return self._make_command('CMPC', data)
+
+
+class MediaplayerClipSetCommand(Command):
+    """
+    Implementation of the `SMPC` command. This sets the name and length of a clip in the media pool after the
+    frames have been uploaded.
+
+    ====== ==== ====== ===========
+    Offset Size Type   Description
+    ====== ==== ====== ===========
+    0      1    u8     Mask
+    1      1    u8     Clip index
+    2      64   str    Name
+    66     2    u16    Number of frames
+    ====== ==== ====== ===========
+
+    """
+
+    def __init__(self, index, name, frames):
+        """
+        :param index: 0-indexed clip number
+        :param name: Name of the clip
+        :param frames: Number of frames in the clip
+        """
+        self.index = index
+        self.name = name
+        self.frames = frames
+
+    def get_command(self):
+        name = self.name.encode() if self.name is not None else b''
+        data = struct.pack('>BB 64s H', 0x03, self.index, name, self.frames)
+        return self._make_command('SMPC', data)
+
+
 class DkeyOnairCommand(Command):
     """
     Implementation of the `CDsL` command. This setting the "on-air" state of the downstream keyer on or off
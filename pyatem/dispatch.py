@@ -0,0 +1,142 @@
+# Copyright 2021 - 2022, Martijn Braam and the OpenAtem contributors
+# SPDX-License-Identifier: LGPL-3.0-only
+import collections
+import logging
+import threading
+
+from pyatem.metrics import Counter, callback_name
+
+# Overflow policies for a full queue
+DROP_OLDEST = 'drop-oldest'
+COALESCE = 'coalesce'
+BLOCK = 'block'
+POLICIES = (DROP_OLDEST, COALESCE, BLOCK)
+
+
+class QueuedCallback:
+    """
+    Wraps a callback so calling it only queues the arguments, the callback runs on a worker thread. This keeps a slow
+    consumer from stalling the thread that raises the events, which for AtemProtocol is the thread that acknowledges
+    the packets from the switcher.
+
+    The queue holds at most `size` calls. When it's full the policy decides what happens:
+
+    * `drop-oldest` drops the oldest queued call
+    * `coalesce` replaces the queued call with the same key, key(*args) gives the key. Without a key function only the
+      latest call is kept. A new key on a full queue drops the oldest key.
+    * `block` makes the caller wait until the worker has made room
+    """
+
+    def __init__(self, callback, size=1024, policy=DROP_OLDEST, key=None, name=None):
+        if policy not in POLICIES:
+            raise ValueError(f'unknown queue policy {policy}, use one of {", ".join(POLICIES)}')
+        self.callback = callback
+        self.__wrapped__ = callback
+        self.size = size
+        self.policy = policy
+        self.key = key
+        self.name = name or callback_name(callback)
+        self.log = logging.getLogger('QueuedCallback')
+
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.queue = collections.deque()
+        self.coalesced = collections.OrderedDict()
+        self.stopped = False
+        self.busy = False
+
+        self.calls = Counter()
+        self.processed = Counter()
+        self.dropped = Counter()
+        self.replaced = Counter()
+        self.max_depth = 0
+
+        self.thread = threading.Thread(target=self._run, name='dispatch.' + self.name, daemon=True)
+        self.thread.start()
+
+    def __call__(self, *args, **kwargs):
+        with self.lock:
+            if self.stopped:
+                return
+            self.calls.add()
+            if self.policy == COALESCE:
+                key = None if self.key is None else self.key(*args, **kwargs)
+                if key in self.coalesced:
+                    self.replaced.add()
+                elif len(self.coalesced) >= self.size:
+                    self.coalesced.popitem(last=False)
+                    self.dropped.add()
+                self.coalesced[key] = (args, kwargs)
+                depth = len(self.coalesced)
+            else:
+                if len(self.queue) >= self.size:
+                    if self.policy == BLOCK:
+                        while len(self.queue) >= self.size and not self.stopped:
+                            self.changed.wait()
+                        if self.stopped:
+                            return
+                    else:
+                        self.queue.popleft()
+                        self.dropped.add()
+                self.queue.append((args, kwargs))
+                depth = len(self.queue)
+            if depth > self.max_depth:
+                self.max_depth = depth
+            self.changed.notify_all()
+
+    def _take(self):
+        with self.lock:
+            while len(self.queue) == 0 and len(self.coalesced) == 0 and not self.stopped:
+                self.changed.wait()
+            if self.stopped:
+                return None
+            if self.policy == COALESCE:
+                key, item = self.coalesced.popitem(last=False)
+            else:
+                item = self.queue.popleft()
+            self.busy = True
+            self.changed.notify_all()
+            return item
+
+    def _run(self):
+        while True:
+            item = self._take()
+            if item is None:
+                return
+            args, kwargs = item
+            try:
+                self.callback(*args, **kwargs)
+            except Exception:
+                self.log.exception(f'Exception in queued callback {self.name}')
+            self.processed.add()
+            with self.lock:
+                self.busy = False
+                self.changed.notify_all()
+
+    def depth(self):
+        return len(self.queue) + len(self.coalesced)
+
+    def join(self, timeout=None):
+        """Wait until all queued calls have been handled, returns False on a timeout"""
+        with self.lock:
+            return self.changed.wait_for(lambda: self.depth() == 0 and not self.busy, timeout)
+
+    def stop(self):
+        """Stop the worker, calls that are still queued are discarded"""
+        with self.lock:
+            self.stopped = True
+            self.queue.clear()
+            self.coalesced.clear()
+            self.changed.notify_all()
+
+    def get_metrics(self):
+        return {
+            'policy': self.policy,
+            'size': self.size,
+            'depth': self.depth(),
+            'max_depth': self.max_depth,
+            'calls': self.calls.total,
+            'processed': self.processed.total,
+            'dropped': self.dropped.total,
+            'coalesced': self.replaced.total,
+        }
@@ -0,0 +1,587 @@
+# Copyright 2021 - 2022, Martijn Braam and the OpenAtem contributors
+# SPDX-License-Identifier: LGPL-3.0-only
+import collections
+import hashlib
+import logging
+import math
+import selectors
+import socket
+import struct
+import threading
+import time
+
+from pyatem.field import VideoModeField
+from pyatem.media import rle_decode, rle_encode
+from pyatem.transport import Packet, UdpProtocol
+
+STRUCT_FIELD = struct.Struct('!H2x 4s')
+
+# Largest payload of a single datagram, the packet length in the header is only 11 bits
+MAX_PAYLOAD = 1400
+
+# Fields that are sent once per index, the value is the size of the index at the start of the field
+INDEXED_FIELDS = {
+    b'InPr': 2,
+    b'PrgI': 1,
+    b'PrvI': 1,
+    b'AuxS': 1,
+    b'AMIP': 2,
+    b'FASP': 16,
+}
+
+
+def read_dump(path):
+    """
+    Read a state dump file. A dump is the fields of the initial state exactly like they are sent on the wire,
+    concatenated together.
+
+    :return: list of (name, raw) tuples
+    """
+    with open(path, 'rb') as handle:
+        data = handle.read()
+    return list(decode_fields(data))
+
+
+def decode_fields(data):
+    offset = 0
+    while offset < len(data):
+        length, name = STRUCT_FIELD.unpack_from(data, offset)
+        if length < 8:
+            raise ValueError("Corrupt field at offset {}".format(offset))
+        yield name, bytes(data[offset + 8:offset + length])
+        offset += length
+
+
+def encode_field(name, raw):
+    return STRUCT_FIELD.pack(len(raw) + 8, name) + raw
+
+
+def capture_dump(ip, path, port=9910):
+    """
+    Connect to a switcher and write the initial state dump it sends to a file so it can be replayed by the emulator
+    """
+    from pyatem.protocol import AtemProtocol
+    from pyatem.transport import ConnectionReady
+
+    switcher = AtemProtocol(ip, port)
+    switcher.connect()
+    count = 0
+    with open(path, 'wb') as handle:
+        while True:
+            packet = switcher.transport.receive_packet()
+            if isinstance(packet, ConnectionReady):
+                break
+            if not isinstance(packet, Packet):
+                continue
+            for name, raw in switcher.decode_packet(packet.data):
+                handle.write(encode_field(name, bytes(raw)))
+                count += 1
+                switcher.save_field_data(name, raw)
+    return count
+
+
+def default_dump(name='ATEM Emulator', inputs=8, mes=1, auxes=1):
+    """
+    Generate the state for a simple switcher with a number of inputs, M/E units and aux outputs
+    """
+    fields = [
+        (b'_ver', struct.pack('>HH', 2, 30)),
+        (b'_pin', name.encode().ljust(44, b'\0')[:44]),
+        (b'_top', struct.pack('>BBBBBBBBBB', mes, inputs + 2, 1, auxes, 0, 2, 1, 0, 0, 0).ljust(28, b'\0')),
+        (b'VidM', struct.pack('>B3x', 10)),
+    ]
+    sources = [(0, 'Black', 'BLK', 1)] + [(i, f'Camera {i}', f'CAM{i}', 0) for i in range(1, inputs + 1)]
+    sources.append((1000, 'Color Bars', 'BARS', 2))
+    for index, long_name, short_name, port_type in sources:
+        fields.append((b'InPr', struct.pack('>H20s4s BBBBBBBBBB', index, long_name.encode(), short_name.encode(),
+                                            0, 0, 0, 0, 0, 0, port_type, 0, 0, 0)))
+    for index in range(inputs + 1):
+        fields.append((b'AMIP', struct.pack('>HB2xBxBBxHh2x', index, 0, index, 1, 1, 32768, 0)))
+    for me in range(mes):
+        fields.append((b'PrgI', struct.pack('>BxH', me, 1)))
+        fields.append((b'PrvI', struct.pack('>BxHB3x', me, 2, 0)))
+    for aux in range(auxes):
+        fields.append((b'AuxS', struct.pack('>BxH', aux, 1000)))
+    fields.append((b'InCm', b'\x01\0\0\0'))
+    return fields
+
+
+class Session:
+    """
+    State of a single client connected to an emulated switcher
+    """
+
+    def __init__(self, address, session_id, now):
+        self.address = address
+        self.session_id = session_id
+        self.established = False
+        self.local_sequence = 0
+        self.unacked = collections.OrderedDict()
+        self.received = collections.deque(maxlen=64)
+        self.last_receive = now
+        self.last_send = now
+        self.audio_levels = False
+        self.fairlight_levels = False
+
+    def next_sequence(self):
+        self.local_sequence = (self.local_sequence + 1) % 2 ** 16
+        return self.local_sequence
+
+    def ack(self, number):
+        for sequence in list(self.unacked.keys()):
+            if (number - sequence) % 2 ** 16 < 2 ** 15:
+                del self.unacked[sequence]
+            else:
+                break
+
+
+class Upload:
+    def __init__(self, session, store, slot, length):
+        self.session = session
+        self.store = store
+        self.slot = slot
+        self.length = length
+        self.data = bytearray()
+        self.chunks = 0
+
+
+class Download:
+    def __init__(self, session, data):
+        self.session = session
+        self.data = data
+        self.offset = 0
+        self.outstanding = 0
+
+
+class EmulatedSwitcher:
+    """
+    A single emulated switcher listening on its own UDP port. Every client gets its own session with the initial
+    state dump, keepalive packets and meter levels. Commands that change the busses are applied to the state and
+    sent to all clients, the media transfer protocol is implemented for uploads and downloads.
+    """
+
+    SESSION_TIMEOUT = 5.0
+    PING_INTERVAL = 0.5
+    RETRANSMIT_TIMEOUT = 0.2
+    CHUNK_SIZE = 1300
+    CHUNK_COUNT = 20
+    DOWNLOAD_WINDOW = 8
+
+    def __init__(self, emulator, sock, fields, name=None):
+        self.emulator = emulator
+        self.sock = sock
+        self.port = sock.getsockname()[1]
+        self.name = name or 'emulator:{}'.format(self.port)
+        self.log = logging.getLogger('AtemEmulator')
+
+        self.state = collections.OrderedDict()
+        self.init_complete = b'\x01\0\0\0'
+        for i, (field, raw) in enumerate(fields):
+            if field == b'InCm':
+                self.init_complete = raw
+                continue
+            self.state[self._key(field, raw, i)] = (field, raw)
+
+        self.sessions = {}
+        self.next_session = 0
+        self.locks = {}
+        self.uploads = {}
+        self.downloads = {}
+        self.stored = {}
+        self.commands = collections.Counter()
+
+    def _key(self, field, raw, position):
+        if field in INDEXED_FIELDS:
+            return field, raw[:INDEXED_FIELDS[field]]
+        return field, position
+
+    def get_field(self, field, index=b''):
+        key = (field, index)
+        if key in self.state:
+            return self.state[key][1]
+        if index != b'':
+            return None
+        for name, raw in self.state.values():
+            if name == field:
+                return raw
+        return None
+
+    def set_field(self, field, raw):
+        """Update a field in the state and send it to all clients"""
+        self.state[self._key(field, raw, len(self.state))] = (field, raw)
+        self.broadcast([(field, raw)])
+
+    def broadcast(self, fields):
+        for session in list(self.sessions.values()):
+            if session.established:
+                self.send_fields(session, fields)
+
+    # Low level packet handling
+
+    def _send(self, session, packet, now=None):
+        packet.session = session.session_id
+        try:
+            self.sock.sendto(packet.to_bytes(), session.address)
+        except OSError as e:
+            self.log.debug('{}: send to {} failed: {}'.format(self.name, session.address, e))
+        session.last_send = now or time.monotonic()
+
+    def send_data(self, session, data, now=None):
+        now = now or time.monotonic()
+        packet = Packet()
+        packet.flags = UdpProtocol.FLAG_RELIABLE
+        packet.sequence_number = session.next_sequence()
+        packet.data = data
+        session.unacked[packet.sequence_number] = [packet, now]
+        self._send(session, packet, now)
+
+    def send_fields(self, session, fields, now=None):
+        data = b''
+        for field, raw in fields:
+            encoded = encode_field(field, raw)
+            if len(data) + len(encoded) > MAX_PAYLOAD and len(data) > 0:
+                self.send_data(session, data, now)
+                data = b''
+            data += encoded
+        if len(data) > 0:
+            self.send_data(session, data, now)
+
+    def handle_datagram(self, data, address, now):
+        try:
+            packet = Packet.from_bytes(data)
+        except (ValueError, struct.error) as e:
+            self.log.warning('{}: invalid packet from {}: {}'.format(self.name, address, e))
+            return
+
+        if packet.flags & UdpProtocol.FLAG_SYN:
+            self._handle_syn(packet, address, now)
+            return
+
+        session = self.sessions.get(address)
+        if session is None:
+            return
+        session.last_receive = now
+
+        if packet.flags & UdpProtocol.FLAG_ACK:
+            if not session.established:
+                # Third packet of the handshake, switch to the real session id and send the state
+                session.established = True
+                self.send_fields(session, list(self.state.values()) + [(b'InCm', self.init_complete)], now)
+                self.send_data(session, b'', now)
+                return
+            session.ack(packet.acknowledgement_number)
+
+        if packet.flags & UdpProtocol.FLAG_REQUEST_RETRANSMISSION:
+            entry = session.unacked.get(packet.remote_sequence_number)
+            if entry is not None:
+                self._retransmit(session, entry, now)
+
+        if packet.flags & UdpProtocol.FLAG_RELIABLE:
+            ack = Packet()
+            ack.flags = UdpProtocol.FLAG_ACK
+            ack.acknowledgement_number = packet.sequence_number
+            self._send(session, ack, now)
+            if packet.sequence_number in session.received:
+                return
+            session.received.append(packet.sequence_number)
+            if len(packet.data) > 0:
+                try:
+                    for field, raw in decode_fields(packet.data):
+                        self.handle_command(session, field, raw)
+                except (ValueError, struct.error, KeyError) as e:
+                    self.log.warning('{}: invalid command from {}: {}'.format(self.name, address, e))
+
+    def _handle_syn(self, packet, address, now):
+        # Start a new session, replacing the previous one if the client reconnects from the same address
+        self.drop_session(address)
+        self.next_session = (self.next_session + 1) % 0x8000
+        session = Session(address, 0x8000 | self.next_session, now)
+        self.sessions[address] = session
+
+        response = Packet()
+        response.flags = UdpProtocol.FLAG_SYN
+        response.data = [0x02, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00, 0x00]
+        response.session = packet.session
+        try:
+            self.sock.sendto(response.to_bytes(), address)
+        except OSError:
+            pass
+        self.log.debug('{}: new session {:04x} for {}'.format(self.name, session.session_id, address))
+
+    def drop_session(self, address):
+        session = self.sessions.pop(address, None)
+        if session is None:
+            return
+        for store, owner in list(self.locks.items()):
+            if owner is session:
+                del self.locks[store]
+        for transfers in [self.uploads, self.downloads]:
+            for tid, transfer in list(transfers.items()):
+                if transfer.session is session:
+                    del transfers[tid]
+
+    def _retransmit(self, session, entry, now):
+        packet = entry[0]
+        packet.flags |= UdpProtocol.FLAG_RETRANSMISSION
+        entry[1] = now
+        self._send(session, packet, now)
+
+    def tick(self, now, meters):
+        for address, session in list(self.sessions.items()):
+            if now - session.last_receive > self.SESSION_TIMEOUT:
+                self.log.debug('{}: session {:04x} timed out'.format(self.name, session.session_id))
+                self.drop_session(address)
+                continue
+            if not session.established:
+                continue
+
+            for entry in list(session.unacked.values()):
+                if now - entry[1] > self.RETRANSMIT_TIMEOUT:
+                    self._retransmit(session, entry, now)
+
+            if meters is not None and (session.audio_levels or self.emulator.always_meters):
+                self.send_fields(session, [(b'AMLv', meters.audio_levels(self))], now)
+            if meters is not None and (session.fairlight_levels or self.emulator.always_meters):
+                self.send_fields(session, meters.fairlight_levels(self), now)
+
+            if now - session.last_send > self.PING_INTERVAL:
+                self.send_data(session, b'', now)
+
+    # Commands
+
+    def handle_command(self, session, field, raw):
+        self.commands[field] += 1
+        if field == b'CPgI':
+            me, source = struct.unpack_from('>BxH', raw)
+            self.set_field(b'PrgI', struct.pack('>BxH', me, source))
+        elif field == b'CPvI':
+            me, source = struct.unpack_from('>BxH', raw)
+            self.set_field(b'PrvI', struct.pack('>BxHB3x', me, source, 0))
+        elif field == b'DCut':
+            me, = struct.unpack_from('>B', raw)
+            program = self.get_field(b'PrgI', bytes([me]))
+            preview = self.get_field(b'PrvI', bytes([me]))
+            if program is not None and preview is not None:
+                self.set_field(b'PrgI', program[:2] + preview[2:4])
+                self.set_field(b'PrvI', preview[:2] + program[2:4] + preview[4:])
+        elif field == b'CAuS':
+            mask, aux, source = struct.unpack_from('>BBH', raw)
+            if mask & 1:
+                self.set_field(b'AuxS', struct.pack('>BxH', aux, source))
+        elif field == b'TiRq':
+            t = time.localtime()
+            self.send_fields(session, [(b'Time', struct.pack('>BBBB?3x', t.tm_hour, t.tm_min, t.tm_sec, 0, False))])
+        elif field == b'SALN':
+            session.audio_levels = raw[0] != 0
+        elif field == b'SFLN':
+            session.fairlight_levels = raw[0] != 0
+        elif field in (b'LOCK', b'PLCK'):
+            store, = struct.unpack_from('>H', raw)
+            if field == b'LOCK' and raw[2] == 0:
+                self.release_lock(store)
+            else:
+                self.locks[store] = session
+                self.send_fields(session, [(b'LKST', struct.pack('>H?x', store, True)),
+                                           (b'LKOB', struct.pack('>H2x', store))])
+        elif field == b'FTSD':
+            tid, store, slot, length, mode = struct.unpack_from('>HHxxHIHxx', raw)
+            if self.locks.get(store) is not session:
+                self.send_fields(session, [(b'FTDE', struct.pack('>HBx', tid, 5))])
+                return
+            self.uploads[tid] = Upload(session, store, slot, length)
+            self._continue_upload(session, tid)
+        elif field == b'FTDa':
+            tid, size = struct.unpack_from('>HH', raw)
+            upload = self.uploads[tid]
+            upload.data += raw[4:4 + size]
+            upload.chunks += 1
+            if upload.chunks % self.CHUNK_COUNT == 0:
+                self._continue_upload(session, tid)
+        elif field == b'FTFD':
+            tid, = struct.unpack_from('>H', raw)
+            digest = raw[194:210]
+            upload = self.uploads.pop(tid)
+            data = rle_decode(bytes(upload.data))
+            if hashlib.md5(data).digest() != digest:
+                # The hardware does not respond at all on a hash mismatch
+                self.log.warning('{}: hash mismatch for upload to {}:{}'.format(self.name, upload.store, upload.slot))
+                return
+            self.stored[(upload.store, upload.slot)] = data
+            self.send_fields(session, [(b'FTDC', struct.pack('>HBB', tid, 1, 2))])
+            self.release_lock(upload.store)
+        elif field == b'FTSU':
+            tid, store, slot = struct.unpack_from('>HHI', raw)
+            data = self.get_media(store, slot)
+            if data is None:
+                self.send_fields(session, [(b'FTDE', struct.pack('>HBx', tid, 2))])
+                return
+            self.downloads[tid] = Download(session, data)
+            for i in range(self.DOWNLOAD_WINDOW):
+                self._continue_download(session, tid)
+        elif field == b'FTUA':
+            tid, = struct.unpack_from('>H', raw)
+            if tid in self.downloads:
+                self.downloads[tid].outstanding -= 1
+                self._continue_download(session, tid)
+
+    def release_lock(self, store):
+        self.locks.pop(store, None)
+        self.broadcast([(b'LKST', struct.pack('>H?x', store, False))])
+
+    def get_media(self, store, slot):
+        data = self.stored.get((store, slot))
+        if data is None and store == 0:
+            # Empty still slots download as a black frame in the current video mode
+            mode = self.get_field(b'VidM')
+            width, height = VideoModeField(mode).get_resolution() if mode is not None else (1920, 1080)
+            data = bytes(width * height * 4)
+        if data is not None and store == 0:
+            data = rle_encode(data)
+        return data
+
+    def _continue_upload(self, session, tid):
+        self.send_fields(session, [(b'FTCD', struct.pack('>H 4x HH 2x', tid, self.CHUNK_SIZE, self.CHUNK_COUNT))])
+
+    def _continue_download(self, session, tid):
+        download = self.downloads[tid]
+        if download.offset >= len(download.data):
+            if download.outstanding <= 0:
+                del self.downloads[tid]
+                self.send_fields(session, [(b'FTDC', struct.pack('>HBB', tid, 1, 2))])
+            return
+        chunk = download.data[download.offset:download.offset + self.CHUNK_SIZE]
+        download.offset += len(chunk)
+        download.outstanding += 1
+        self.send_fields(session, [(b'FTDa', struct.pack('>HH', tid, len(chunk)) + chunk)])
+
+
+class MeterGenerator:
+    """
+    Generates moving audio levels for the AMLv, FMLv and FDLv meter fields
+    """
+
+    def __init__(self):
+        self.phase = 0.0
+
+    def step(self, interval):
+        self.phase += interval
+
+    def _level(self, offset):
+        # A slow sine between -50dB and -6dB, offset per channel so not all meters move together
+        return -28 + 22 * math.sin(self.phase * 2 + offset)
+
+    def audio_levels(self, device):
+        sources = [struct.unpack_from('>H', key[1])[0] for key in device.state if key[0] == b'AMIP']
+        raw = struct.pack('>H2x', len(sources))
+        master = self._classic(self._level(0))
+        raw += struct.pack('>4I 4I', master, master, master, master, master, master, master, master)
+        raw += struct.pack('>{}H'.format(len(sources)), *sources)
+        raw = raw.ljust(int(math.ceil(len(raw) / 4.0) * 4), b'\0')
+        for i, source in enumerate(sources):
+            level = self._classic(self._level(i))
+            raw += struct.pack('>4I', level, level, level, level)
+        return raw
+
+    def fairlight_levels(self, device):
+        fields = []
+        for key, (field, raw) in device.state.items():
+            if field != b'FASP':
+                continue
+            index, = struct.unpack_from('>H', raw)
+            level = self._fairlight(self._level(index))
+            fields.append((b'FMLv', struct.pack('>6xBBH 15h', raw[14], raw[15], index, level, level, level, level,
+                                                0, 0, 0, level, level, level, level, level, level, level, level)))
+        if len(fields):
+            level = self._fairlight(self._level(0))
+            fields.append((b'FDLv', struct.pack('>14h', *([level] * 4 + [0, 0] + [level] * 8))))
+        return fields
+
+    def _classic(self, db):
+        return int(128 * 65536 * 10 ** (db / 20))
+
+    def _fairlight(self, db):
+        return int(db * 100)
+
+
+class Emulator:
+    """
+    Runs any number of emulated switchers from a single thread. Every switcher has its own UDP socket and all
+    sockets are handled by one selector.
+    """
+
+    def __init__(self, meter_rate=10, always_meters=False):
+        self.selector = selectors.DefaultSelector()
+        self.devices = []
+        self.meter_rate = meter_rate
+        self.always_meters = always_meters
+        self.meters = MeterGenerator()
+        self.log = logging.getLogger('AtemEmulator')
+        self.running = False
+        self.thread = None
+
+    def add_device(self, fields=None, port=0, host='127.0.0.1', name=None):
+        """
+        Add an emulated switcher
+
+        :param fields: State dump as a list of (name, raw) tuples, a default state is used when this is not set
+        :param port: UDP port for the switcher, use 0 to pick a free port
+        :return: The EmulatedSwitcher instance, the port it's listening on is in the port attribute
+        """
+        if fields is None:
+            fields = default_dump()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.setblocking(False)
+        device = EmulatedSwitcher(self, sock, fields, name)
+        self.selector.register(sock, selectors.EVENT_READ, device)
+        self.devices.append(device)
+        return device
+
+    def serve_forever(self):
+        self.running = True
+        tick_interval = self.devices[0].RETRANSMIT_TIMEOUT if len(self.devices) else 0.1
+        if self.meter_rate:
+            tick_interval = min(tick_interval, 1.0 / self.meter_rate)
+        last_tick = time.monotonic()
+        last_meters = last_tick
+        while self.running:
+            for key, mask in self.selector.select(timeout=tick_interval):
+                device = key.data
+                now = time.monotonic()
+                while True:
+                    try:
+                        data, address = device.sock.recvfrom(2048)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except OSError as e:
+                        self.log.debug('{}: receive failed: {}'.format(device.name, e))
+                        break
+                    device.handle_datagram(data, address, now)
+
+            now = time.monotonic()
+            if now - last_tick < tick_interval:
+                continue
+            last_tick = now
+            meters = None
+            if self.meter_rate and now - last_meters >= 1.0 / self.meter_rate:
+                self.meters.step(now - last_meters)
+                last_meters = now
+                meters = self.meters
+            for device in self.devices:
+                device.tick(now, meters)
+
+    def start(self):
+        """Run the emulator in a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever, name='atem-emulator', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for device in self.devices:
+            self.selector.unregister(device.sock)
+            device.sock.close()
+        self.devices = []
@@ -1,8 +1,20 @@
 # Copyright 2021 - 2022, Martijn Braam and the OpenAtem contributors
 # SPDX-License-Identifier: LGPL-3.0-only
+import argparse
+import concurrent.futures
+import hashlib
+import mmap
+import os
 import struct
+import sys
+import time
+
 import pyatem.mediaconvert as mc
 
+ATEM_FILE_MAGIC = b'ATEM'
+ATEM_FILE_VERSION = 1
+ATEM_FILE_HEADER = struct.Struct('>4s H 2x HH I I 16s 64s 128s')
+
 
 def atem_to_image(data, width, height):
     """Decompress and decode an atem frame to RGBA8888"""
@@ -23,8 +35,50 @@ def atem_to_rgb(data, width, height):
 
 
 def rgb_to_atem(data, width, height, premultiply=False):
-    """Wrapper for the native function"""
-    return mc.rgb_to_atem(data, width, height, premultiply)
+    """Wrapper for the native function, data can be anything accepted by rgba_buffer()"""
+    return mc.rgb_to_atem(rgba_buffer(data), width, height, premultiply)
+
+
+def rgba_buffer(image):
+    """
+    Get the RGBA8888 pixel data of an image as an object supporting the buffer protocol so it can be passed to
+    the native converter without building python lists. This accepts PIL images, GdkPixbuf pixbufs, NumPy arrays
+    and any other object implementing the buffer protocol. Buffers are passed through without copying, PIL
+    images and pixbufs with padded rows are copied once.
+
+    :param image: Image object or buffer with 8-bit RGBA pixels
+    :return: Buffer with the tightly packed RGBA8888 pixel data
+    """
+    if isinstance(image, (bytes, bytearray)):
+        return image
+
+    # PIL images
+    if hasattr(image, 'getdata') and hasattr(image, 'mode'):
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        return image.tobytes()
+
+    # GdkPixbuf
+    if hasattr(image, 'get_rowstride') and hasattr(image, 'read_pixel_bytes'):
+        if image.get_bits_per_sample() != 8:
+            raise ValueError("Only 8-bit pixbufs are supported")
+        if not image.get_has_alpha():
+            image = image.add_alpha(False, 0, 0, 0)
+        width = image.get_width()
+        height = image.get_height()
+        rowstride = image.get_rowstride()
+        pixels = image.read_pixel_bytes().get_data()
+        if rowstride == width * 4:
+            return pixels
+        view = memoryview(pixels)
+        return b''.join(view[row * rowstride:row * rowstride + width * 4] for row in range(height))
+
+    view = memoryview(image)
+    if view.itemsize != 1:
+        raise ValueError("Image data needs to be 8 bits per channel")
+    if not view.c_contiguous:
+        return view.tobytes()
+    return view.cast('B')
 
 
 def rle_encode_slow(data):
@@ -107,12 +161,179 @@ def rle_decode(data):
     return result
 
 
+class EncodedFrame:
+    """
+    A frame that is already converted and RLE compressed, with the metadata needed to upload it without touching
+    the pixel data again. Instances can be passed directly to AtemProtocol.upload().
+
+    On disk this is stored as an `.atem` file, a fixed header followed by the RLE compressed frame data:
+
+    ====== ==== ====== ===========
+    Offset Size Type   Description
+    ====== ==== ====== ===========
+    0      4    char   Magic, "ATEM"
+    4      2    u16    Format version, currently 1
+    6      2    ?      padding
+    8      2    u16    Width
+    10     2    u16    Height
+    12     4    u32    Uncompressed data length
+    16     4    u32    Compressed data length
+    20     16   u8[]   MD5 hash of the uncompressed data
+    36     64   str    Name
+    100    128  str    Description
+    ====== ==== ====== ===========
+
+    :ivar data: RLE compressed frame data, a memoryview into the file for loaded frames
+    :ivar data_length: Length of the uncompressed frame data
+    :ivar hash: MD5 hash of the uncompressed frame data
+    :ivar width: Frame width in pixels
+    :ivar height: Frame height in pixels
+    :ivar name: Name shown for the media slot
+    :ivar description: Description of the media slot
+    """
+
+    def __init__(self, data, data_length, hash, width, height, name=None, description=None):
+        self.data = data
+        self.data_length = data_length
+        self.hash = hash
+        self.width = width
+        self.height = height
+        self.name = name
+        self.description = description
+        self._map = None
+
+    @classmethod
+    def load(cls, path):
+        """Open an .atem file, the payload is memory-mapped instead of read into memory"""
+        with open(path, 'rb') as handle:
+            header = handle.read(ATEM_FILE_HEADER.size)
+            if len(header) < ATEM_FILE_HEADER.size:
+                raise ValueError(f"{path} is too short to be an .atem file")
+            magic, version, width, height, data_length, size, hash, name, description = \
+                ATEM_FILE_HEADER.unpack(header)
+            if magic != ATEM_FILE_MAGIC:
+                raise ValueError(f"{path} is not an .atem file")
+            if version > ATEM_FILE_VERSION:
+                raise ValueError(f"{path} uses unsupported format version {version}")
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(mapped) < ATEM_FILE_HEADER.size + size:
+            mapped.close()
+            raise ValueError(f"{path} is truncated")
+
+        data = memoryview(mapped)[ATEM_FILE_HEADER.size:ATEM_FILE_HEADER.size + size]
+        name = name.split(b'\x00')[0].decode()
+        description = description.split(b'\x00')[0].decode()
+        self = cls(data, data_length, hash, width, height, name=name or None, description=description or None)
+        self._map = mapped
+        return self
+
+    def save(self, path):
+        name = self.name.encode() if self.name else b''
+        description = self.description.encode() if self.description else b''
+        header = ATEM_FILE_HEADER.pack(ATEM_FILE_MAGIC, ATEM_FILE_VERSION, self.width, self.height,
+                                       self.data_length, len(self.data), self.hash, name, description)
+        with open(path, 'wb') as handle:
+            handle.write(header)
+            handle.write(self.data)
+
+    def close(self):
+        if self._map is None:
+            return
+        self.data.release()
+        self.data = None
+        self._map.close()
+        self._map = None
+
+    def __repr__(self):
+        return f'<EncodedFrame {self.width}x{self.height} name={self.name} size={len(self.data)}>'
+
+
+def load_atem_file(path):
+    """Load a pre-encoded frame from an .atem file"""
+    return EncodedFrame.load(path)
+
+
+def save_atem_file(path, frame):
+    """Save a pre-encoded frame to an .atem file"""
+    frame.save(path)
+
+
+def load_image(path, width, height):
+    """Load an image file with pillow and fit it centered in a transparent RGBA frame of the target resolution"""
+    from PIL import Image
+
+    im = Image.open(path)
+    im.thumbnail((width, height), Image.Resampling.LANCZOS)
+    frame = Image.new('RGBA', (width, height))
+    frame.paste(im, ((width - im.width) // 2, (height - im.height) // 2))
+    return frame
+
+
+def encode_still(path, width, height, premultiply=False):
+    """
+    Load an image file and convert it to a compressed ATEM frame
+
+    :return: EncodedFrame with the compressed data
+    """
+    frame = load_image(path, width, height)
+    data = rgb_to_atem(frame, width, height, premultiply)
+    return EncodedFrame(rle_encode(data), len(data), hashlib.md5(data).digest(), width, height)
+
+
+def _convert_job(job):
+    source, destination, width, height, premultiply = job
+    start = time.perf_counter()
+    frame = encode_still(source, width, height, premultiply)
+    frame.name = os.path.splitext(os.path.basename(source))[0]
+    frame.save(destination)
+    return destination, len(frame.data), time.perf_counter() - start
+
+
+def parse_resolution(value):
+    if 'x' not in value:
+        raise argparse.ArgumentTypeError(f"Invalid resolution '{value}', expected WIDTHxHEIGHT")
+    width, height = value.lower().split('x', maxsplit=1)
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a directory of images to pre-encoded ATEM frames")
+    parser.add_argument('source', help='Directory with images to convert')
+    parser.add_argument('destination', help='Directory to write the .atem files to')
+    parser.add_argument('--resolution', '-r', type=parse_resolution, action='append',
+                        help='Target resolution as WIDTHxHEIGHT, can be specified multiple times (default 1920x1080)')
+    parser.add_argument('--premultiply', action='store_true', help='Premultiply the alpha channel')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help='Number of worker processes')
+    args = parser.parse_args()
+
+    resolutions = args.resolution or [(1920, 1080)]
+    extensions = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.gif', '.webp')
+    os.makedirs(args.destination, exist_ok=True)
+
+    jobs = []
+    for filename in sorted(os.listdir(args.source)):
+        if not filename.lower().endswith(extensions):
+            continue
+        stem = os.path.splitext(filename)[0]
+        for width, height in resolutions:
+            destination = os.path.join(args.destination, f'{stem}.{width}x{height}.atem')
+            jobs.append((os.path.join(args.source, filename), destination, width, height, args.premultiply))
+
+    if len(jobs) == 0:
+        print("No images found")
+        sys.exit(1)
+
+    pixels = sum(job[2] * job[3] for job in jobs)
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for destination, size, duration in executor.map(_convert_job, jobs):
+            print(f'{destination}: {size} bytes in {duration:.2f}s')
+
+    duration = time.perf_counter() - start
+    print(f'Converted {len(jobs)} frames in {duration:.2f}s, {len(jobs) / duration:.1f} frames/s, '
+          f'{pixels / duration / 1e6:.1f} Mpixel/s using {args.jobs} processes')
+
+
 if __name__ == '__main__':
-    with open('/workspace/test.bin', 'wb') as handle:
-        handle.write(
-            rle_decode(b'\xfe\xfe\xfe\xfe\xfe\xfe\xfe\xfe\x00\x00\x00\x00\x00\x0f\xd2\x00:\x96d\xfa:\x9e\xfc\xfa'))
-    exit(0)
-
-    with open('/workspace/usb-0-0.bin', 'rb') as handle:
-        raw = handle.read()
-    atem_to_image(raw, 1920, 1080)
+    main()
@@ -56,6 +56,7 @@ method_atem_to_rgb(PyObject *self, PyObject *args)
     char *resbuffer = (char *) malloc(data_length);
 
     if (resbuffer == NULL) {
+        PyBuffer_Release(&input_buffer);
         return PyErr_NoMemory();
     }
 
@@ -63,6 +64,7 @@ method_atem_to_rgb(PyObject *self, PyObject *args)
 
     int pixel_size = 8;
     buffer = input_buffer.buf;
+    Py_BEGIN_ALLOW_THREADS
     for (int i = 0; i < data_length; i += pixel_size) {
         // Convert 10-bit BT.709 Y'CbCrA 4:2:2 to RGB
         // Unpack bytes to 2xY 2xA and a B and R pair
@@ -96,7 +98,9 @@ method_atem_to_rgb(PyObject *self, PyObject *args)
         outbuffer += pixel_size;
         buffer += pixel_size;
     }
+    Py_END_ALLOW_THREADS
 
+    PyBuffer_Release(&input_buffer);
     res = Py_BuildValue("y#", resbuffer, data_length);
     free(resbuffer);
     return res;
@@ -121,12 +125,14 @@ method_rgb_to_atem(PyObject *self, PyObject *args)
 
     char *outbuffer = (char *) malloc(data_length);
     if (outbuffer == NULL) {
+        PyBuffer_Release(&input_buffer);
         return PyErr_NoMemory();
     }
 
     char *writepointer = outbuffer;
 
     int pixel_size = 8;
+    Py_BEGIN_ALLOW_THREADS
     for (int i = 0; i < data_length; i += pixel_size) {
         // Convert RGBA 8888 to 10-bit BT.709 Y'CbCrA
         float r1 = (float)buffer[0] / 255;
@@ -171,7 +177,9 @@ method_rgb_to_atem(PyObject *self, PyObject *args)
         writepointer += pixel_size;
         buffer += pixel_size;
     }
+    Py_END_ALLOW_THREADS
 
+    PyBuffer_Release(&input_buffer);
     res = Py_BuildValue("y#", outbuffer, data_length);
     free(outbuffer);
     return res;
@@ -192,6 +200,12 @@ method_rle_encode(PyObject *self, PyObject *args)
     Py_ssize_t c = 0, i, w;
     uint64_t *data = input_buffer.buf;
     uint64_t *buf = malloc(input_buffer.len);
+    if (buf == NULL) {
+        PyBuffer_Release(&input_buffer);
+        return PyErr_NoMemory();
+    }
+
+    Py_BEGIN_ALLOW_THREADS
     for (i = 0, w = 0, c = 0; i < input_buffer.len / 8; ++i) {
         assert(data[i] != RLE_HEADER);
         if (i != 0 && data[i - 1] == data[i]) {
@@ -223,7 +237,9 @@ method_rle_encode(PyObject *self, PyObject *args)
     } else if (input_buffer.len == 1) {
         buf[0] = data[0];
     }
+    Py_END_ALLOW_THREADS
 
+    PyBuffer_Release(&input_buffer);
     res = Py_BuildValue("y#", buf, w * 8);
     free(buf);
     return res;
@@ -0,0 +1,210 @@
+# Copyright 2021 - 2022, Martijn Braam and the OpenAtem contributors
+# SPDX-License-Identifier: LGPL-3.0-only
+import bisect
+import collections
+import functools
+import logging
+import time
+
+# Bucket bounds in seconds for network round trip times
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Bucket bounds in seconds for event callbacks, these should be a lot faster than a network round trip
+CALLBACK_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1)
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets. Updating it is a few integer increments so it can be used for every packet, the
+    values are only written from a single thread.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """
+        Get the upper bound of the bucket containing the percentile, for values above the last bucket this is the
+        highest value observed
+        """
+        if self.count == 0:
+            return None
+        target = fraction * self.count
+        total = 0
+        for i, count in enumerate(self.counts):
+            total += count
+            if total >= target and count > 0:
+                if i == len(self.buckets):
+                    return self.max
+                return min(self.buckets[i], self.max)
+        return self.max
+
+    def cumulative(self):
+        """List of (upper bound, count of values at or below the bound), the last bound is infinity"""
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), list(self.counts)):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+        }
+
+
+class Counter:
+    """
+    Monotonic counter that also tracks the rate it increases. The rate is averaged over at least a second between
+    reads. There is no lock, when multiple threads add to the same counter an increment can get lost in rare cases
+    which is fine for monitoring.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self._sample = (time.monotonic(), 0)
+        self._rate = 0.0
+
+    def add(self, value=1):
+        self.total += value
+
+    def rate(self):
+        now = time.monotonic()
+        timestamp, total = self._sample
+        if now - timestamp >= 1.0:
+            current = self.total
+            self._rate = (current - total) / (now - timestamp)
+            self._sample = (now, current)
+        return self._rate
+
+
+class RollingWindow:
+    """
+    Keeps the last values observed so the percentiles show the recent behaviour instead of the whole runtime
+    """
+
+    def __init__(self, size=1000):
+        self.values = collections.deque(maxlen=size)
+
+    def observe(self, value):
+        self.values.append(value)
+
+    def percentile(self, fraction):
+        values = sorted(self.values)
+        if len(values) == 0:
+            return None
+        return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def callback_name(callback):
+    """Get a readable name for a callback, like module.Class.method"""
+    if isinstance(callback, functools.partial):
+        return callback_name(callback.func)
+    if hasattr(callback, '__wrapped__'):
+        return callback_name(callback.__wrapped__)
+    name = getattr(callback, '__qualname__', None) or type(callback).__qualname__
+    module = getattr(callback, '__module__', None)
+    if module is None:
+        return name
+    return f'{module}.{name}'
+
+
+class CallbackStats:
+    def __init__(self, event, name, window):
+        self.event = event
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.over_budget = 0
+        self.last_warning = 0
+        self.window = RollingWindow(window)
+
+    def to_dict(self):
+        return {
+            'event': self.event,
+            'callback': self.name,
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'p50': self.window.percentile(0.5),
+            'p90': self.window.percentile(0.9),
+            'p99': self.window.percentile(0.99),
+            'over_budget': self.over_budget,
+        }
+
+
+class CallbackProfiler:
+    """
+    Times every callback separately. The percentiles are over the last `window` calls of a callback, calls that take
+    longer than `budget` seconds are counted and logged at most every `warning_interval` seconds per callback.
+    """
+
+    def __init__(self, budget=None, window=1000, warning_interval=10):
+        self.budget = budget
+        self.window = window
+        self.warning_interval = warning_interval
+        self.stats = {}
+        self.log = logging.getLogger('CallbackProfiler')
+
+    def observe(self, event, key, callback, duration):
+        """
+        :param event: Name of the event the callback is registered for
+        :param key: Id of the registration, callbacks registered multiple times are tracked separately
+        """
+        stats = self.stats.get((event, key))
+        if stats is None:
+            stats = CallbackStats(event, callback_name(callback), self.window)
+            self.stats[(event, key)] = stats
+        stats.count += 1
+        stats.total += duration
+        if duration > stats.max:
+            stats.max = duration
+        stats.window.observe(duration)
+
+        if self.budget is not None and duration > self.budget:
+            stats.over_budget += 1
+            now = time.monotonic()
+            if now - stats.last_warning >= self.warning_interval:
+                stats.last_warning = now
+                self.log.warning(f'Callback {stats.name} for "{event}" took {duration * 1000:.1f} ms, '
+                                 f'the budget is {self.budget * 1000:.1f} ms')
+
+    def reset(self):
+        self.stats = {}
+
+    def report(self):
+        """List of the stats for every callback, the callbacks that took the most time in total first"""
+        result = [stats.to_dict() for stats in list(self.stats.values())]
+        result.sort(key=lambda row: row['total'], reverse=True)
+        return result
+
+    def format_report(self, limit=None):
+        """The report as a text table with the times in milliseconds"""
+        rows = self.report()
+        if limit is not None:
+            rows = rows[:limit]
+        lines = ['{:>8} {:>10} {:>8} {:>8} {:>8} {:>8} {:>6}  {}'.format('calls', 'total', 'p50', 'p90', 'p99', 'max',
+                                                                         'over', 'event / callback')]
+        for row in rows:
+            times = [row[key] * 1000 for key in ('total', 'p50', 'p90', 'p99', 'max')]
+            lines.append('{:>8} {:>10.1f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>6}  {} / {}'.format(
+                row['count'], *times, row['over_budget'], row['event'], row['callback']))
+        return '\n'.join(lines)
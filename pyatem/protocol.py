@@ -2,12 +2,16 @@
 # SPDX-License-Identifier: LGPL-3.0-only
 import logging
 import struct
+import time
 
-from pyatem.transfer import TransferTask, TransferQueueFlushed
+from pyatem.transfer import TransferTask, TransferQueueFlushed, StreamingTransferTask, ClipUpload
 from pyatem.transport import UdpProtocol, Packet, UsbProtocol, TcpProtocol, ConnectionReady
 from pyatem.command import LockCommand, TransferDownloadRequestCommand, TransferAckCommand, \
-    TransferUploadRequestCommand, TransferDataCommand, TransferFileDataCommand, PartialLockCommand, TimeRequestCommand
-from pyatem.media import rle_decode
+    TransferUploadRequestCommand, TransferDataCommand, TransferFileDataCommand, PartialLockCommand, TimeRequestCommand, \
+    MediaplayerClipClearCommand, MediaplayerClipSetCommand
+from pyatem.media import rle_decode, EncodedFrame
+from pyatem.dispatch import QueuedCallback, DROP_OLDEST
+from pyatem.metrics import Counter, Histogram, CallbackProfiler, CALLBACK_BUCKETS
 import pyatem.field as fieldmodule
 
 
@@ -145,10 +149,12 @@ class AtemProtocol:
         'camera-control-data-packet': struct.Struct('>BBB'),
     }
 
-    def __init__(self, ip=None, port=9910, usb=None):
-        if ip is None and usb is None:
+    def __init__(self, ip=None, port=9910, usb=None, transport=None):
+        if ip is None and usb is None and transport is None:
             raise ValueError("Need either an ip or usb port")
-        if ip is not None:
+        if transport is not None:
+            self.transport = transport
+        elif ip is not None:
             if ip.startswith('tcp://'):
                 self.transport = TcpProtocol(url=ip)
             else:
@@ -160,11 +166,20 @@ class AtemProtocol:
         self.transport.queue_callback = self.queue_callback
         self.mixerstate = {}
         self.callbacks = {}
+
+        # After a reconnect the state dump is compared with the last known state, this holds the fields that were
+        # received again until the dump is complete
+        self.resyncing = False
+        self.resync_seen = set()
         self.inputs = {}
         self.callback_idx = 1
+        self.callback_times = {}
+        self.profiler = None
         self.connected = False
 
         self.locks = {}
+        # Stores that were locked for a single clip frame, the hardware releases these locks after the transfer
+        self.partial_locks = set()
         self.mode = None
         self.transfer_queue = {}
         self.transfer_id = 42
@@ -174,6 +189,9 @@ class AtemProtocol:
         self.transfer_requested = False
         self.transfer_packets = 0
         self.transfer_budget = []
+        self.transfer_bytes_in = Counter()
+        self.transfer_bytes_out = Counter()
+        self.clip_uploads = {}
 
     @classmethod
     def usb_exists(cls):
@@ -185,12 +203,18 @@ class AtemProtocol:
 
     def loop(self):
         self.log.debug('Waiting for data packet...')
-        packet = self.transport.receive_packet()
+        self.handle_packet(self.transport.receive_packet())
+
+    def handle_packet(self, packet):
+        """
+        Process a result of transport.receive_packet(), this is the part of loop() that runs after receiving. A None
+        packet is handled as a disconnect.
+        """
         if packet is None:
             # Disconnected from hardware
             if self.connected:
                 self._raise('disconnected')
-                self.mixerstate = {}
+                self._start_resync()
             self.connected = False
             return
         if isinstance(packet, ConnectionReady):
@@ -208,9 +232,66 @@ class AtemProtocol:
         except ConnectionError:
             print("Encountered protocol corruption, closing connection")
             self._raise('disconnected')
-            self.mixerstate = {}
+            self._start_resync()
             self.connected = False
 
+    def _start_resync(self):
+        """
+        Keep the state of the lost connection, the state dump after reconnecting only raises change events for the
+        fields that differ from it
+        """
+        self.resyncing = len(self.mixerstate) > 0
+        self.resync_seen = set()
+
+    def _finish_resync(self):
+        """
+        Called when the state dump after a reconnect is complete. Fields that were not in the new dump are removed from
+        the mixerstate, the resynced event gets a list of their identities in the (key, index, ...) form.
+        """
+        self.resyncing = False
+        removed = [identity for identity in self._identities() if identity not in self.resync_seen]
+        for identity in removed:
+            self._remove_field(identity)
+        self.resync_seen = set()
+        self._raise('resynced', removed)
+
+    def _identities(self, tree=None, path=()):
+        if tree is None:
+            tree = self.mixerstate
+        for key, value in list(tree.items()):
+            if isinstance(value, dict) and (len(path) > 0 or key in self.FIELDNAME_UNIQUE):
+                yield from self._identities(value, path + (key,))
+            else:
+                yield path + (key,)
+
+    def _remove_field(self, identity):
+        """Remove a field from the mixerstate, the dicts for the indexes are removed when they become empty"""
+        trees = [self.mixerstate]
+        for idx in identity[:-1]:
+            if not isinstance(trees[-1].get(idx), dict):
+                return
+            trees.append(trees[-1][idx])
+        trees[-1].pop(identity[-1], None)
+        for tree, idx in zip(reversed(trees[:-1]), reversed(identity[:-1])):
+            if len(tree[idx]) > 0:
+                break
+            del tree[idx]
+
+    def _unchanged(self, key, idxes, raw):
+        """Check if a field in the state dump after a reconnect is the same as in the last known state"""
+        identity = (key,) + idxes
+        self.resync_seen.add(identity)
+        previous = self.mixerstate.get(key)
+        for idx in idxes:
+            if not isinstance(previous, dict):
+                return False
+            previous = previous.get(idx)
+        if previous is None or isinstance(previous, dict):
+            return False
+        if isinstance(previous, bytes):
+            return previous == raw
+        return getattr(previous, 'raw', None) == raw
+
     def on(self, event, callback):
         if event not in self.callbacks:
             self.callbacks[event] = {}
@@ -218,18 +299,73 @@ class AtemProtocol:
         self.callback_idx += 1
         return self.callback_idx - 1
 
+    def on_queued(self, event, callback, size=1024, policy=DROP_OLDEST, key=None):
+        """
+        Register a callback that runs on its own worker thread with a bounded queue, see QueuedCallback for the
+        overflow policies. Slow callbacks registered this way don't delay the receiving and acknowledging of packets.
+        """
+        return self.on(event, QueuedCallback(callback, size=size, policy=policy, key=key))
+
     def off(self, event, callback_id):
         if event not in self.callbacks:
             return
-        del self.callbacks[event][callback_id]
+        callback = self.callbacks[event].pop(callback_id)
+        if isinstance(callback, QueuedCallback):
+            callback.stop()
 
     def get_link_quality(self):
         return self.transport.get_link_quality()
 
+    def get_metrics(self):
+        """
+        Get the transport counters and, when profiling is enabled, the time spent in the event callbacks for every
+        event
+        """
+        return {
+            'connected': self.connected,
+            'transport': self.transport.get_metrics(),
+            'callbacks': {event: histogram.to_dict() for event, histogram in list(self.callback_times.items())},
+            'queues': {f'{event}/{callback.name}': callback.get_metrics()
+                       for event, callbacks in list(self.callbacks.items())
+                       for callback in list(callbacks.values()) if isinstance(callback, QueuedCallback)},
+            'transfer': {
+                'bytes_in': self.transfer_bytes_in.total,
+                'bytes_out': self.transfer_bytes_out.total,
+                'bytes_in_rate': self.transfer_bytes_in.rate(),
+                'bytes_out_rate': self.transfer_bytes_out.rate(),
+            },
+        }
+
+    def enable_profiling(self, budget=None, window=1000):
+        """
+        Time every event callback separately to find the handlers that block loop(). Callbacks that take longer than
+        budget seconds are logged. The results are in self.profiler.report().
+        """
+        self.profiler = CallbackProfiler(budget=budget, window=window)
+        return self.profiler
+
+    def disable_profiling(self):
+        self.profiler = None
+
     def _raise(self, event, *args, **kwargs):
-        if event in self.callbacks:
+        if event not in self.callbacks:
+            return
+        profiler = self.profiler
+        if profiler is None:
+            # Timing costs more than most callbacks, it's only done when profiling is enabled
             for cbidx in self.callbacks[event]:
                 self.callbacks[event][cbidx](*args, **kwargs)
+            return
+
+        start = time.perf_counter()
+        for cbidx in self.callbacks[event]:
+            callback = self.callbacks[event][cbidx]
+            before = time.perf_counter()
+            callback(*args, **kwargs)
+            profiler.observe(event, cbidx, callback, time.perf_counter() - before)
+        if event not in self.callback_times:
+            self.callback_times[event] = Histogram(CALLBACK_BUCKETS)
+        self.callback_times[event].observe(time.perf_counter() - start)
 
     def decode_packet(self, data):
         offset = 0
@@ -245,14 +381,25 @@ class AtemProtocol:
             yield (cmd, raw)
             offset += datalen
 
-    def save_field_data(self, fieldname, contents):
-        raw = contents
+    @classmethod
+    def decode_field(cls, fieldname, contents):
+        """
+        Decode the data of a field without storing it
+
+        :return: tuple of the key as used in the mixerstate and the field object, or the raw data if there's no
+                 decoder for the field
+        """
         key = fieldname.decode()
-        if key in self.FIELDNAME_PRETTY:
-            key = self.FIELDNAME_PRETTY[key]
+        if key in cls.FIELDNAME_PRETTY:
+            key = cls.FIELDNAME_PRETTY[key]
             classname = key.title().replace('-', '') + "Field"
             if hasattr(fieldmodule, classname):
                 contents = getattr(fieldmodule, classname)(contents)
+        return key, contents
+
+    def save_field_data(self, fieldname, contents):
+        raw = contents
+        key, contents = self.decode_field(fieldname, contents)
 
         if key == 'CapA':
             return
@@ -269,6 +416,7 @@ class AtemProtocol:
             if contents.store in self.locks and self.locks[contents.store]:
                 # Remove the lock if we held it
                 del self.locks[contents.store]
+                self.partial_locks.discard(contents.store)
             self.log.debug(contents)
             return
         elif key == 'file-transfer-continue-data':
@@ -283,6 +431,7 @@ class AtemProtocol:
             if contents.transfer == self.transfer.tid:
                 self.transfer_packets += 1
                 self.transfer_buffer += contents.data
+                self.transfer_bytes_in.add(len(contents.data))
                 if self.transfer_packets % 20 == 0:
                     total_size = self.mixerstate['video-mode'].get_pixels() * 4
                     transfer_progress = len(self.transfer_buffer) / total_size
@@ -294,6 +443,9 @@ class AtemProtocol:
             return
         elif key == 'file-transfer-error':
             self.log.error(f"file-transfer-error: {str(contents)}")
+            if self.transfer is None or contents.transfer != self.transfer.tid:
+                # Error for a transfer that has already been given up
+                return
             self.transfer_requested = False
             if contents.status == 1:
                 # Status is try-again
@@ -314,9 +466,18 @@ class AtemProtocol:
             queue = self.transfer_queue[self.transfer.store]
             self.transfer_queue[self.transfer.store] = queue[1:]
 
+            # The lock for a clip frame is released by the hardware after the transfer, the lock of other stores is
+            # kept for the next transfer in the queue and released in _transfer_trigger()
+            if self.transfer.store in self.partial_locks:
+                self.partial_locks.discard(self.transfer.store)
+                self.locks.pop(self.transfer.store, None)
+
             if self.transfer.upload:
                 self._raise('upload-done', self.transfer.store, self.transfer.slot)
                 self.transfer_requested = False
+                if self._clip_upload_done(self.transfer.store):
+                    # The next frame of the clip has been queued and triggered already
+                    return
             else:
                 # Assemble the buffer
                 data = self.transfer_buffer
@@ -341,17 +502,17 @@ class AtemProtocol:
 
             if contents.upload:
                 self._raise('upload-done', contents.store, contents.slot)
+                if self._clip_upload_done(contents.store):
+                    return
             else:
                 # TODO: Implement proxy download
                 pass
             # Start next transfer in the queue
-            self._transfer_trigger(self.transfer.store)
+            self._transfer_trigger(contents.store)
             return
 
         if key in self.FIELDNAME_UNIQUE:
             idxes = self.FIELDNAME_UNIQUE[key].unpack_from(raw, 0)
-            if key not in self.mixerstate:
-                self.mixerstate[key] = {}
 
             # Fairlight strips have weird numbering that's harder to parse here, read it back from the class
             if hasattr(contents, 'strip_id'):
@@ -359,11 +520,22 @@ class AtemProtocol:
                 idxes[0] = contents.strip_id
                 idxes = tuple(idxes)
 
+            if self.resyncing and self._unchanged(key, idxes, raw):
+                return
+            if key not in self.mixerstate:
+                self.mixerstate[key] = {}
+
             unique = self.make_unique_dict(contents, idxes)
             self.mixerstate[key] = self.recursive_merge(self.mixerstate[key], unique)
             self._raise('change:' + key + ':' + str(idxes[0]), contents)
             self._raise('change:' + key + ':*', contents)
         else:
+            if key == 'InCm' and self.resyncing:
+                # The dump is complete, InCm itself is always raised since it marks the end of the dump
+                self.resync_seen.add((key,))
+                self._finish_resync()
+            elif self.resyncing and self._unchanged(key, (), raw):
+                return
             self.mixerstate[key] = contents
             self._raise('change:' + key, contents)
         if key == 'input-properties':
@@ -414,9 +586,14 @@ class AtemProtocol:
             return
 
         self.transfer.send_done += size
+        self.transfer_bytes_out.add(size)
         fraction = self.transfer.send_done / self.transfer.send_length
         self._raise('upload-progress', self.transfer.store, self.transfer.slot, fraction * 100, self.transfer.send_done,
                     self.transfer.send_length)
+        if self.transfer.store in self.clip_uploads:
+            clip = self.clip_uploads[self.transfer.store]
+            self._raise('clip-upload-progress', clip.index, clip.frames_done, clip.frame_count,
+                        clip.get_progress(fraction))
 
     def download(self, store, index):
         self.log.info("Queue download of {}:{}".format(store, index))
@@ -431,7 +608,12 @@ class AtemProtocol:
         if store not in self.transfer_queue:
             self.transfer_queue[store] = []
 
-        if task is None:
+        if task is None and isinstance(data, EncodedFrame):
+            # Pre-encoded frames already have all the metadata, don't touch the pixel data
+            task = TransferTask.from_encoded_frame(store, index, data)
+            task.name = name or task.name
+            task.description = description or task.description
+        elif task is None:
             task = TransferTask(store, index, upload=True)
             task.data = data
             task.send_length = len(data)
@@ -452,11 +634,80 @@ class AtemProtocol:
         self.log.info(f'New upload task is {len(task.data)} bytes, {task.data_length} uncompressed')
 
         if isinstance(self.transport, TcpProtocol):
+            # The TCP transfer header contains the hash and compressed size, so the whole frame is needed here
+            task.fill()
             self.transport.upload(task)
         else:
             self.transfer_queue[store].append(task)
             self._transfer_trigger(store)
 
+    def upload_stream(self, store, index, data, width, height, premultiply=False, name=None, description=None):
+        """
+        Upload an RGBA8888 frame without converting the whole frame up front. The frame is converted, hashed and
+        compressed in bands of rows in a background thread while the already finished bands are being sent.
+        When the frame can't be converted the upload is skipped and upload-error is raised with the store, slot and
+        the exception.
+        """
+        task = StreamingTransferTask(store, index, data, width, height, premultiply=premultiply)
+        task.name = name
+        task.description = description
+        task.start()
+        self.upload(store, index, None, task=task)
+
+    def upload_clip(self, index, frames, width, height, name=None, premultiply=False, frame_count=None):
+        """
+        Upload a sequence of frames to a clip in the media pool. The frames are taken from an iterator one by one
+        and the next frame is encoded while the current one is being transferred. Progress for the whole clip is
+        reported with the clip-upload-progress event and clip-upload-done is raised when the clip is complete. The
+        frames are pulled from the iterator on a separate thread, if the iterator raises an exception the upload is
+        stopped and clip-upload-error is raised with the clip index and the exception.
+
+        :param index: 0-indexed clip number
+        :param frames: Iterable of RGBA8888 frames or EncodedFrame objects
+        :param width: Width of the frames
+        :param height: Height of the frames
+        :param name: Name for the clip
+        :param premultiply: Premultiply the alpha channel of the frames
+        :param frame_count: Number of frames for progress reporting, taken from len(frames) if possible
+        """
+        clip = ClipUpload(index, frames, width, height, name=name, premultiply=premultiply, frame_count=frame_count)
+        self.log.info(f'Queue upload of clip {index}')
+        self.clip_uploads[clip.store] = clip
+        self.send_commands([MediaplayerClipClearCommand(index)])
+        clip.start(self._clip_upload_next)
+        self._clip_upload_next(clip)
+
+    def _clip_upload_next(self, clip):
+        """
+        Queue the upload of the next frame of the clip, returns False when the clip is complete or the next frame is
+        not ready yet. In that case this is called again from the prefetch thread of the clip.
+        """
+        try:
+            task = clip.next_task()
+        except Exception as e:
+            self.log.error(f'Reading the frames for clip {clip.index} failed: {e}')
+            del self.clip_uploads[clip.store]
+            self._raise('clip-upload-error', clip.index, e)
+            return False
+        if task is ClipUpload.PENDING:
+            return False
+        if task is None:
+            del self.clip_uploads[clip.store]
+            self.send_commands([MediaplayerClipSetCommand(clip.index, clip.name or '', clip.frames_done)])
+            self._raise('clip-upload-done', clip.index)
+            return False
+        self.upload(clip.store, task.slot, None, task=task)
+        return True
+
+    def _clip_upload_done(self, store):
+        """Continue a clip upload after a frame is done, returns True if the upload of the next frame was started"""
+        if store not in self.clip_uploads:
+            return False
+        clip = self.clip_uploads[store]
+        clip.frames_done += 1
+        self._raise('clip-upload-progress', clip.index, clip.frames_done, clip.frame_count, clip.get_progress())
+        return self._clip_upload_next(clip)
+
     def _queue_chunks(self):
         # Can't transfer without a chunk size
         if self.transfer_budget is None:
@@ -475,6 +726,11 @@ class AtemProtocol:
         chunk_size = self.transfer_budget.size
         self.log.debug(f'Queue {self.transfer_budget.count} chunks of {chunk_size}')
         for i in range(0, self.transfer_budget.count):
+            try:
+                self.transfer.fill(chunk_size)
+            except Exception as e:
+                self._transfer_failed(e)
+                return
             if len(self.transfer.data) == 0:
                 break
 
@@ -502,6 +758,13 @@ class AtemProtocol:
 
     def _queue_flushed(self):
         self.log.info('Queue flushed')
+        if self.transfer is None:
+            return
+        try:
+            self.transfer.fill(1)
+        except Exception as e:
+            self._transfer_failed(e)
+            return
         if len(self.transfer.data):
             self._queue_chunks()
             return
@@ -510,6 +773,35 @@ class AtemProtocol:
                                       name=self.transfer.name, description=self.transfer.description)
         self.send_commands([cmd])
 
+    def _transfer_failed(self, error):
+        """
+        Give up on the current upload when its data can't be produced, like a frame that fails to convert, and
+        continue with the next transfer in the queue
+        """
+        transfer = self.transfer
+        self.log.error(f'Upload to {transfer.store}:{transfer.slot} failed: {error}')
+
+        # There is no abort command in the protocol, the chunks that are not sent yet are dropped and the lock is
+        # released so the switcher discards the transfer
+        self.transport.send_queue.clear()
+        self.transport.queue_enabled = False
+        queue = self.transfer_queue.get(transfer.store, [])
+        if len(queue) > 0 and queue[0] is transfer:
+            self.transfer_queue[transfer.store] = queue[1:]
+        self.partial_locks.discard(transfer.store)
+        if self.locks.pop(transfer.store, False):
+            self.send_commands([LockCommand(transfer.store, False)])
+        self.transfer = None
+        self.transfer_requested = False
+        self.transfer_budget = None
+
+        self._raise('upload-error', transfer.store, transfer.slot, error)
+        if transfer.store in self.clip_uploads:
+            clip = self.clip_uploads.pop(transfer.store)
+            clip.stop()
+            self._raise('clip-upload-error', clip.index, error)
+        self._transfer_trigger(transfer.store)
+
     def _transfer_trigger(self, store, retry=False):
         next = None
 
@@ -541,6 +833,8 @@ class AtemProtocol:
         # Request a lock if needed
         if next.store != 0xffff and (next.store not in self.locks or not self.locks[next.store]):
             self.log.info('Requesting lock for {}'.format(next.store))
+            if next.store in self.clip_uploads:
+                self.partial_locks.add(next.store)
             cmd = PartialLockCommand(next.store, next.slot)
             self.send_commands([cmd])
             return
@@ -0,0 +1,283 @@
+# Copyright 2021 - 2022, Martijn Braam and the OpenAtem contributors
+# SPDX-License-Identifier: LGPL-3.0-only
+"""
+Handles the connections to many switchers from a single thread. Every device normally gets an `atem-udp` thread for
+the socket and a thread calling AtemProtocol.loop(), with the Supervisor all sockets are on one selector and the
+decoding and the event callbacks run on the supervisor thread.
+"""
+import collections
+import logging
+import selectors
+import socket
+import threading
+import time
+
+from pyatem.metrics import Counter
+from pyatem.protocol import AtemProtocol
+from pyatem.transport import BaseProtocol, UdpProtocol
+
+
+class SharedUdpProtocol(UdpProtocol):
+    """
+    UDP transport driven by a Supervisor. There's no thread for the socket and AtemProtocol.loop() can't be used,
+    the supervisor feeds the received packets to AtemProtocol.handle_packet() instead.
+    """
+
+    def __init__(self, supervisor, ip, port=9910):
+        self.supervisor = supervisor
+        super().__init__(ip, port)
+        self.sock.setblocking(False)
+        self.connect_started = None
+
+        # Sending bulk data is already paced by the packets from the switcher, sleeping would stall all devices
+        self.batch_delay = 0
+
+    def _setup_thread(self):
+        self.thread = None
+        self.outbox = collections.deque()
+
+    def get_metrics(self):
+        metrics = BaseProtocol.get_metrics(self)
+        metrics['thread_queue'] = len(self.outbox)
+        return metrics
+
+    def _send_packet(self, packet):
+        self.outbox.append(packet)
+        self.packet_sucess += 1
+        self.supervisor.send_ready(self)
+
+    def flush(self):
+        while len(self.outbox):
+            self._send_packet_low(self.outbox.popleft())
+
+    def connect(self):
+        if not self.supervisor.in_thread():
+            # The connection state is only touched from the supervisor thread
+            if self.state != UdpProtocol.STATE_CLOSED:
+                raise RuntimeError("Trying to open an connection that's already open")
+            self.supervisor.call_soon(self.connect)
+            return
+        self.connect_started = time.monotonic()
+        super().connect()
+
+    def receive_packet(self):
+        raise RuntimeError("This connection is handled by a Supervisor, don't call loop()")
+
+
+class Device:
+    def __init__(self, switcher):
+        self.switcher = switcher
+        self.transport = switcher.transport
+        self.last_received = 0
+        self.next_attempt = None
+        self.failures = 0
+
+
+class Supervisor:
+    """
+    Runs the UDP connections of many switchers on a single thread. Connection timeouts and reconnects with
+    exponential backoff are handled here for all devices.
+
+    The AtemProtocol objects returned by add() work like normal ones, except that the event callbacks run on the
+    supervisor thread and loop() is not used. Use AtemProtocol.on_queued() for callbacks that could be slow.
+    """
+
+    def __init__(self, timeout=5, connect_timeout=2, backoff=1, max_backoff=30):
+        """
+        :param timeout: Seconds without packets from an established connection before it's reconnected
+        :param connect_timeout: Seconds to wait for the handshake
+        :param backoff: Delay before the first reconnect attempt, this doubles for every failed attempt
+        :param max_backoff: Longest delay between the reconnect attempts
+        """
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.interval = 0.25
+        self.log = logging.getLogger('Supervisor')
+
+        self.devices = {}
+        self.calls = collections.deque()
+        self.flush_queue = collections.deque()
+        self.thread = None
+        self.thread_id = None
+        self.stopped = False
+
+        self.selector = selectors.DefaultSelector()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        self._woken = False
+
+        self.reconnects = Counter()
+        self.callback_errors = Counter()
+
+    def add(self, ip, port=9910):
+        """
+        Create an AtemProtocol for a switcher that's handled by this supervisor, it connects when connect() is called
+        on it like a normal AtemProtocol.
+        """
+        switcher = AtemProtocol(transport=SharedUdpProtocol(self, ip, port))
+        self.call_soon(self._register, Device(switcher))
+        return switcher
+
+    def remove(self, switcher):
+        self.call_soon(self._unregister, switcher.transport)
+
+    def in_thread(self):
+        return threading.get_ident() == self.thread_id
+
+    def call_soon(self, callback, *args):
+        """Run a function on the supervisor thread"""
+        self.calls.append((callback, args))
+        self.wakeup()
+
+    def send_ready(self, transport):
+        if self.in_thread():
+            self._flush(transport)
+        else:
+            self.flush_queue.append(transport)
+            self.wakeup()
+
+    def wakeup(self):
+        if self._woken:
+            return
+        self._woken = True
+        try:
+            self._wakeup_send.send(b'x')
+        except BlockingIOError:
+            pass
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='atem-supervisor', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup()
+        if self.thread is not None and not self.in_thread():
+            self.thread.join(5)
+
+    def serve_forever(self):
+        self.thread_id = threading.get_ident()
+        last_check = time.monotonic()
+        try:
+            while not self.stopped:
+                self._run_calls()
+                while len(self.flush_queue):
+                    self._flush(self.flush_queue.popleft())
+
+                for key, mask in self.selector.select(timeout=self.interval):
+                    if key.data is None:
+                        self._woken = False
+                        try:
+                            while self._wakeup_recv.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    else:
+                        self._read(key.data)
+
+                now = time.monotonic()
+                if now - last_check >= self.interval:
+                    last_check = now
+                    self._check(now)
+        finally:
+            for transport in list(self.devices):
+                self._unregister(transport)
+            self.selector.close()
+
+    def get_metrics(self):
+        devices = list(self.devices.values())
+        return {
+            'devices': len(devices),
+            'connected': sum(1 for device in devices if device.switcher.connected),
+            'reconnects': self.reconnects.total,
+            'callback_errors': self.callback_errors.total,
+        }
+
+    def _register(self, device):
+        self.devices[device.transport] = device
+        self.selector.register(device.transport.sock, selectors.EVENT_READ, device)
+
+    def _unregister(self, transport):
+        if transport not in self.devices:
+            return
+        del self.devices[transport]
+        self.selector.unregister(transport.sock)
+        transport.sock.close()
+
+    def _run_calls(self):
+        while len(self.calls):
+            callback, args = self.calls.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                self.log.exception('Exception in supervisor call')
+
+    def _flush(self, transport):
+        device = self.devices.get(transport)
+        try:
+            transport.flush()
+        except OSError as e:
+            transport.outbox.clear()
+            if device is not None:
+                self._failed(device, time.monotonic(), str(e))
+
+    def _dispatch(self, device, packet):
+        try:
+            device.switcher.handle_packet(packet)
+        except Exception:
+            # A broken callback for one device should not stop the other devices
+            self.callback_errors.add()
+            self.log.exception(f'Exception while handling a packet from {device.transport.ip}')
+
+    def _read(self, device):
+        transport = device.transport
+        # Limit the packets per device per round so a busy device doesn't starve the others
+        for i in range(64):
+            try:
+                packet = transport._receive_packet_low()
+            except BlockingIOError:
+                break
+            except ValueError as e:
+                self.log.error(f'Invalid packet from {transport.ip}: {e}')
+                continue
+            except OSError as e:
+                # ICMP errors for unreachable devices end up here, the timeout will reconnect
+                self.log.debug(f'Receive error from {transport.ip}: {e}')
+                break
+            device.last_received = time.monotonic()
+            result = transport.process_packet(packet)
+            if transport.state == UdpProtocol.STATE_ESTABLISHED:
+                device.failures = 0
+            if result is not True:
+                self._dispatch(device, result)
+
+    def _check(self, now):
+        for device in list(self.devices.values()):
+            transport = device.transport
+            if device.next_attempt is not None:
+                if now >= device.next_attempt:
+                    device.next_attempt = None
+                    self.reconnects.add()
+                    transport.connect()
+            elif transport.state == UdpProtocol.STATE_SYN_SENT:
+                if now - transport.connect_started > self.connect_timeout:
+                    self._failed(device, now, 'no response to the handshake')
+            elif transport.state == UdpProtocol.STATE_ESTABLISHED:
+                if now - device.last_received > self.timeout:
+                    self._failed(device, now, 'timeout')
+
+    def _failed(self, device, now, reason):
+        transport = device.transport
+        delay = min(self.max_backoff, self.backoff * 2 ** device.failures)
+        device.failures += 1
+        device.next_attempt = now + delay
+        self.log.warning(f'Connection to {transport.ip} failed ({reason}), retrying in {delay:.0f}s')
+        transport.state = UdpProtocol.STATE_CLOSED
+        transport.had_traffic = False
+        transport.outbox.clear()
+        if device.switcher.connected:
+            self._dispatch(device, None)
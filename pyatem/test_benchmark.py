@@ -0,0 +1,27 @@
+# Copyright 2021 - 2022, Martijn Braam and the OpenAtem contributors
+# SPDX-License-Identifier: LGPL-3.0-only
+from unittest import TestCase
+
+from pyatem.benchmark import field_benchmarks, command_benchmarks, macro_benchmarks, Benchmark, compare
+from pyatem.protocol import AtemProtocol
+
+
+class Test(TestCase):
+    def test_benchmarks_run(self):
+        # Run every benchmark once so new fields and commands that break the suite are noticed
+        for benchmark in field_benchmarks() + command_benchmarks() + macro_benchmarks():
+            run, items = benchmark.setup()
+            run()
+            self.assertGreater(items, 0, benchmark.name)
+
+    def test_field_coverage(self):
+        names = [benchmark.name for benchmark in field_benchmarks()]
+        self.assertIn('decode.PrgI', names)
+        self.assertGreater(len(names), len(AtemProtocol.FIELDNAME_PRETTY) * 0.8)
+
+    def test_compare(self):
+        result = Benchmark('test', 'items/s', lambda: (lambda: None, 1)).measure(0.01)
+        self.assertGreater(result['rate'], 0)
+        old = {'results': {'a': {'rate': 100}, 'b': {'rate': 100}}}
+        new = {'results': {'a': {'rate': 90}, 'b': {'rate': 50}, 'c': {'rate': 1}}}
+        self.assertEqual([('b', 100, 50)], compare(old, new, 0.2))
@@ -0,0 +1,86 @@
+# Copyright 2021 - 2022, Martijn Braam and the OpenAtem contributors
+# SPDX-License-Identifier: LGPL-3.0-only
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from pyatem.capture import CaptureReader, CaptureWriter, ReplayTransport, KIND_TCP, start_recording, stop_recording
+from pyatem.command import ProgramInputCommand
+from pyatem.emulator import Emulator, default_dump, encode_field
+from pyatem.protocol import AtemProtocol
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _replay(self, path, **kwargs):
+        transport = ReplayTransport(path, **kwargs)
+        switcher = AtemProtocol(transport=transport)
+        events = []
+        switcher.on('connected', lambda: events.append('connected'))
+        switcher.on('change', lambda key, contents: events.append(key))
+        while not transport.finished:
+            switcher.loop()
+        return switcher, events
+
+    def test_file_format(self):
+        path = os.path.join(self.tempdir.name, 'test.cap.gz')
+        writer = CaptureWriter(path, KIND_TCP)
+        writer.write(b'one')
+        time.sleep(0.05)
+        writer.write(b'two')
+        writer.close()
+
+        reader = CaptureReader(path)
+        records = list(reader)
+        self.assertEqual(KIND_TCP, reader.kind)
+        self.assertEqual([b'one', b'two'], [data for timestamp, data in records])
+        self.assertGreaterEqual(records[1][0] - records[0][0], 0.05)
+
+    def test_replay_fields(self):
+        path = os.path.join(self.tempdir.name, 'test.cap')
+        writer = CaptureWriter(path, KIND_TCP)
+        fields = default_dump('Replay')
+        writer.write(b''.join(encode_field(name, raw) for name, raw in fields[:10]))
+        writer.write(b''.join(encode_field(name, raw) for name, raw in fields[10:]))
+        writer.close()
+
+        switcher, events = self._replay(path)
+        self.assertEqual('Replay', switcher.mixerstate['product-name'].name)
+        self.assertEqual(len(fields), len(events) - 1)
+        self.assertEqual('connected', events[-1])
+
+    def test_record_udp(self):
+        emulator = Emulator(meter_rate=0)
+        device = emulator.add_device(default_dump('Recorded'))
+        emulator.start()
+
+        path = os.path.join(self.tempdir.name, 'udp.cap')
+        switcher = AtemProtocol('127.0.0.1', device.port)
+        start_recording(switcher.transport, path)
+        connected = threading.Event()
+        switcher.on('connected', connected.set)
+        switcher.connect()
+
+        def loop():
+            while not connected.is_set() or switcher.mixerstate['program-bus-input'][0].source != 4:
+                switcher.loop()
+
+        thread = threading.Thread(target=loop, daemon=True)
+        thread.start()
+        self.assertTrue(connected.wait(5))
+        switcher.send_commands([ProgramInputCommand(0, 4)])
+        thread.join(5)
+        stop_recording(switcher.transport)
+        emulator.stop()
+
+        replayed, events = self._replay(path)
+        self.assertIn('connected', events)
+        self.assertEqual('Recorded', replayed.mixerstate['product-name'].name)
+        self.assertEqual(4, replayed.mixerstate['program-bus-input'][0].source)
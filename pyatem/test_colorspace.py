@@ -23,9 +23,7 @@ class Test(TestCase):
         Load a test fixture image with pillow and run through the atem frame encoder without compression
         """
         im = Image.open(path)
-        pixels = im.getdata()
-        flat = [item for sublist in pixels for item in sublist]
-        return bytes(flat)
+        return pyatem.media.rgba_buffer(im)
 
     def _decompose(self, raw):
         """
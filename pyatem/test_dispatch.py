@@ -0,0 +1,99 @@
+# Copyright 2021 - 2022, Martijn Braam and the OpenAtem contributors
+# SPDX-License-Identifier: LGPL-3.0-only
+import threading
+import time
+from unittest import TestCase
+
+from pyatem.dispatch import QueuedCallback, DROP_OLDEST, COALESCE, BLOCK
+from pyatem.emulator import default_dump, encode_field
+from pyatem.protocol import AtemProtocol
+from pyatem.transport import UdpProtocol
+
+
+class Test(TestCase):
+    def _blocked(self, policy, size=3, key=None):
+        """Create a QueuedCallback with a worker that is stuck in the first call until release is set"""
+        release = threading.Event()
+        started = threading.Event()
+        calls = []
+
+        def callback(value):
+            if not started.is_set():
+                started.set()
+                release.wait(5)
+            calls.append(value)
+
+        queued = QueuedCallback(callback, size=size, policy=policy, key=key)
+        self.addCleanup(queued.stop)
+        queued('first')
+        self.assertTrue(started.wait(5))
+        return queued, release, calls
+
+    def test_drop_oldest(self):
+        queued, release, calls = self._blocked(DROP_OLDEST)
+        for i in range(5):
+            queued(i)
+        release.set()
+        self.assertTrue(queued.join(5))
+        self.assertEqual(['first', 2, 3, 4], calls)
+        self.assertEqual(2, queued.get_metrics()['dropped'])
+
+    def test_coalesce(self):
+        queued, release, calls = self._blocked(COALESCE, key=lambda value: value[0])
+        for value in ['a1', 'b1', 'a2', 'c1', 'a3']:
+            queued(value)
+        release.set()
+        self.assertTrue(queued.join(5))
+        self.assertEqual(['first', 'a3', 'b1', 'c1'], calls)
+        metrics = queued.get_metrics()
+        self.assertEqual(2, metrics['coalesced'])
+        self.assertEqual(0, metrics['dropped'])
+
+    def test_block(self):
+        queued, release, calls = self._blocked(BLOCK, size=2)
+        queued(1)
+        queued(2)
+        done = threading.Event()
+
+        def producer():
+            queued(3)
+            done.set()
+
+        threading.Thread(target=producer, daemon=True).start()
+        self.assertFalse(done.wait(0.1))
+        release.set()
+        self.assertTrue(done.wait(5))
+        self.assertTrue(queued.join(5))
+        self.assertEqual(['first', 1, 2, 3], calls)
+
+    def test_on_queued(self):
+        switcher = AtemProtocol(transport=UdpProtocol('127.0.0.1'))
+        received = []
+        receiving = threading.Event()
+
+        def slow(key, contents):
+            receiving.wait(5)
+            received.append(key)
+
+        callback_id = switcher.on_queued('change', slow, policy=COALESCE, key=lambda key, contents: key)
+        changes = []
+        switcher.on('change', lambda key, contents: changes.append(key))
+        fields = default_dump()
+        data = b''.join(encode_field(name, raw) for name, raw in fields)
+        start = time.monotonic()
+        for i in range(10):
+            for fieldname, contents in switcher.decode_packet(data):
+                switcher.save_field_data(fieldname, contents)
+        # The slow callback doesn't block decoding
+        self.assertLess(time.monotonic() - start, 2)
+        receiving.set()
+        self.assertTrue(switcher.callbacks['change'][callback_id].join(5))
+
+        queue = switcher.get_metrics()['queues']['change/' + slow.__module__ + '.' + slow.__qualname__]
+        self.assertEqual(len(changes), queue['calls'])
+        self.assertGreater(queue['coalesced'], 0)
+        self.assertEqual(len(changes), queue['processed'] + queue['coalesced'])
+        self.assertEqual(set(changes), set(received))
+
+        switcher.off('change', callback_id)
+        self.assertNotIn('change/' + slow.__module__ + '.' + slow.__qualname__, switcher.get_metrics()['queues'])
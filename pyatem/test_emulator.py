@@ -0,0 +1,76 @@
+# Copyright 2021 - 2022, Martijn Braam and the OpenAtem contributors
+# SPDX-License-Identifier: LGPL-3.0-only
+import threading
+import time
+from unittest import TestCase
+
+from pyatem.command import ProgramInputCommand, CutCommand, SendAudioLevelsCommand
+from pyatem.emulator import Emulator, default_dump
+from pyatem.protocol import AtemProtocol
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.emulator = Emulator(meter_rate=20)
+        self.device = self.emulator.add_device(default_dump('Test switcher', inputs=4))
+        self.emulator.start()
+
+        self.events = []
+        self.switcher = AtemProtocol('127.0.0.1', self.device.port)
+        self.switcher.on('connected', lambda: self.events.append('connected'))
+        self.switcher.on('change', lambda key, contents: self.events.append(key))
+        self.switcher.on('upload-done', lambda store, slot: self.events.append('upload-done'))
+        self.switcher.on('download-done', lambda store, slot, data: self.events.append(data))
+        self.switcher.connect()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.running = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.running = False
+        self.emulator.stop()
+
+    def _loop(self):
+        while self.running:
+            self.switcher.loop()
+
+    def _wait(self, check, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if check():
+                return
+            time.sleep(0.01)
+        self.fail('Timeout waiting for the emulator')
+
+    def test_initial_state(self):
+        self._wait(lambda: 'connected' in self.events)
+        self.assertEqual('Test switcher', self.switcher.mixerstate['product-name'].name)
+        self.assertEqual(6, len(self.switcher.mixerstate['input-properties']))
+        self.assertEqual(1, self.switcher.mixerstate['program-bus-input'][0].source)
+
+    def test_commands(self):
+        self._wait(lambda: 'connected' in self.events)
+        self.switcher.send_commands([ProgramInputCommand(0, 3)])
+        self._wait(lambda: self.switcher.mixerstate['program-bus-input'][0].source == 3)
+        self.switcher.send_commands([CutCommand(0)])
+        self._wait(lambda: self.switcher.mixerstate['program-bus-input'][0].source == 2)
+        self.assertEqual(3, self.switcher.mixerstate['preview-bus-input'][0].source)
+
+    def test_meters(self):
+        self._wait(lambda: 'connected' in self.events)
+        self.assertNotIn('audio-meter-levels', self.events)
+        self.switcher.send_commands([SendAudioLevelsCommand(True)])
+        self._wait(lambda: self.events.count('audio-meter-levels') > 5)
+        self.assertEqual(5, len(self.switcher.mixerstate['audio-meter-levels'].input))
+
+    def test_transfer(self):
+        self._wait(lambda: 'connected' in self.events)
+        data = bytes(i % 251 for i in range(64 * 1024))
+        self.switcher.upload(0, 2, data)
+        self._wait(lambda: 'upload-done' in self.events)
+        self.assertEqual(data, self.device.stored[(0, 2)])
+        self.switcher.download(0, 2)
+        self._wait(lambda: data in self.events)
+        transfer = self.switcher.get_metrics()['transfer']
+        self.assertGreater(transfer['bytes_out'], 0)
+        self.assertGreater(transfer['bytes_in'], 0)
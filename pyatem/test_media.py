@@ -1,10 +1,16 @@
 # Copyright 2021 - 2022, Martijn Braam and the OpenAtem contributors
 # SPDX-License-Identifier: LGPL-3.0-only
+import hashlib
+import os
+import tempfile
 from unittest import TestCase
 
 from pyatem.hexdump import hexdump
-from pyatem.media import rle_decode, rle_encode, atem_to_image, image_to_atem, rgb_to_atem
+from pyatem.media import rle_decode, rle_encode, atem_to_image, image_to_atem, rgb_to_atem, rgba_buffer, \
+    EncodedFrame, load_atem_file
 from pyatem.mediaconvert import atem_to_rgb
+from pyatem.protocol import AtemProtocol
+from pyatem.transfer import StreamingTransferTask
 
 
 class Test(TestCase):
@@ -43,3 +49,61 @@ class Test(TestCase):
         compressed = rle_encode(testframe)
         decompressed = rle_decode(compressed)
         self.assertEqual(testframe, decompressed)
+
+    def test_rgba_buffer(self):
+        frame = bytes(range(64))
+        self.assertIs(frame, rgba_buffer(frame))
+        self.assertEqual(frame, bytes(rgba_buffer(memoryview(frame))))
+
+        # Non-contiguous buffers get packed
+        strided = memoryview(frame * 2)[::2]
+        self.assertEqual(bytes(strided), bytes(rgba_buffer(strided)))
+
+        self.assertEqual(rgb_to_atem(frame, 4, 4), rgb_to_atem(bytearray(frame), 4, 4))
+
+    def test_streaming_upload_task(self):
+        width, height = 64, 36
+        frame = bytes((x * 7 + y * 3) % 256 for y in range(height) for x in range(width * 4))
+        reference = rgb_to_atem(frame, width, height)
+
+        task = StreamingTransferTask(0, 0, frame, width, height, band_height=5, queue_size=2)
+        data = b''
+        while True:
+            task.fill(100)
+            if len(task.data) == 0:
+                break
+            data += task.data[0:100]
+            task.data = task.data[100:]
+
+        self.assertEqual(reference, rle_decode(data))
+        self.assertEqual(hashlib.md5(reference).digest(), task.hash)
+        self.assertEqual(len(reference), task.data_length)
+        self.assertEqual(len(data), task.send_length)
+
+    def test_encoded_frame_file(self):
+        uncompressed = rle_decode(self.FRAME_1080_RED)
+        frame = EncodedFrame(self.FRAME_1080_RED, len(uncompressed), hashlib.md5(uncompressed).digest(), 1920, 1080,
+                             name='Red')
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'red.atem')
+            frame.save(path)
+            loaded = load_atem_file(path)
+            self.assertEqual(self.FRAME_1080_RED, loaded.data)
+            self.assertEqual(frame.hash, loaded.hash)
+            self.assertEqual(len(uncompressed), loaded.data_length)
+            self.assertEqual((1920, 1080), (loaded.width, loaded.height))
+            self.assertEqual('Red', loaded.name)
+            self.assertIsNone(loaded.description)
+
+            # Uploading a pre-encoded frame uses the stored metadata as-is
+            switcher = AtemProtocol('127.0.0.1')
+            switcher.upload(0, 3, loaded)
+            task = switcher.transfer_queue[0][0]
+            self.assertIs(loaded.data, task.data)
+            self.assertEqual(loaded.hash, task.hash)
+            self.assertEqual(len(uncompressed), task.data_length)
+            self.assertEqual(len(self.FRAME_1080_RED), task.send_length)
+            self.assertEqual('Red', task.name)
+            switcher.transfer_queue = {}
+            del task
+            loaded.close()
@@ -0,0 +1,90 @@
+# Copyright 2021 - 2022, Martijn Braam and the OpenAtem contributors
+# SPDX-License-Identifier: LGPL-3.0-only
+import threading
+import time
+from unittest import TestCase
+
+from pyatem.command import ProgramInputCommand
+from pyatem.emulator import Emulator, default_dump, encode_field
+from pyatem.metrics import Histogram
+from pyatem.protocol import AtemProtocol
+from pyatem.transport import UdpProtocol
+
+
+class Test(TestCase):
+    def test_histogram(self):
+        histogram = Histogram((1, 2, 5, 10))
+        self.assertIsNone(histogram.percentile(0.5))
+        for value in [0.5, 1.5, 1.5, 3, 4, 20]:
+            histogram.observe(value)
+        self.assertEqual(6, histogram.count)
+        self.assertEqual(30.5, histogram.sum)
+        self.assertEqual(2, histogram.percentile(0.5))
+        self.assertEqual(5, histogram.percentile(0.8))
+        self.assertEqual(20, histogram.percentile(0.99))
+        self.assertEqual([(1, 1), (2, 3), (5, 5), (10, 5), (float('inf'), 6)], histogram.cumulative())
+
+    def test_callback_profiler(self):
+        switcher = AtemProtocol(transport=UdpProtocol('127.0.0.1'))
+        switcher.on('change', lambda key, contents: None)
+
+        def slow(contents):
+            time.sleep(0.002)
+
+        switcher.on('change:program-bus-input:0', slow)
+        with self.assertLogs('CallbackProfiler', 'WARNING'):
+            switcher.enable_profiling(budget=0.001)
+            data = b''.join(encode_field(name, raw) for name, raw in default_dump())
+            for i in range(2):
+                for fieldname, contents in switcher.decode_packet(data):
+                    switcher.save_field_data(fieldname, contents)
+
+        report = switcher.profiler.report()
+        self.assertEqual('change:program-bus-input:0', report[0]['event'])
+        self.assertTrue(report[0]['callback'].endswith('.slow'))
+        self.assertEqual(2, report[0]['count'])
+        self.assertEqual(2, report[0]['over_budget'])
+        self.assertGreaterEqual(report[0]['p50'], 0.002)
+        self.assertEqual('change', report[1]['event'])
+        self.assertEqual(0, report[1]['over_budget'])
+
+    def test_link_quality_without_traffic(self):
+        self.assertEqual(100, UdpProtocol('127.0.0.1').get_link_quality())
+
+    def test_udp_metrics(self):
+        emulator = Emulator(meter_rate=0)
+        device = emulator.add_device()
+        emulator.start()
+        self.addCleanup(emulator.stop)
+
+        switcher = AtemProtocol('127.0.0.1', device.port)
+        changes = []
+        switcher.on('change:program-bus-input:0', lambda field: changes.append(field.source))
+        switcher.enable_profiling()
+        switcher.connect()
+        running = True
+
+        def loop():
+            while running:
+                switcher.loop()
+
+        thread = threading.Thread(target=loop, daemon=True)
+        thread.start()
+        deadline = time.monotonic() + 5
+        while not switcher.connected and time.monotonic() < deadline:
+            time.sleep(0.01)
+        switcher.send_commands([ProgramInputCommand(0, 3)])
+        while 3 not in changes and time.monotonic() < deadline:
+            time.sleep(0.01)
+        running = False
+
+        metrics = switcher.get_metrics()
+        transport = metrics['transport']
+        self.assertTrue(metrics['connected'])
+        self.assertGreater(transport['bytes_in'], 0)
+        self.assertGreater(transport['packets_out'], 2)
+        self.assertGreaterEqual(transport['rtt']['count'], 1)
+        self.assertEqual(0, transport['retransmissions'])
+        self.assertEqual(0, transport['receive_backlog'])
+        self.assertIn('change:program-bus-input:0', metrics['callbacks'])
+        self.assertEqual(100, transport['link_quality'])
@@ -0,0 +1,82 @@
+# Copyright 2021 - 2022, Martijn Braam and the OpenAtem contributors
+# SPDX-License-Identifier: LGPL-3.0-only
+import struct
+from unittest import TestCase
+
+from pyatem.emulator import default_dump, encode_field
+from pyatem.protocol import AtemProtocol
+from pyatem.transport import BaseProtocol, ConnectionReady, Packet
+
+
+class CaptureTransport(BaseProtocol):
+    def send_packet(self, packet):
+        pass
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.switcher = AtemProtocol(transport=CaptureTransport())
+        self.events = []
+        self.switcher.on('connected', lambda: self.events.append('connected'))
+        self.switcher.on('disconnected', lambda: self.events.append('disconnected'))
+        self.switcher.on('change', lambda key, contents: self.events.append(key))
+        self.switcher.on('resynced', lambda removed: self.events.append(('resynced', removed)))
+        self.feed(default_dump(inputs=4))
+        self.events.clear()
+
+    def feed(self, fields, ready=True):
+        # The dump is split over multiple packets like the hardware does
+        for i in range(0, len(fields), 4):
+            packet = Packet()
+            packet.data = b''.join(encode_field(name, raw) for name, raw in fields[i:i + 4])
+            self.switcher.handle_packet(packet)
+        if ready:
+            self.switcher.handle_packet(ConnectionReady())
+
+    def dump(self, program=1):
+        # Input 4 is gone and the program bus changed
+        fields = []
+        for name, raw in default_dump(inputs=4):
+            if name == b'InPr' and struct.unpack_from('>H', raw)[0] == 4:
+                continue
+            if name == b'PrgI':
+                raw = struct.pack('>BxH', 0, program)
+            fields.append((name, raw))
+        return fields
+
+    def test_resync(self):
+        self.switcher.handle_packet(None)
+        self.assertTrue(self.switcher.resyncing)
+        self.feed(self.dump(program=3))
+
+        # Unchanged fields are not raised, changed fields are raised and the removed fields are listed
+        self.assertEqual(['disconnected', 'program-bus-input', ('resynced', [('input-properties', 4)]), 'InCm',
+                          'connected'], self.events)
+        self.assertFalse(self.switcher.resyncing)
+        self.assertEqual(3, self.switcher.mixerstate['program-bus-input'][0].source)
+        self.assertNotIn(4, self.switcher.mixerstate['input-properties'])
+        self.assertIn(3, self.switcher.mixerstate['input-properties'])
+
+    def test_nothing_changed(self):
+        self.switcher.handle_packet(None)
+        self.feed(default_dump(inputs=4))
+        self.assertEqual(['disconnected', ('resynced', []), 'InCm', 'connected'], self.events)
+
+    def test_disconnect_during_resync(self):
+        self.switcher.handle_packet(None)
+        dump = self.dump(program=3)
+        incomplete = [field for field in dump if field[0] not in (b'AuxS', b'InCm')]
+        self.feed(incomplete, ready=False)
+        self.assertIn('program-bus-input', self.events)
+        self.switcher.handle_packet(None)
+
+        # Nothing is removed based on an incomplete dump
+        self.assertNotIn(('resynced', []), self.events)
+        self.assertIn(4, self.switcher.mixerstate['input-properties'])
+        self.assertTrue(self.switcher.resyncing)
+
+        # The fields from the incomplete dump are already part of the state and not raised again
+        self.events.clear()
+        self.feed(dump)
+        self.assertEqual([('resynced', [('input-properties', 4)]), 'InCm', 'connected'], self.events)
+        self.assertNotIn(4, self.switcher.mixerstate['input-properties'])
@@ -0,0 +1,81 @@
+# Copyright 2021 - 2022, Martijn Braam and the OpenAtem contributors
+# SPDX-License-Identifier: LGPL-3.0-only
+import threading
+import time
+from unittest import TestCase
+
+from pyatem.command import ProgramInputCommand
+from pyatem.emulator import Emulator, default_dump
+from pyatem.supervisor import Supervisor
+
+
+class Test(TestCase):
+    def _wait(self, check, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if check():
+                return
+            time.sleep(0.01)
+        self.fail('Timeout waiting for the supervisor')
+
+    def test_devices(self):
+        emulator = Emulator(meter_rate=0)
+        devices = [emulator.add_device(default_dump(f'Switcher {i}')) for i in range(10)]
+        emulator.start()
+        self.addCleanup(emulator.stop)
+
+        threads = threading.active_count()
+        supervisor = Supervisor()
+        switchers = [supervisor.add('127.0.0.1', device.port) for device in devices]
+        for switcher in switchers:
+            switcher.connect()
+        supervisor.start()
+        self.addCleanup(supervisor.stop)
+
+        self._wait(lambda: all(switcher.connected for switcher in switchers))
+        self.assertEqual(threads + 1, threading.active_count())
+        for i, switcher in enumerate(switchers):
+            self.assertEqual(f'Switcher {i}', switcher.mixerstate['product-name'].name)
+
+        switchers[3].send_commands([ProgramInputCommand(0, 4)])
+        self._wait(lambda: switchers[3].mixerstate['program-bus-input'][0].source == 4)
+        self.assertEqual(1, switchers[4].mixerstate['program-bus-input'][0].source)
+        self.assertEqual(10, supervisor.get_metrics()['connected'])
+
+    def test_reconnect(self):
+        emulator = Emulator(meter_rate=0)
+        device = emulator.add_device(default_dump('First'))
+        emulator.start()
+        port = device.port
+
+        supervisor = Supervisor(timeout=0.5, connect_timeout=0.5, backoff=0.1)
+        switcher = supervisor.add('127.0.0.1', port)
+        events = []
+        switcher.on('connected', lambda: events.append('connected'))
+        switcher.on('disconnected', lambda: events.append('disconnected'))
+        switcher.on('change', lambda key, contents: events.append(key))
+        switcher.on('resynced', lambda removed: events.append(('resynced', removed)))
+        switcher.connect()
+        supervisor.start()
+        self.addCleanup(supervisor.stop)
+        self._wait(lambda: 'connected' in events)
+
+        emulator.stop()
+        self._wait(lambda: 'disconnected' in events)
+
+        emulator = Emulator(meter_rate=0)
+        emulator.add_device(default_dump('Second', inputs=6), port=port)
+        emulator.start()
+        self.addCleanup(emulator.stop)
+        self._wait(lambda: events.count('connected') == 2)
+        self.assertEqual('Second', switcher.mixerstate['product-name'].name)
+
+        # Only the differences with the state before the disconnect are raised
+        resync = events[events.index('disconnected') + 1:events.index('connected', events.index('disconnected'))]
+        self.assertEqual(['product-name', 'topology', 'InCm'], [event for event in resync if isinstance(event, str)])
+        resynced = [event[1] for event in resync if isinstance(event, tuple)]
+        self.assertEqual(1, len(resynced))
+        self.assertIn(('input-properties', 8), resynced[0])
+        self.assertNotIn(8, switcher.mixerstate['input-properties'])
+        self.assertIn(6, switcher.mixerstate['input-properties'])
+        self.assertGreaterEqual(supervisor.get_metrics()['reconnects'], 1)
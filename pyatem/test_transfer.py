@@ -0,0 +1,266 @@
+# Copyright 2021 - 2022, Martijn Braam and the OpenAtem contributors
+# SPDX-License-Identifier: LGPL-3.0-only
+import collections
+import hashlib
+import struct
+import threading
+import time
+from unittest import TestCase
+
+from pyatem.media import rle_decode, rle_encode, rgb_to_atem, EncodedFrame
+from pyatem.protocol import AtemProtocol
+from pyatem.transfer import StreamingTransferTask, TransferQueueFlushed
+from pyatem.transport import BaseProtocol, Packet
+
+
+class FakeSwitcherTransport(BaseProtocol):
+    """
+    Transport that emulates the media pool of a switcher. It implements partial locking and the
+    FTSD -> FTCD -> FTDa -> FTFD -> FTDC upload flow. The lock of a clip store ends with the transfer of a frame,
+    the lock of the stills stays until it's released with LOCK.
+    """
+
+    CHUNK_SIZE = 1000
+    CHUNK_COUNT = 4
+
+    def __init__(self):
+        super().__init__()
+        self.inbox = collections.deque()
+        self.locks = set()
+        self.transfers = {}
+        self.stored = {}
+        self.commands = []
+
+    def pending(self):
+        return len(self.inbox) > 0 or len(self.send_queue) > 0 or self.queue_enabled
+
+    def respond(self, *fields):
+        data = b''
+        for name, raw in fields:
+            data += struct.pack('!H2x 4s', len(raw) + 8, name) + raw
+        packet = Packet()
+        packet.data = data
+        self.inbox.append(packet)
+
+    def receive_packet(self):
+        if self.queue_trigger():
+            return TransferQueueFlushed()
+        if len(self.inbox):
+            return self.inbox.popleft()
+
+    def send_packet(self, packet):
+        self._send_packet(packet)
+
+    def _send_packet(self, packet):
+        offset = 0
+        while offset < len(packet.data):
+            length, name = struct.unpack_from('!H2x 4s', packet.data, offset)
+            self.handle(name.decode(), bytes(packet.data[offset + 8:offset + length]))
+            offset += length
+
+    def handle(self, name, raw):
+        self.commands.append(name)
+        if name == 'PLCK':
+            store, = struct.unpack_from('>H', raw)
+            self.locks.add(store)
+            self.respond((b'LKST', struct.pack('>H?x', store, True)), (b'LKOB', struct.pack('>H2x', store)))
+        elif name == 'LOCK':
+            store, state = struct.unpack_from('>H?', raw)
+            if not state and store in self.locks:
+                self.locks.discard(store)
+                self.respond((b'LKST', struct.pack('>H?x', store, False)))
+        elif name == 'FTSD':
+            tid, store, slot, length, mode = struct.unpack('>HHxxHIHxx', raw)
+            if store not in self.locks:
+                self.respond((b'FTDE', struct.pack('>HBx', tid, 5)))
+                return
+            self.transfers[tid] = [store, slot, length, b'', 0]
+            self._continue(tid)
+        elif name == 'FTDa':
+            tid, size = struct.unpack_from('>HH', raw)
+            transfer = self.transfers[tid]
+            transfer[3] += raw[4:4 + size]
+            transfer[4] += 1
+            if transfer[4] % self.CHUNK_COUNT == 0:
+                self._continue(tid)
+        elif name == 'FTFD':
+            tid, = struct.unpack_from('>H', raw)
+            hash = raw[194:210]
+            store, slot, length, data, _ = self.transfers.pop(tid)
+            decoded = rle_decode(data)
+            if len(decoded) != length or hashlib.md5(decoded).digest() != hash:
+                # The hardware does not respond at all on a hash mismatch
+                return
+            self.stored[(store, slot)] = decoded
+            self.respond((b'FTDC', struct.pack('>HBB', tid, 1, 2)))
+            if store > 0:
+                self.locks.discard(store)
+                self.respond((b'LKST', struct.pack('>H?x', store, False)))
+
+    def _continue(self, tid):
+        self.respond((b'FTCD', struct.pack('>H 4x HH 2x', tid, self.CHUNK_SIZE, self.CHUNK_COUNT)))
+
+
+class BrokenImage:
+    """Image that fails to decode, looks like a PIL image to rgba_buffer()"""
+    mode = 'RGBA'
+
+    def getdata(self):
+        pass
+
+    def tobytes(self):
+        raise OSError('broken image')
+
+
+class Test(TestCase):
+    WIDTH = 32
+    HEIGHT = 20
+
+    def setUp(self):
+        self.switcher = AtemProtocol('127.0.0.1')
+        self.transport = FakeSwitcherTransport()
+        self.transport.queue_callback = self.switcher.queue_callback
+        self.switcher.transport = self.transport
+
+    def _run(self, timeout=10):
+        # Clip frames are prepared on another thread, wait for them while the transport is idle
+        deadline = time.monotonic() + timeout
+        longest = 0
+        while self.transport.pending() or len(self.switcher.clip_uploads):
+            self.assertLess(time.monotonic(), deadline)
+            if not self.transport.pending():
+                time.sleep(0.001)
+                continue
+            start = time.monotonic()
+            self.switcher.loop()
+            longest = max(longest, time.monotonic() - start)
+        return longest
+
+    def _frame(self, seed):
+        return bytes((seed * 31 + i * 7) % 256 for i in range(self.WIDTH * self.HEIGHT * 4))
+
+    def test_clip_upload(self):
+        progress = []
+        done = []
+        self.switcher.on('clip-upload-progress', lambda *args: progress.append(args))
+        self.switcher.on('clip-upload-done', lambda index: done.append(index))
+
+        frames = [self._frame(i) for i in range(5)]
+        self.switcher.upload_clip(1, iter(frames), self.WIDTH, self.HEIGHT, name='Test', frame_count=len(frames))
+        self._run()
+
+        self.assertEqual([1], done)
+        self.assertEqual('CMPC', self.transport.commands[0])
+        self.assertEqual('SMPC', self.transport.commands[-1])
+        self.assertNotIn('LOCK', self.transport.commands)
+        self.assertEqual(len(frames), self.transport.commands.count('PLCK'))
+        self.assertEqual(['PLCK', 'FTSD'], self.transport.commands[1:3])
+        for i, frame in enumerate(frames):
+            self.assertEqual(rgb_to_atem(frame, self.WIDTH, self.HEIGHT), self.transport.stored[(2, i)])
+        self.assertEqual((1, 5, 5, 100.0), progress[-1])
+        self.assertEqual({}, self.switcher.clip_uploads)
+
+    def test_clip_upload_slow_frames(self):
+        def frames():
+            for i in range(3):
+                # Reading the next frame from disk or decoding it takes a while
+                time.sleep(0.2)
+                yield self._frame(i)
+
+        errors = []
+        self.switcher.on('clip-upload-error', lambda index, error: errors.append(error))
+        self.switcher.upload_clip(0, frames(), self.WIDTH, self.HEIGHT)
+        longest = self._run()
+
+        # The protocol thread never waits for the iterator
+        self.assertLess(longest, 0.1)
+        self.assertEqual([], errors)
+        for i in range(3):
+            self.assertEqual(rgb_to_atem(self._frame(i), self.WIDTH, self.HEIGHT), self.transport.stored[(1, i)])
+
+    def test_clip_upload_iterator_error(self):
+        def frames():
+            yield self._frame(0)
+            raise OSError('broken file')
+
+        errors = []
+        self.switcher.on('clip-upload-error', lambda index, error: errors.append((index, str(error))))
+        self.switcher.upload_clip(2, frames(), self.WIDTH, self.HEIGHT)
+        self._run()
+
+        self.assertEqual([(2, 'broken file')], errors)
+        self.assertIn((3, 0), self.transport.stored)
+        self.assertEqual({}, self.switcher.clip_uploads)
+
+    def test_clip_upload_encoded(self):
+        frames = []
+        for i in range(3):
+            data = rgb_to_atem(self._frame(i), self.WIDTH, self.HEIGHT)
+            frames.append(EncodedFrame(rle_encode(data), len(data), hashlib.md5(data).digest(), self.WIDTH,
+                                       self.HEIGHT))
+
+        self.switcher.upload_clip(0, frames, self.WIDTH, self.HEIGHT)
+        self._run()
+
+        for i, frame in enumerate(frames):
+            self.assertEqual(rle_decode(frame.data), self.transport.stored[(1, i)])
+
+    def test_still_upload_lock(self):
+        # Stills that are uploaded one after the other share a single lock that is released after the last one
+        def next_still(store, slot):
+            if slot < 2:
+                self.switcher.upload(0, slot + 1, self._frame(slot + 1))
+
+        self.switcher.on('upload-done', next_still)
+        self.switcher.upload(0, 0, self._frame(0))
+        self._run()
+
+        self.assertEqual(1, self.transport.commands.count('PLCK'))
+        self.assertEqual('LOCK', self.transport.commands[-1])
+        self.assertEqual(set(), self.transport.locks)
+        for i in range(3):
+            self.assertEqual(self._frame(i), self.transport.stored[(0, i)])
+
+    def test_stream_error(self):
+        task = StreamingTransferTask(0, 0, BrokenImage(), self.WIDTH, self.HEIGHT)
+        errors = []
+
+        def fill():
+            try:
+                task.fill()
+            except OSError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=fill, daemon=True)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), 'fill() blocked after the encoder failed')
+        self.assertEqual(['broken image'], [str(e) for e in errors])
+
+        # The error is raised again instead of waiting for bands that never come
+        self.assertRaises(OSError, task.fill, 1)
+
+    def test_stream_error_upload(self):
+        events = []
+        self.switcher.on('upload-error', lambda store, slot, error: events.append(('error', store, slot, str(error))))
+        self.switcher.on('upload-done', lambda store, slot: events.append(('done', store, slot)))
+
+        # A frame that fails to convert is skipped and the next upload in the queue still runs
+        self.switcher.upload_stream(0, 0, BrokenImage(), self.WIDTH, self.HEIGHT)
+        self.switcher.upload_stream(0, 1, self._frame(1), self.WIDTH, self.HEIGHT)
+        self._run()
+
+        self.assertEqual([('error', 0, 0, 'broken image'), ('done', 0, 1)], events)
+        self.assertNotIn((0, 0), self.transport.stored)
+        self.assertEqual(rgb_to_atem(self._frame(1), self.WIDTH, self.HEIGHT), self.transport.stored[(0, 1)])
+        self.assertEqual([], self.switcher.transfer_queue[0])
+
+    def test_clip_frame_error(self):
+        errors = []
+        self.switcher.on('clip-upload-error', lambda index, error: errors.append((index, str(error))))
+        self.switcher.upload_clip(0, [self._frame(0), BrokenImage(), self._frame(2)], self.WIDTH, self.HEIGHT)
+        self._run()
+
+        self.assertEqual([(0, 'broken image')], errors)
+        self.assertEqual([(1, 0)], list(self.transport.stored))
+        self.assertEqual({}, self.switcher.clip_uploads)
@@ -1,9 +1,11 @@
 # Copyright 2021 - 2022, Martijn Braam and the OpenAtem contributors
 # SPDX-License-Identifier: LGPL-3.0-only
 import hashlib
+import queue
 import struct
+import threading
 
-from pyatem.media import rle_encode
+from pyatem.media import rle_encode, rgb_to_atem, rgba_buffer, EncodedFrame
 
 
 class TransferTask:
@@ -35,6 +37,21 @@ class TransferTask:
         self.data = compressed
         self.send_length = len(self.data)
 
+    def fill(self, size=None):
+        # All data is already in the buffer for regular transfers
+        pass
+
+    @classmethod
+    def from_encoded_frame(cls, store, slot, frame):
+        self = cls(store, slot, upload=True)
+        self.data = frame.data
+        self.send_length = len(frame.data)
+        self.data_length = frame.data_length
+        self.hash = frame.hash
+        self.name = frame.name
+        self.description = frame.description
+        return self
+
     def __repr__(self):
         direction = 'upload' if self.upload else 'download'
         return f'<TransferTask {direction} store={self.store} slot={self.slot}>'
@@ -73,6 +90,198 @@ class TransferTask:
         return self
 
 
+class StreamingTransferTask(TransferTask):
+    """
+    Upload task that takes an RGBA frame and converts, hashes and compresses it in bands of rows in a background
+    thread. The compressed bands are buffered in a bounded queue so the first chunks can be sent while the rest
+    of the frame is still being processed.
+    """
+
+    def __init__(self, store, slot, data, width, height, premultiply=False, band_height=16, queue_size=8):
+        super().__init__(store, slot, upload=True)
+        self.source = data
+        self.width = width
+        self.height = height
+        self.premultiply = premultiply
+        self.band_height = band_height
+
+        self.data = b''
+        self.data_length = width * height * 4
+
+        # The compressed size is only known after the last band, until then use the uncompressed size since
+        # the RLE encoder never makes data larger
+        self.send_length = self.data_length
+
+        self.bands = queue.Queue(maxsize=queue_size)
+        self.finished = False
+        self.error = None
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(None, self._encode_thread, "atem-encode", daemon=True)
+        self.thread.start()
+
+    def _encode_thread(self):
+        try:
+            hasher = hashlib.md5()
+            source = memoryview(rgba_buffer(self.source)).cast('B')
+            stride = self.width * 4
+            compressed_length = 0
+            for row in range(0, self.height, self.band_height):
+                rows = min(self.band_height, self.height - row)
+                band = rgb_to_atem(source[row * stride:(row + rows) * stride], self.width, rows, self.premultiply)
+                hasher.update(band)
+                band = rle_encode(band)
+                compressed_length += len(band)
+                self.bands.put(band)
+        except Exception as e:
+            # Hand the error to fill() instead of leaving it waiting for the next band
+            self.source = None
+            self.bands.put(e)
+            return
+
+        self.hash = hasher.digest()
+        self.send_length = compressed_length
+        self.source = None
+        self.bands.put(None)
+
+    def fill(self, size=None):
+        """
+        Make sure at least `size` bytes of compressed data are buffered, or everything when size is None. This
+        blocks until the encoder thread has produced enough data. Errors from encoding the frame are raised here.
+        """
+        self.start()
+        if self.error is not None:
+            raise self.error
+        while not self.finished and (size is None or len(self.data) < size):
+            band = self.bands.get()
+            if band is None:
+                self.finished = True
+                break
+            if isinstance(band, Exception):
+                self.error = band
+                raise band
+            self.data += band
+
+    def __repr__(self):
+        return f'<StreamingTransferTask upload store={self.store} slot={self.slot}>'
+
+
+class ClipUpload:
+    """
+    Upload of a sequence of frames to a clip in the media pool. Frames are pulled from the iterator one at a time on a
+    prefetch thread so a slow iterator never blocks the thread handling the switcher connection. The frame after the
+    one that is being transferred is already being encoded in the background so at most two frames are held in memory.
+
+    The frames can be RGBA8888 images in any format accepted by rgba_buffer() or pre-encoded EncodedFrame objects.
+    """
+
+    # Returned by next_task() when the prefetch thread hasn't finished the next frame yet
+    PENDING = object()
+
+    def __init__(self, index, frames, width, height, name=None, premultiply=False, frame_count=None):
+        self.index = index
+        self.store = index + 1
+        self.width = width
+        self.height = height
+        self.name = name
+        self.premultiply = premultiply
+
+        if frame_count is None and hasattr(frames, '__len__'):
+            frame_count = len(frames)
+        self.frame_count = frame_count
+        self.frames = iter(frames)
+        self.frames_done = 0
+        self.position = 0
+
+        self.tasks = queue.Queue(maxsize=1)
+        self.lock = threading.Lock()
+        self.waiting = False
+        self.stopped = False
+        self.on_ready = None
+        self.thread = None
+
+    def start(self, on_ready):
+        """
+        Start pulling frames on the prefetch thread. When next_task() returned PENDING the on_ready(clip) callback
+        is called from the prefetch thread once the next task is available.
+        """
+        self.on_ready = on_ready
+        self.thread = threading.Thread(None, self._prefetch_thread, "atem-clip", daemon=True)
+        self.thread.start()
+
+    def _prefetch_thread(self):
+        while not self.stopped:
+            try:
+                task = self._prepare()
+            except Exception as e:
+                task = e
+            self.tasks.put(task)
+            with self.lock:
+                notify = self.waiting
+                self.waiting = False
+            if notify:
+                self.on_ready(self)
+            if task is None or isinstance(task, Exception) or self.stopped:
+                return
+            # Only pull the frame after this one when this task has been taken for transfer
+            self.tasks.join()
+
+    def stop(self):
+        """Stop pulling frames, the iterator is left at the frame that was being prepared"""
+        self.stopped = True
+        try:
+            self.tasks.get_nowait()
+            self.tasks.task_done()
+        except queue.Empty:
+            pass
+
+    def next_task(self):
+        """
+        Get the upload task for the next frame without blocking. Returns PENDING when the frame isn't ready yet,
+        None at the end of the clip and raises the exception when the frame iterator failed.
+        """
+        with self.lock:
+            try:
+                task = self.tasks.get_nowait()
+            except queue.Empty:
+                self.waiting = True
+                return ClipUpload.PENDING
+        self.tasks.task_done()
+        if isinstance(task, Exception):
+            raise task
+        return task
+
+    def _prepare(self):
+        try:
+            frame = next(self.frames)
+        except StopIteration:
+            return None
+
+        slot = self.position
+        self.position += 1
+        if isinstance(frame, EncodedFrame):
+            return TransferTask.from_encoded_frame(self.store, slot, frame)
+
+        # Buffer the whole frame so it's completely encoded by the time the previous frame is done
+        bands = -(-self.height // 16) + 1
+        task = StreamingTransferTask(self.store, slot, frame, self.width, self.height, premultiply=self.premultiply,
+                                     band_height=16, queue_size=bands)
+        task.start()
+        return task
+
+    def get_progress(self, fraction=0.0):
+        """Progress of the whole clip in percent, or None if the number of frames is unknown"""
+        if not self.frame_count:
+            return None
+        return min(100.0, (self.frames_done + fraction) / self.frame_count * 100)
+
+    def __repr__(self):
+        return f'<ClipUpload clip={self.index} frames={self.frames_done}/{self.frame_count}>'
+
+
 class TransferQueueFlushed:
     def __init__(self):
         pass
@@ -13,6 +13,7 @@ import threading
 import usb.core
 import usb.util
 
+from pyatem.metrics import Counter, Histogram
 from pyatem.socketqueue import SocketQueue
 from pyatem.transfer import TransferQueueFlushed, TransferTask
 
@@ -128,6 +129,17 @@ class BaseProtocol:
         self.batch_size = 1
         self.batch_delay = 0
 
+        # CaptureWriter that gets every received packet, see pyatem.capture
+        self.recorder = None
+
+        self.bytes_in = Counter()
+        self.bytes_out = Counter()
+        self.packets_in = Counter()
+        self.packets_out = Counter()
+        self.retransmissions = Counter()
+        self.retransmission_requests = Counter()
+        self.rtt = Histogram()
+
     def _send_packet(self, packet):
         raise NotImplementedError()
 
@@ -151,6 +163,26 @@ class BaseProtocol:
     def get_link_quality(self):
         return 100
 
+    def get_metrics(self):
+        """
+        Get the counters of the transport. Rates are in units per second, times in seconds.
+        """
+        return {
+            'link_quality': self.get_link_quality(),
+            'bytes_in': self.bytes_in.total,
+            'bytes_out': self.bytes_out.total,
+            'bytes_in_rate': self.bytes_in.rate(),
+            'bytes_out_rate': self.bytes_out.rate(),
+            'packets_in': self.packets_in.total,
+            'packets_out': self.packets_out.total,
+            'packets_in_rate': self.packets_in.rate(),
+            'packets_out_rate': self.packets_out.rate(),
+            'retransmissions': self.retransmissions.total,
+            'retransmission_requests': self.retransmission_requests.total,
+            'send_queue': len(self.send_queue),
+            'rtt': self.rtt.to_dict(),
+        }
+
 
 class UdpProtocol(BaseProtocol):
     STATE_CLOSED = 0
@@ -173,8 +205,6 @@ class UdpProtocol(BaseProtocol):
         self.sock.settimeout(5)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024 * 16)
 
-        self.thread = threading.Thread(None, self._udp_thread, "atem-udp", daemon=True)
-
         self.local_sequence_number = 0
         self.local_ack_number = 0
         self.remote_sequence_number = 0
@@ -189,8 +219,10 @@ class UdpProtocol(BaseProtocol):
         self.received_packets = collections.deque(maxlen=1024)
         self.retransmission_buffer = {}
 
-        self.thread_queue = SocketQueue()
-        self.thread_recv_queue = Queue()
+        # Send time of the reliable packets that haven't been acknowledged yet, for the round trip time
+        self.ack_pending = collections.OrderedDict()
+
+        self._setup_thread()
 
         self.batch_size = 5
         self.batch_delay = 0.003
@@ -199,6 +231,12 @@ class UdpProtocol(BaseProtocol):
         self.packet_sucess = 0
         self.packet_errors = 0
 
+    def _setup_thread(self):
+        # The socket is handled by a thread that's started on connect, packets are passed through the queues
+        self.thread = threading.Thread(None, self._udp_thread, "atem-udp", daemon=True)
+        self.thread_queue = SocketQueue()
+        self.thread_recv_queue = Queue()
+
     def _udp_thread(self):
         while True:
             readable, _, _ = select.select([self.sock, self.thread_queue], [], [])
@@ -220,8 +258,16 @@ class UdpProtocol(BaseProtocol):
                     RuntimeError("Unexpected result from select()")
 
     def get_link_quality(self):
+        if self.packet_sucess == 0:
+            return 100
         return 100 - (self.packet_errors / self.packet_sucess * 100)
 
+    def get_metrics(self):
+        metrics = super().get_metrics()
+        metrics['thread_queue'] = self.thread_queue.qsize()
+        metrics['receive_backlog'] = self.thread_recv_queue.qsize()
+        return metrics
+
     def _send_packet(self, packet):
         self.thread_queue.put(packet)
         self.packet_sucess += 1
@@ -234,6 +280,10 @@ class UdpProtocol(BaseProtocol):
             packet.sequence_number = (self.local_sequence_number + 1) % 2 ** 16
         raw = packet.to_bytes()
         self.sock.sendto(raw, (self.ip, self.port))
+        self.bytes_out.add(len(raw))
+        self.packets_out.add()
+        if packet.flags & UdpProtocol.FLAG_RELIABLE:
+            self.ack_pending[packet.sequence_number] = time.monotonic()
         self.log.debug('> {}'.format(packet))
         if packet.debug:
             # hexdump(raw)
@@ -257,9 +307,17 @@ class UdpProtocol(BaseProtocol):
             self.state = UdpProtocol.STATE_CLOSED
             self.connect()
             return
+        if self.recorder is not None:
+            self.recorder.write(data)
+        self.bytes_in.add(len(data))
+        self.packets_in.add()
         packet = Packet.from_bytes(data)
 
+        if packet.flags & UdpProtocol.FLAG_ACK and len(self.ack_pending):
+            self._handle_ack(packet.acknowledgement_number)
+
         if packet.flags & UdpProtocol.FLAG_RETRANSMISSION:
+            self.retransmissions.add()
             if len(data) > 12:
                 self.log.error("retransmission detected")
                 self.packet_errors += 1
@@ -272,6 +330,7 @@ class UdpProtocol(BaseProtocol):
 
         if packet.flags & UdpProtocol.FLAG_REQUEST_RETRANSMISSION:
             self.log.error("retransmission requested")
+            self.retransmission_requests.add()
             self.packet_errors += 1
             # hexdump(data)
 
@@ -300,6 +359,17 @@ class UdpProtocol(BaseProtocol):
 
         return packet
 
+    def _handle_ack(self, number):
+        # Acknowledgements are cumulative, everything up to the acknowledged packet is done
+        now = time.monotonic()
+        while len(self.ack_pending):
+            sequence, sent = next(iter(self.ack_pending.items()))
+            if (number - sequence) % 2 ** 16 >= 2 ** 15:
+                break
+            del self.ack_pending[sequence]
+            if sequence == number:
+                self.rtt.observe(now - sent)
+
     def _handshake(self, packet):
         if not packet.flags & UdpProtocol.FLAG_SYN:
             return
@@ -324,7 +394,7 @@ class UdpProtocol(BaseProtocol):
         if self.state != UdpProtocol.STATE_CLOSED:
             raise RuntimeError("Trying to open an connection that's already open")
 
-        if not self.thread.is_alive():
+        if self.thread is not None and not self.thread.is_alive():
             self.thread.start()
 
         # Reset internal state
@@ -334,6 +404,7 @@ class UdpProtocol(BaseProtocol):
         self.remote_ack_numbe = 0
         self.session_id = 0x1337
         self.enable_ack = False
+        self.ack_pending.clear()
 
         # Create first syn packet
         syn = Packet()
@@ -349,55 +420,63 @@ class UdpProtocol(BaseProtocol):
 
     def receive_packet(self):
         while True:
-            packet = self._receive_packet()
-
-            if packet is True:
-                continue
-            if packet is None and not self.had_traffic:
-                continue
-            if packet is None and self.state == UdpProtocol.STATE_SYN_SENT:
-                # No response in connect, retry connection
-                self.state = UdpProtocol.STATE_CLOSED
-                self.had_traffic = False
-                self.connect()
-                return None
-
-            if packet is None:
-                # When None is in the receive queue the socket has disconnected
-                return None
-
-            if self.mark_next_connected:
-                self.mark_next_connected = False
-                return ConnectionReady()
+            result = self.process_packet(self._receive_packet())
+            if result is not True:
+                return result
+
+    def process_packet(self, packet):
+        """
+        Run a result of _receive_packet_low() through the connection state machine. Returns True when the packet
+        was handled by the transport, otherwise the result for the upper layer like receive_packet() does.
+        """
+        if packet is True:
+            return True
+        if packet is None and not self.had_traffic:
+            return True
+        if packet is None and self.state == UdpProtocol.STATE_SYN_SENT:
+            # No response in connect, retry connection
+            self.state = UdpProtocol.STATE_CLOSED
+            self.had_traffic = False
+            self.connect()
+            return None
 
-            if self.enable_ack and self.queue_trigger():
-                return TransferQueueFlushed()
+        if packet is None:
+            # When None is in the receive queue the socket has disconnected
+            return None
 
-            if self.state == UdpProtocol.STATE_SYN_SENT:
-                # Got response for the first handshake packet
-                self.had_traffic = True
-                self._handshake(packet)
-            elif self.state == UdpProtocol.STATE_ESTABLISHED:
-                if packet.length == 12:
-                    # This is a control packet, deal with it in the transport layer
-                    if not self.enable_ack:
-                        # This is the first ACK from the mixer, after this we should send ACKs bac
-                        self.enable_ack = True
-                        # self.local_sequence_number = 0
-                        ack = Packet()
-                        ack.flags = UdpProtocol.FLAG_ACK
-                        ack.acknowledgement_number = self.remote_sequence_number
-                        ack.remote_sequence_number = 0x61
-                        ack.label = 'initial ack after connection'
-                        self._send_packet(ack)
-                    # TODO: Implement other control packets, like request for retransmission
-
-                    # Send queued up bulk traffic after the ack
-                    if self.queue_trigger():
-                        return TransferQueueFlushed()
-                else:
-                    # Data packet for the upper layer
-                    return packet
+        if self.mark_next_connected:
+            self.mark_next_connected = False
+            return ConnectionReady()
+
+        if self.enable_ack and self.queue_trigger():
+            return TransferQueueFlushed()
+
+        if self.state == UdpProtocol.STATE_SYN_SENT:
+            # Got response for the first handshake packet
+            self.had_traffic = True
+            self._handshake(packet)
+        elif self.state == UdpProtocol.STATE_ESTABLISHED:
+            if packet.length == 12:
+                # This is a control packet, deal with it in the transport layer
+                if not self.enable_ack:
+                    # This is the first ACK from the mixer, after this we should send ACKs bac
+                    self.enable_ack = True
+                    # self.local_sequence_number = 0
+                    ack = Packet()
+                    ack.flags = UdpProtocol.FLAG_ACK
+                    ack.acknowledgement_number = self.remote_sequence_number
+                    ack.remote_sequence_number = 0x61
+                    ack.label = 'initial ack after connection'
+                    self._send_packet(ack)
+                # TODO: Implement other control packets, like request for retransmission
+
+                # Send queued up bulk traffic after the ack
+                if self.queue_trigger():
+                    return TransferQueueFlushed()
+            else:
+                # Data packet for the upper layer
+                return packet
+        return True
 
     def send_packet(self, packet):
         self._send_packet(packet)
@@ -453,6 +532,8 @@ class UsbProtocol(BaseProtocol):
     def _send_packet(self, packet):
         raw = packet.to_usb()
         self.queue.put(raw)
+        self.bytes_out.add(len(raw))
+        self.packets_out.add()
 
     def _receive_packet(self):
         try:
@@ -465,6 +546,7 @@ class UsbProtocol(BaseProtocol):
             return None
 
         raw = bytes(data)
+        self.bytes_in.add(len(raw))
         if len(raw) == 0:
             # Send queued up bulk traffic after the ack
             if self.queue_trigger():
@@ -480,13 +562,21 @@ class UsbProtocol(BaseProtocol):
             if len(raw) == 0:
                 break
 
+        self.packets_in.add()
         packet = Packet()
         packet.data = b''.join(chunks)
+        if self.recorder is not None:
+            self.recorder.write(packet.data)
         return packet
 
     def connect(self):
         self.handle.ctrl_transfer(0x21, 0, 0x0000, 2, [])
 
+    def get_metrics(self):
+        metrics = super().get_metrics()
+        metrics['write_queue'] = self.queue.qsize()
+        return metrics
+
     def receive_packet(self):
         while True:
 
@@ -540,6 +630,8 @@ class TcpProtocol(BaseProtocol):
     def _send_packet(self, data):
         header = self.STRUCT_HEADER.pack(len(data))
         self.sock.sendall(header + data)
+        self.bytes_out.add(len(data) + 2)
+        self.packets_out.add()
 
     def _receive_packet(self):
         try:
@@ -557,6 +649,10 @@ class TcpProtocol(BaseProtocol):
         except:
             return None
 
+        if self.recorder is not None:
+            self.recorder.write(data)
+        self.bytes_in.add(len(data) + 2)
+        self.packets_in.add()
         packet = Packet()
         packet.data = data
         return packet
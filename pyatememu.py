@@ -0,0 +1,40 @@
+import argparse
+import logging
+
+from pyatem.emulator import Emulator, read_dump, default_dump, capture_dump
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate one or more ATEM switchers on the network")
+    parser.add_argument('--host', default='0.0.0.0', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=9910, help='UDP port of the first switcher')
+    parser.add_argument('--count', type=int, default=1, help='Number of switchers, on consecutive ports')
+    parser.add_argument('--dump', help='State dump to send to clients instead of the default state')
+    parser.add_argument('--inputs', type=int, default=8, help='Number of inputs in the default state')
+    parser.add_argument('--meter-rate', type=float, default=10, help='Audio meter updates per second, 0 to disable')
+    parser.add_argument('--always-meters', action='store_true',
+                        help='Send meter levels to every client instead of only when requested')
+    parser.add_argument('--capture', metavar='IP', help='Capture the state dump of a real switcher to --dump')
+    parser.add_argument('--debug', action='store_true', help='Enable debug logging')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    if args.capture:
+        if not args.dump:
+            parser.error('--capture needs --dump to write the state to')
+        count = capture_dump(args.capture, args.dump)
+        logging.info('Captured {} fields from {} to {}'.format(count, args.capture, args.dump))
+        return
+
+    emulator = Emulator(meter_rate=args.meter_rate, always_meters=args.always_meters)
+    for i in range(args.count):
+        fields = read_dump(args.dump) if args.dump else default_dump(f'ATEM Emulator {i + 1}', inputs=args.inputs)
+        emulator.add_device(fields, port=args.port + i, host=args.host)
+    logging.info('Emulating {} switchers on {}:{}-{}'.format(args.count, args.host, args.port,
+                                                             args.port + args.count - 1))
+    emulator.serve_forever()
+
+
+if __name__ == '__main__':
+    main()